@@ -0,0 +1,156 @@
+# Batching writer for InfluxDB
+#
+# Points are collected per database and retention policy and written in one
+# request per batch, once a batch has `batch_size` points or its oldest point
+# waited `max_latency` seconds. The writes run on a thread of their own.
+# The client can be a LocalStore as well, see local_store.py.
+import time
+import sqlite3
+import logging
+import threading
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+
+log = logging.getLogger("root")
+
+
+class BatchWriter(threading.Thread):
+    """
+    Collects points and writes them in batches, a point without a time gets
+    the time it was added. When InfluxDB is down the
+    points are kept and written with the next flush, up to `max_points`, after
+    that the oldest points are dropped, other client errors than a 400 are
+    retried the same way. When InfluxDB rejects a batch with a 400 it is
+    split to find the points it rejects, only those are dropped. `close()`
+    writes what is left.
+    """
+
+    def __init__(self, client, batch_size=500, max_latency=10, max_points=100000, retry_delay=30):
+        super().__init__(name="batch-writer", daemon=True)
+        self.client = client
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.max_points = max_points
+        self.retry_delay = retry_delay
+        # (database, retention policy) -> [time of the oldest point, points]
+        self.batches = {}
+        self.condition = threading.Condition()
+        self.closed = False
+        self.written = 0
+        self.writes = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def add(self, point, database=None, retention_policy=None):
+        if "time" not in point:
+            # InfluxDB can store part of a batch it rejects, with its own time the
+            # halves written again would duplicate those points
+            point = {**point, "time": time.time_ns()}
+        with self.condition:
+            key = (database, retention_policy)
+            batch = self.batches.get(key)
+            if batch is None or not batch[1]:
+                batch = self.batches[key] = [time.monotonic(), []]
+            batch[1].append(point)
+            if len(batch[1]) > self.max_points:
+                del batch[1][0]
+                self.dropped += 1
+            # wake up the writer for the deadline of a new batch or a full batch
+            if len(batch[1]) == 1 or len(batch[1]) >= self.batch_size:
+                self.condition.notify()
+
+    def due(self, now):
+        # the batches to write now, everything once closed
+        return [
+            key
+            for key, (oldest, points) in self.batches.items()
+            if points and (self.closed or len(points) >= self.batch_size or now - oldest >= self.max_latency)
+        ]
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    keys = self.due(now)
+                    if keys or (self.closed and not self.batches):
+                        break
+                    deadlines = [oldest + self.max_latency for oldest, points in self.batches.values() if points]
+                    self.condition.wait(min(deadlines) - now if deadlines else None)
+                closed = self.closed
+                batches = {key: self.batches.pop(key)[1] for key in keys}
+
+            failed = False
+            for (database, retention_policy), points in batches.items():
+                for i in range(0, len(points), self.batch_size):
+                    if failed or not self.write(points[i : i + self.batch_size], database, retention_policy):
+                        # keep the points for the next flush, before the ones that came in meanwhile
+                        failed = True
+                        self.requeue(points[i:], database, retention_policy)
+                        break
+
+            if failed:
+                if closed:
+                    log.error("InfluxDB is down, %d points are not written", self.pending())
+                    return
+                with self.condition:
+                    # new points don't cut the back-off short, only close() does
+                    self.condition.wait_for(lambda: self.closed, self.retry_delay)
+            elif closed and not self.batches:
+                return
+
+    def write(self, points, database, retention_policy):
+        # False when the points should be written again later
+        try:
+            self.client.write_points(
+                points, database=database, retention_policy=retention_policy, batch_size=len(points)
+            )
+            self.written += len(points)
+            self.writes += 1
+            return True
+        except (InfluxDBClientError, ValueError) as e:
+            if isinstance(e, InfluxDBClientError) and e.code != 400:
+                # like a 401 or a 404 for a database that isn't there yet, no reason to drop the points
+                log.error("InfluxDB client error writing %d points, retry later: %s", len(points), e)
+                return False
+            if len(points) > 1:
+                # write the halves, so only the points InfluxDB rejects are dropped
+                half = len(points) // 2
+                if not self.write(points[:half], database, retention_policy):
+                    return False
+                return self.write(points[half:], database, retention_policy)
+            self.rejected += 1
+            log.error("InfluxDB rejected point %s, dropped", points[0], exc_info=e)
+            return True
+        except (InfluxDBServerError, OSError, sqlite3.Error) as e:
+            log.error("failed to write a batch of %d points, retry later", len(points), exc_info=e)
+            return False
+
+    def requeue(self, points, database, retention_policy):
+        with self.condition:
+            batch = self.batches.get((database, retention_policy))
+            if batch is None or not batch[1]:
+                batch = self.batches[(database, retention_policy)] = [time.monotonic(), []]
+            batch[1][:0] = points
+            excess = len(batch[1]) - self.max_points
+            if excess > 0:
+                del batch[1][:excess]
+                self.dropped += excess
+
+    def pending(self):
+        with self.condition:
+            return sum(len(points) for _, points in self.batches.values())
+
+    def close(self, timeout=30):
+        # write the points that are left and stop
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.join(timeout)
+        log.info(
+            "batch writer: %d points in %d writes, %d dropped, %d rejected, %d not written",
+            self.written,
+            self.writes,
+            self.dropped,
+            self.rejected,
+            self.pending(),
+        )
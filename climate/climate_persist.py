@@ -1,13 +1,17 @@
 import os
-import re
 import sys
-import json
 import time
+import signal
 import logging
 from logging.handlers import RotatingFileHandler
 import paho.mqtt.client as mqtt
 from influxdb import InfluxDBClient
-from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from local_store import LocalStore
+from batch_writer import BatchWriter
+from workers import MessageWorkers
+from routing import Router, load_routes
+from field_types import FieldTypes
+from deadband import DeadbandFilter, load_filters
 
 # MQTT connection variables
 mqtt_broker = os.getenv("MQTT_BROKER", "localhost")
@@ -23,9 +27,44 @@ influx_port = int(os.getenv("INFLUXDB_PORT", "8086"))
 influx_user = os.getenv("INFLUXDB_USER", "user")
 influx_password = os.getenv("INFLUXDB_PASSWORD", "")
 influx_db = os.getenv("INFLUXDB_CLIMATE_DATABASE", "climate")
+influx_retention_policy = os.getenv("INFLUXDB_CLIMATE_RETENTION_POLICY") or None
+
+# influxdb, or sqlite to store the points in STORAGE_DIR/<database>.db with
+# local_store.py, the tables of days older than STORAGE_RETENTION_DAYS are dropped
+storage_backend = os.getenv("STORAGE_BACKEND", "influxdb")
+storage_dir = os.getenv("STORAGE_DIR", "data")
+storage_retention_days = int(os.getenv("STORAGE_RETENTION_DAYS", "0"))
+
+# points are written in batches of at most CLIMATE_BATCH_SIZE points, a point
+# waits at most CLIMATE_BATCH_LATENCY seconds
+batch_size = int(os.getenv("CLIMATE_BATCH_SIZE", "500"))
+batch_latency = float(os.getenv("CLIMATE_BATCH_LATENCY", "10"))
+
+# messages are transformed and stored by CLIMATE_WORKERS threads, every worker
+# queues at most CLIMATE_QUEUE_SIZE messages and drops the oldest when full
+workers = int(os.getenv("CLIMATE_WORKERS", "2"))
+queue_size = int(os.getenv("CLIMATE_QUEUE_SIZE", "1000"))
+stats_interval = int(os.getenv("CLIMATE_STATS_INTERVAL", "300"))
+
+# join the shared subscription `$share/<group>/CLIMATE_TOPIC/#` so several
+# processes split the messages, empty to get all messages in this process;
+# the deadband state is kept per process, so it can't be used with CLIMATE_FILTERS
+share_group = os.getenv("CLIMATE_SHARE_GROUP", "")
 
 location = os.getenv("LOCATION", "house")
 
+# values that don't fit the type of their field are written to this measurement
+quarantine_measurement = os.getenv("CLIMATE_QUARANTINE_MEASUREMENT", "quarantine")
+
+# routing table of the devices to their measurements, see routing.py
+routes_file = os.getenv(
+    "CLIMATE_ROUTES", os.path.join(os.path.dirname(os.path.abspath(__file__)), "routes.json")
+)
+
+# deadband, smoothing and heartbeat per device and field, see deadband.py and the
+# example filters.json, empty to write every value
+filters_file = os.getenv("CLIMATE_FILTERS", "")
+
 # Configure logging
 log_dir = os.path.join(os.getenv("LOG_DIR", "/var/log"), "climate.log")
 log_handler = RotatingFileHandler(log_dir, maxBytes=5 * 1024 * 1024, backupCount=2)
@@ -39,84 +78,67 @@ log.setLevel(logging.INFO)
 log.addHandler(log_handler)
 log.addHandler(logging.StreamHandler())
 
+router = Router(load_routes(routes_file), {"location": location}, stats_interval)
+field_types = FieldTypes(quarantine_measurement)
+deadband = DeadbandFilter(load_filters(filters_file), stats_interval) if filters_file else None
+if share_group and deadband is not None:
+    # a process of the group doesn't see every value of a device to filter
+    raise ValueError("CLIMATE_SHARE_GROUP can't be used with CLIMATE_FILTERS, unset one of them")
 
-def prepare_data(device, entry):
+
+def prepare_data(device, entry, retained=False):
     try:
-        if device == "operame":
-            match = re.search(r"(\d+).*", entry, re.IGNORECASE)
-            if match:
-                data = {
-                    "measurement": device,
-                    "tags": {
-                        "location": location,
-                        "devices": "operame",
-                        "sensor": "metriful",
-                    },
-                    "fields": {"co2": int(match.group(1))},
-                }
-            else:
-                log.error("failed to receive correct format from operame: %s", entry)
-                return None
-        elif device == "esp32":
-            fields = json.loads(entry)
-            data = {
-                "measurement": "esp32",
-                "tags": {"location": location, "devices": "esp32", "sensor": "esp32"},
-                "fields": fields,
-            }
-        elif device.startswith("esp"):
-            fields = json.loads(entry)
-            if "humidity" in fields:
-                fields["humidity"] = float(fields["humidity"])
-            data = {
-                "measurement": device,
-                "tags": {"location": location, "devices": device, "sensor": device},
-                "fields": fields,
-            }
-        else:
-            data = json.loads(entry)
-    except (ValueError, json.JSONDecodeError, KeyError, TypeError) as e:
+        return router.route(device, entry, retained)
+    except (ValueError, KeyError, TypeError) as e:
         log.error("failed to read data from '%s': %s", device, entry, exc_info=e)
         return None
 
-    return data
-
 
 def store(device, data):
-    # Send the JSON data to InfluxDB
-    try:
-        successful = dbclient.write_points([data])
-        if not successful:
-            log.error("failed to write to db for device '%s': '%s'", device, data)
-    except (InfluxDBClientError, InfluxDBServerError) as e:
-        log.exception("InfluxDB error occurred: %s", e)
+    # Queue the JSON data for the next batch to InfluxDB
+    log.debug("queue point of device '%s'", device)
+    # one value of the wrong type must not fail the whole batch
+    for point in field_types.check(data):
+        writer.add(point, influx_db, influx_retention_policy)
 
 
 # The callback for when the client receives a CONNACK response from the server.
-def on_connect(_client, _userdata, _flags, rc):
+def on_connect(_client, _userdata, _flags, rc, _properties=None):
     log.info("connected with result code: '%s'", mqtt.connack_string(rc))
 
     # Subscribing in on_connect() means that if we lose the connection and
     # reconnect then subscriptions will be renewed.
     topic = f"{mqtt_topic}/#"
+    if share_group:
+        # the broker hands every message to one member of the group, the
+        # workers in this process still keep the messages of a device in order
+        topic = f"$share/{share_group}/{topic}"
+    log.info("subscribe to %s", topic)
     client.subscribe(topic)
 
 
-def on_disconnect(_client, _userdata, rc):
+def on_disconnect(_client, _userdata, rc, _properties=None):
     if rc != 0:
         print("unexpected disconnection: ''%s'", mqtt.error_string(rc))
 
 
+def handle(device, entry, retained):
+    # runs on a worker thread
+    data = prepare_data(device, entry, retained)
+    log.info("received update for device='%s': data=%s", device, data)
+    if data is not None and deadband is not None:
+        data = deadband(device, data)
+    if data is not None:
+        store(device, data)
+
+
 # The callback for when a PUBLISH message is received from the server.
 def on_message(_client, _userdata, msg):
     try:
         device = msg.topic[len(mqtt_topic) + 1 :]
         entry = msg.payload.decode("utf-8")
-
-        data = prepare_data(device, entry)
-        log.info("received update for device='%s': data=%s", device, data)
-        if data is not None:
-            store(device, data)
+        # hand over to the workers, the network loop must not wait for InfluxDB
+        message_workers.put(device, entry, msg.retain)
 
     except (UnicodeDecodeError, AttributeError) as e:
         log.error("failure", exc_info=e)
@@ -127,20 +149,29 @@ def on_message(_client, _userdata, msg):
 ########################
 if "__main__" == __name__:
     log.info("starting climate persist service")
-    # Set up a client for InfluxDB
-    while True:
-        try:
-            # Create the InfluxDB client object
-            dbclient = InfluxDBClient(
-                influx_host, influx_port, influx_user, influx_password, influx_db
-            )
-            break
-        except ConnectionError:
-            logging.exception("failed to connect to influx")
-            time.sleep(120)
-
-
-    client = mqtt.Client()
+    if storage_backend == "sqlite":
+        dbclient = LocalStore(os.path.join(storage_dir, f"{influx_db}.db"), retention_days=storage_retention_days)
+    else:
+        # Set up a client for InfluxDB
+        while True:
+            try:
+                # Create the InfluxDB client object
+                dbclient = InfluxDBClient(
+                    influx_host, influx_port, influx_user, influx_password, influx_db
+                )
+                break
+            except ConnectionError:
+                logging.exception("failed to connect to influx")
+                time.sleep(120)
+
+        field_types.load(dbclient, influx_db)
+    writer = BatchWriter(dbclient, batch_size, batch_latency)
+    writer.start()
+    message_workers = MessageWorkers(handle, workers, queue_size, stats_interval)
+    message_workers.start()
+
+    # shared subscriptions are part of MQTT 5
+    client = mqtt.Client(protocol=mqtt.MQTTv5 if share_group else mqtt.MQTTv311)
     client.on_connect = on_connect
     client.on_disconnect = on_disconnect
     client.on_message = on_message
@@ -150,10 +181,23 @@ if "__main__" == __name__:
 
     client.connect(mqtt_broker, mqtt_port, mqtt_timeout)
 
+    # stop on SIGTERM like on ctrl-c, so the queues are drained and the last batch is written
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
     # Blocking call that processes network traffic, dispatches callbacks and
     # handles reconnecting.
     # Other loop*() functions are available that give a threaded interface and a
     # manual interface.
-    client.loop_forever()
+    try:
+        client.loop_forever()
+    except KeyboardInterrupt:
+        log.info("climate persist service stopped")
+    finally:
+        client.disconnect()
+        message_workers.stop()
+        writer.close()
+        log.info("routing stats: %s, field types: %s", router.stats(), field_types.stats())
+        if deadband is not None:
+            log.info("deadband stats: %s", deadband.stats())
 
     sys.exit()
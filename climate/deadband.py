@@ -0,0 +1,167 @@
+# Deadband and smoothing of noisy sensor fields
+#
+# The filter table maps a device, by exact name, longest prefix like `esp*` or
+# `*` as with the routes, to the fields to filter; `*` filters every numeric
+# field of the device:
+#
+#   "operame": {
+#     "co2": {"deadband": 10, "heartbeat": 900}
+#   },
+#   "esp*": {
+#     "temperature": {"deadband": 0.2, "ewma": 0.3},
+#     "humidity": {"relative": 0.02}
+#   }
+#
+# A value is written when it differs at least `deadband` from the last written
+# value, or `relative` times the last written value, or when the field wasn't
+# written for `heartbeat` seconds (600 by default). After a written 0 only the
+# deadband counts, or any change without one. With `ewma` the field is the
+# exponentially weighted moving average of the values, with that weight for the
+# newest value, so a single spike doesn't pass the deadband. A point without
+# fields left isn't written at all.
+import time
+import json
+import logging
+import threading
+
+log = logging.getLogger("root")
+
+
+class FieldFilter:
+
+    def __init__(self, spec):
+        self.deadband = spec.get("deadband")
+        self.relative = spec.get("relative")
+        self.ewma = spec.get("ewma")
+        self.heartbeat = spec.get("heartbeat", 600)
+        if self.ewma is not None and not 0 < self.ewma <= 1:
+            raise ValueError(f"ewma {self.ewma} isn't a weight between 0 and 1")
+
+    def __call__(self, state, value, now):
+        # the value to write, None when it is suppressed; state is [average, written, written at]
+        integer = isinstance(value, int)
+        if state[0] is not None and self.ewma is not None:
+            value = self.ewma * value + (1 - self.ewma) * state[0]
+        state[0] = value
+        if integer:
+            # an integer field stays an integer
+            value = round(value)
+
+        written, written_at = state[1], state[2]
+        if written is None or now - written_at >= self.heartbeat or self.changed(written, value):
+            state[1] = value
+            state[2] = now
+            return value
+        return None
+
+    def changed(self, written, value):
+        difference = abs(value - written)
+        if self.deadband is None and self.relative is None:
+            return difference > 0
+        if self.deadband is not None and difference >= self.deadband:
+            return True
+        if self.relative is None:
+            return False
+        if written == 0:
+            # any change from zero is relatively infinite, the deadband or heartbeat decides
+            return self.deadband is None and difference > 0
+        return difference >= self.relative * abs(written)
+
+
+class DeadbandFilter:
+    """
+    Filters the fields of the points of every device with the filter table.
+    The points of a device are filtered in order by one worker, the state is
+    kept per device, measurement and field. The counters are logged every
+    `stats_interval` seconds.
+    """
+
+    def __init__(self, filters, stats_interval=300):
+        self.exact = {}
+        self.prefixes = {}
+        self.default = None
+        for pattern, fields in filters.items():
+            field_filters = {field: FieldFilter(spec) for field, spec in fields.items()}
+            if pattern == "*":
+                self.default = field_filters
+            elif pattern.endswith("*"):
+                self.prefixes[pattern[:-1]] = field_filters
+            else:
+                self.exact[pattern] = field_filters
+        self.lengths = sorted({len(prefix) for prefix in self.prefixes}, reverse=True)
+        self.cache = {}
+        # (device, measurement, field) -> [average, written, written at]
+        self.state = {}
+        self.lock = threading.Lock()
+        self.stats_interval = stats_interval
+        self.last_stats = time.monotonic()
+        self.passed = 0
+        self.suppressed = 0
+        self.dropped = 0
+        self.suppressed_devices = {}
+
+    def lookup(self, device):
+        if device in self.cache:
+            return self.cache[device]
+        filters = self.exact.get(device)
+        if filters is None:
+            for length in self.lengths:
+                filters = self.prefixes.get(device[:length])
+                if filters is not None:
+                    break
+            else:
+                filters = self.default
+        if len(self.cache) < 10000:
+            self.cache[device] = filters
+        return filters
+
+    def __call__(self, device, point):
+        # the point with the fields to write, None when all fields are suppressed
+        if time.monotonic() - self.last_stats >= self.stats_interval:
+            self.last_stats = time.monotonic()
+            log.info("deadband stats: %s", self.stats())
+
+        filters = self.lookup(device)
+        if not filters:
+            return point
+
+        # the time of the message, so a replay is filtered like it was sent
+        now = point["time"] / 1e9 if isinstance(point.get("time"), int) else time.time()
+        measurement = point.get("measurement")
+        fields = {}
+        suppressed = 0
+        with self.lock:
+            for field, value in point.get("fields", {}).items():
+                field_filter = filters.get(field) or filters.get("*")
+                if field_filter is None or not isinstance(value, (int, float)) or isinstance(value, bool):
+                    fields[field] = value
+                    continue
+                state = self.state.setdefault((device, measurement, field), [None, None, None])
+                value = field_filter(state, value, now)
+                if value is None:
+                    suppressed += 1
+                else:
+                    fields[field] = value
+
+            self.passed += len(fields)
+            self.suppressed += suppressed
+            if suppressed:
+                self.suppressed_devices[device] = self.suppressed_devices.get(device, 0) + suppressed
+            if not fields:
+                self.dropped += 1
+                return None
+        return {**point, "fields": fields}
+
+    def stats(self):
+        with self.lock:
+            return {
+                "passed": self.passed,
+                "suppressed": self.suppressed,
+                "dropped": self.dropped,
+                "devices": dict(self.suppressed_devices),
+            }
+
+
+def load_filters(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
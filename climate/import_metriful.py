@@ -0,0 +1,349 @@
+# Bulk import of Metriful data files
+#
+# Imports the data files of the Metriful examples, the columns that
+# writeAirData() and the other write functions write to the file of
+# startNewDataFile(), and CSV exports with a header, like the ones of the
+# influx CLI. Every row becomes the point that metriful_service.py would have
+# published and goes through the router and the field types of
+# climate_persist, then it is written in large batches.
+#
+# The files are split in chunks of --chunk-size MB on line boundaries, every
+# chunk is imported by one of --workers processes. The rows of a column file
+# have no time: the file name has the start time, data_2024-01-31_12-00-00.txt
+# in local time, and every row is --period seconds later than the one before.
+# The rows of a CSV export are written at the time in their `time` column.
+#
+# Every imported chunk is checkpointed to --state, so running the same import
+# again continues with the chunks that aren't imported yet. A changed file is
+# imported again; the points keep their time, so that overwrites them.
+#
+# usage: python import_metriful.py data/*.txt [--workers 4] [--period 100] [--dry-run]
+import os
+import re
+import csv
+import json
+import time
+import argparse
+import logging
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from routing import Router, load_routes, source_time
+from field_types import FieldTypes
+
+# Configure InfluxDB connection variables
+influx_host = os.getenv("INFLUXDB_HOST", "localhost")
+influx_port = int(os.getenv("INFLUXDB_PORT", "8086"))
+influx_user = os.getenv("INFLUXDB_USER", "user")
+influx_password = os.getenv("INFLUXDB_PASSWORD", "")
+influx_db = os.getenv("INFLUXDB_CLIMATE_DATABASE", "climate")
+influx_retention_policy = os.getenv("INFLUXDB_CLIMATE_RETENTION_POLICY") or None
+
+location = os.getenv("LOCATION", "house")
+# as metriful_service.py, the device is the last part of its topic
+device_name = os.getenv("DEVICE_NAME", "device")
+metriful_device = os.getenv("METRIFUL_TOPIC", "sensor/climate/metriful").rsplit("/", 1)[-1]
+
+quarantine_measurement = os.getenv("CLIMATE_QUARANTINE_MEASUREMENT", "quarantine")
+routes_file = os.getenv(
+    "CLIMATE_ROUTES", os.path.join(os.path.dirname(os.path.abspath(__file__)), "routes.json")
+)
+
+# the columns of a data file, in the order of the write functions; the sound
+# data ends with its stability and the particle data is only there with a
+# particle sensor
+AIR = ["temperature", "pressure", "humidity", "gas_sensor_resistance"]
+AIR_QUALITY = ["air_quality_index", "estimated_co2", "equivalent_breath_voc", "air_quality_accuracy"]
+LIGHT = ["illuminance", "white_light_level"]
+SOUND = (
+    ["a_weighted_sound_pressure_level"]
+    + [f"frequency_band_{hz}" for hz in (125, 250, 500, 1000, 2000, 4000)]
+    + ["peak_sound_amplitude", None]
+)
+PARTICLE = ["particle_duty_cycle", "particle_concentration", "particle_valid"]
+COLUMNS = AIR + AIR_QUALITY + LIGHT + SOUND
+# columns of a CSV export that aren't fields
+TAGS = ("location", "devices", "sensor")
+SKIP = ("name", "tags")
+
+FILE_TIME = re.compile(r"data_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})")
+
+logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
+log = logging.getLogger("root")
+
+# the router, field types and client of a worker process
+worker = {}
+
+
+def number(text):
+    # the value as metriful_service.py sends it: integers stay integers
+    if "." in text or "e" in text or "n" in text:
+        return float(text)
+    return int(text)
+
+
+def message(fields, tags=None, timestamp=None):
+    data = {
+        "measurement": "metriful",
+        "tags": {"location": location, "devices": device_name, "sensor": "metriful", **(tags or {})},
+        "fields": fields,
+    }
+    if timestamp is not None:
+        data["time"] = timestamp
+    return data
+
+
+def from_columns(values, timestamp):
+    if len(values) == len(COLUMNS):
+        names = COLUMNS
+    elif len(values) == len(COLUMNS) + len(PARTICLE):
+        names = COLUMNS + PARTICLE
+    else:
+        raise ValueError(f"{len(values)} columns, a data file has {len(COLUMNS)} or {len(COLUMNS) + len(PARTICLE)}")
+    fields = {name: number(value) for name, value in zip(names, values) if name}
+    # the service sends the pressure in hPa
+    fields["pressure"] = fields["pressure"] / 100
+    return message(fields, timestamp=timestamp)
+
+
+def from_csv(header, values):
+    fields = {}
+    tags = {}
+    timestamp = None
+    for name, value in zip(header, values):
+        if name in SKIP or value == "":
+            continue
+        if name == "time":
+            timestamp = source_time(number(value) if value.isdigit() else value)
+        elif name in TAGS:
+            tags[name] = value
+        else:
+            try:
+                fields[name] = number(value)
+            except ValueError:
+                fields[name] = value
+    if timestamp is None:
+        raise ValueError(f"row without a time: {values}")
+    return message(fields, tags, timestamp)
+
+
+def start_time(path):
+    # nanoseconds since epoch of the first row of a column file, None when the name has no time
+    match = FILE_TIME.search(os.path.basename(path))
+    if not match:
+        return None
+    return int(datetime.strptime(match.group(1), "%Y-%m-%d_%H-%M-%S").timestamp() * 1e9)
+
+
+def plan(path, chunk_size):
+    # the chunks of a file: (start, end, rows before the chunk), and the CSV header or None
+    with open(path, "rb") as f:
+        first = f.readline()
+        header = None
+        start = 0
+        if b"," in first:
+            header = next(csv.reader([first.decode("utf-8-sig")]))
+            start = f.tell()
+
+        chunks = []
+        rows = 0
+        while True:
+            f.seek(start)
+            data = f.read(chunk_size)
+            if not data:
+                break
+            # end the chunk after the last complete line, or with the file
+            end = data.rfind(b"\n") + 1 if len(data) == chunk_size else len(data)
+            if end == 0:
+                end = len(data)
+            chunks.append((start, start + end, rows))
+            rows += data.count(b"\n", 0, end)
+            start += end
+    return chunks, header
+
+
+def write(client, points, args, attempts=3):
+    for attempt in range(1, attempts + 1):
+        try:
+            client.write_points(points, retention_policy=influx_retention_policy, batch_size=args.batch_size)
+            return
+        except (InfluxDBClientError, InfluxDBServerError, OSError) as e:
+            if attempt == attempts:
+                raise
+            log.warning("write failed, attempt %d of %d: %s", attempt, attempts, e)
+            time.sleep(5 * attempt)
+
+
+def init_worker(args):
+    worker["router"] = Router(load_routes(routes_file), {"location": location}, stats_interval=float("inf"))
+    worker["field_types"] = FieldTypes(quarantine_measurement)
+    worker["client"] = None
+    if not args.dry_run:
+        client = InfluxDBClient(influx_host, influx_port, influx_user, influx_password, influx_db)
+        worker["field_types"].load(client, influx_db)
+        worker["client"] = client
+
+
+def import_chunk(job, args):
+    path, start, end, row, header, first_time = job
+    started = time.monotonic()
+    router = worker["router"]
+    field_types = worker["field_types"]
+    client = worker["client"]
+
+    rows = 0
+    invalid = 0
+    written = 0
+    batch = []
+    with open(path, "rb") as f:
+        f.seek(start)
+        lines = f.read(end - start).decode("utf-8", errors="replace").splitlines()
+    if header is not None:
+        lines = csv.reader(lines)
+
+    for line in lines:
+        row += 1
+        values = line if header is not None else line.split()
+        if not values:
+            continue
+        rows += 1
+        try:
+            if header is not None:
+                data = from_csv(header, values)
+            else:
+                data = from_columns(values, first_time + int((row - 1) * args.period * 1e9))
+            point = router.route(metriful_device, data)
+        except (ValueError, KeyError, TypeError) as e:
+            invalid += 1
+            if invalid <= 10:
+                log.warning("%s row %d: %s", path, row, e)
+            continue
+        if point is None:
+            invalid += 1
+            continue
+        batch.extend(field_types.check(point))
+
+        if len(batch) >= args.batch_size:
+            if client is not None:
+                write(client, batch, args)
+            written += len(batch)
+            batch = []
+
+    if batch and client is not None:
+        write(client, batch, args)
+    written += len(batch)
+    return rows, invalid, written, time.monotonic() - started
+
+
+def chunk_key(path, start):
+    # a chunk of this version of the file
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}:{start}"
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf-8") as f:
+        return set(json.load(f))
+
+
+def checkpoint(path, done):
+    temp = path + ".tmp"
+    with open(temp, "w", encoding="utf-8") as f:
+        json.dump(sorted(done), f)
+    os.replace(temp, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="import Metriful data files into InfluxDB")
+    parser.add_argument("files", nargs="+", help="column data files or CSV exports")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=float, default=16, help="MB per chunk")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--period", type=float, default=100, help="seconds between the rows of a column file")
+    parser.add_argument(
+        "--start", type=datetime.fromisoformat, help="local time of the first row of column files without a time"
+    )
+    parser.add_argument("--state", default="import.json", help="checkpoint of the imported chunks")
+    parser.add_argument("--dry-run", action="store_true", help="read and convert only, don't write to InfluxDB")
+    args = parser.parse_args()
+
+    done = set() if args.dry_run else load_state(args.state)
+    jobs = []
+    total_bytes = 0
+    skipped_bytes = 0
+    for path in args.files:
+        chunks, header = plan(path, int(args.chunk_size * 1024 * 1024))
+        first_time = None
+        if header is None:
+            first_time = start_time(path)
+            if first_time is None and args.start:
+                first_time = int(args.start.timestamp() * 1e9)
+            if first_time is None:
+                log.error("%s: no time in the file name, import it with --start", path)
+                continue
+        for start, end, row in chunks:
+            total_bytes += end - start
+            key = chunk_key(path, start)
+            if key in done:
+                skipped_bytes += end - start
+                continue
+            jobs.append((key, (path, start, end, row, header, first_time)))
+    if not jobs:
+        log.info("nothing to import, %d files are imported", len(args.files))
+        return
+
+    log.info(
+        "import %d chunks with %d workers, %.0f of %.0f MB imported before",
+        len(jobs),
+        args.workers,
+        skipped_bytes / 1e6,
+        total_bytes / 1e6,
+    )
+    started = time.monotonic()
+    imported_bytes = skipped_bytes
+    total_rows = 0
+    total_invalid = 0
+    total_points = 0
+    with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(args,)) as executor:
+        futures = {executor.submit(import_chunk, job, args): (key, job) for key, job in jobs}
+        for future in as_completed(futures):
+            key, (path, start, end, _, _, _) = futures[future]
+            rows, invalid, points, seconds = future.result()
+            total_rows += rows
+            total_invalid += invalid
+            total_points += points
+            imported_bytes += end - start
+            if not args.dry_run:
+                done.add(key)
+                checkpoint(args.state, done)
+
+            elapsed = time.monotonic() - started
+            log.info(
+                "%.1f%% %s@%d: %d rows, %d invalid, %d points in %.1fs, total %d points (%.0f points/s)",
+                imported_bytes / total_bytes * 100,
+                path,
+                start,
+                rows,
+                invalid,
+                points,
+                seconds,
+                total_points,
+                total_points / elapsed if elapsed else 0,
+            )
+
+    elapsed = time.monotonic() - started
+    log.info(
+        "imported %d rows into %d points in %.1fs (%.0f points/s), %d invalid rows",
+        total_rows,
+        total_points,
+        elapsed,
+        total_points / elapsed if elapsed else 0,
+        total_invalid,
+    )
+
+
+if __name__ == "__main__":
+    main()
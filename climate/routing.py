@@ -0,0 +1 @@
+../mqtt/routing.py
\ No newline at end of file
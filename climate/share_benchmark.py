@@ -0,0 +1,116 @@
+# Benchmark of the shared subscription of the persist services
+#
+# Runs 1 up to N worker processes that join the same `$share` group on a local
+# broker and route every message like climate_persist, without writing to
+# InfluxDB. For every number of workers a publisher process sends the same
+# esp messages, the report has the throughput and the share of every worker.
+# The numbers depend on the broker and the host, run it on the Pi with the
+# broker of the services before choosing the number of processes.
+#
+# The broker decides which member of the group gets a message: mosquitto hands
+# them out round robin, so the messages of one device can be handled by several
+# processes. A broker that dispatches by topic, like EMQX with the `hash_topic`
+# strategy, keeps every device on one process. Either way the deadband filter
+# and the watering detector keep their state per process, the services refuse
+# a share group together with them.
+#
+# usage: python share_benchmark.py [--workers 4] [--messages 20000] [--broker localhost]
+import os
+import json
+import time
+import argparse
+import multiprocessing
+import paho.mqtt.client as mqtt
+from routing import Router, load_routes
+
+routes_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "routes.json")
+
+
+def worker(index, args, ready, received, stopping):
+    router = Router(load_routes(routes_file), {"location": "benchmark"})
+    client = mqtt.Client(client_id=f"share-benchmark-{index}", protocol=mqtt.MQTTv5)
+
+    def on_connect(client, _userdata, _flags, _rc, _properties=None):
+        client.subscribe(f"$share/{args.group}/{args.topic}/#", qos=1)
+
+    def on_subscribe(_client, _userdata, _mid, _reason_codes, _properties=None):
+        ready.release()
+
+    def on_message(_client, _userdata, msg):
+        router.route(msg.topic[len(args.topic) + 1 :], msg.payload.decode("utf-8"))
+        received.value += 1
+
+    client.on_connect = on_connect
+    client.on_subscribe = on_subscribe
+    client.on_message = on_message
+    client.connect(args.broker, args.port)
+    client.loop_start()
+    stopping.wait()
+    client.loop_stop()
+    client.disconnect()
+
+
+def publish(args):
+    client = mqtt.Client(client_id="share-benchmark-publisher", protocol=mqtt.MQTTv5)
+    client.max_queued_messages_set(0)
+    client.connect(args.broker, args.port)
+    client.loop_start()
+    result = None
+    for i in range(args.messages):
+        payload = json.dumps({"temperature": 20 + i % 50 / 10, "humidity": str(40 + i % 20), "pressure": 1013})
+        result = client.publish(f"{args.topic}/esp{i % args.devices}", payload, qos=1)
+    if result is not None:
+        result.wait_for_publish()
+    client.loop_stop()
+    client.disconnect()
+
+
+def run(workers, args):
+    ready = multiprocessing.Semaphore(0)
+    stopping = multiprocessing.Event()
+    counts = [multiprocessing.Value("l", 0, lock=False) for _ in range(workers)]
+    processes = [
+        multiprocessing.Process(target=worker, args=(i, args, ready, counts[i], stopping)) for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        if not ready.acquire(timeout=10):
+            raise SystemExit(f"workers didn't subscribe on {args.broker}:{args.port}")
+
+    started = time.monotonic()
+    publisher = multiprocessing.Process(target=publish, args=(args,))
+    publisher.start()
+    deadline = started + args.timeout
+    while sum(count.value for count in counts) < args.messages and time.monotonic() < deadline:
+        time.sleep(0.01)
+    elapsed = time.monotonic() - started
+
+    publisher.join()
+    stopping.set()
+    for process in processes:
+        process.join()
+
+    total = sum(count.value for count in counts)
+    shares = ", ".join(f"{count.value / total * 100:.0f}%" if total else "0%" for count in counts)
+    print(f"{workers} workers: {total}/{args.messages} messages in {elapsed:.2f}s, {total / elapsed:.0f}/s, shares {shares}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the shared subscription against a local broker")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="run 1 up to this many workers")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--broker", default=os.getenv("MQTT_BROKER", "localhost"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("MQTT_PORT", "1883")))
+    parser.add_argument("--topic", default="benchmark/climate")
+    parser.add_argument("--group", default="benchmark")
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    for workers in range(1, args.workers + 1):
+        run(workers, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import time
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from batch_writer import BatchWriter
+
+
+class FakeInflux:
+    def __init__(self):
+        self.points = []
+        self.down = False
+        self.error = None
+        self.attempts = 0
+
+    def write_points(self, points, database=None, retention_policy=None, batch_size=None):
+        self.attempts += 1
+        if self.down:
+            raise InfluxDBServerError("down")
+        if self.error is not None:
+            raise self.error
+        # InfluxDB stores the good points of a batch before it rejects the bad ones
+        good = [point for point in points if point["fields"]["value"] != "bad"]
+        self.points.extend(good)
+        if len(good) < len(points):
+            raise InfluxDBClientError("partial write: field type conflict", 400)
+
+
+def point(value, **extra):
+    return {"measurement": "climate", "fields": {"value": value}, **extra}
+
+
+def test_points_get_a_time_before_they_are_batched():
+    influx = FakeInflux()
+    writer = BatchWriter(influx, batch_size=100, max_latency=60)
+    writer.add(point(1))
+    writer.add(point(2, time=5))
+    writer.start()
+    writer.close()
+    assert isinstance(influx.points[0]["time"], int)
+    assert influx.points[1]["time"] == 5
+
+
+def test_a_rejected_batch_is_split_without_new_points():
+    influx = FakeInflux()
+    writer = BatchWriter(influx, batch_size=100, max_latency=60)
+    for value in (1, 2, "bad", 4):
+        writer.add(point(value))
+    writer.start()
+    writer.close()
+    assert writer.rejected == 1
+    # the points written twice have the same time, InfluxDB overwrites them
+    assert len({(p["time"], p["fields"]["value"]) for p in influx.points}) == 3
+
+
+def test_points_are_kept_while_influxdb_is_down():
+    influx = FakeInflux()
+    influx.down = True
+    writer = BatchWriter(influx, batch_size=100, max_latency=60)
+    writer.add(point(1))
+    writer.start()
+    writer.close(timeout=5)
+    assert writer.pending() == 1 and not influx.points
+
+
+def test_full_batches_wait_for_the_back_off():
+    influx = FakeInflux()
+    influx.down = True
+    writer = BatchWriter(influx, batch_size=1, max_latency=60, retry_delay=60)
+    writer.start()
+    writer.add(point(1))
+    time.sleep(0.1)
+    for value in range(2, 5):
+        writer.add(point(value))
+    time.sleep(0.1)
+    assert influx.attempts == 1
+    # close doesn't wait for the back-off
+    influx.down = False
+    writer.close(timeout=5)
+    assert not writer.is_alive() and len(influx.points) == 4
+
+
+def test_other_client_errors_keep_the_batch():
+    influx = FakeInflux()
+    influx.error = InfluxDBClientError("database not found: climate", 404)
+    writer = BatchWriter(influx, batch_size=100, max_latency=60)
+    for value in (1, 2, 3):
+        writer.add(point(value))
+    writer.start()
+    writer.close(timeout=5)
+    # one write, not split and nothing dropped
+    assert influx.attempts == 1
+    assert writer.rejected == 0 and writer.pending() == 3
@@ -0,0 +1,78 @@
+import os
+import pytest
+from deadband import DeadbandFilter, FieldFilter, load_filters
+
+FILTERS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "filters.json")
+
+
+def run(spec, values, step=10):
+    # the written value per sample, None when it is suppressed
+    field_filter = FieldFilter(spec)
+    state = [None, None, None]
+    return [field_filter(state, value, i * step) for i, value in enumerate(values)]
+
+
+def test_deadband():
+    assert run({"deadband": 0.5}, [20.0, 20.3, 20.49, 20.5, 20.1, 19.9]) == [20.0, None, None, 20.5, None, 19.9]
+
+
+def test_relative():
+    assert run({"relative": 0.1}, [100, 105, 111, 101, 99]) == [100, None, 111, None, 99]
+
+
+def test_relative_after_a_written_zero():
+    assert run({"relative": 0.1}, [0, 0, 0.5, 0.52]) == [0, None, 0.5, None]
+    assert run({"relative": 0.1, "deadband": 1}, [0, 0.5, 1.2]) == [0, None, 1.2]
+
+
+def test_heartbeat():
+    assert run({"deadband": 5, "heartbeat": 30}, [20, 20, 20, 20, 20], step=10) == [20, None, None, 20, None]
+
+
+def test_unchanged_values_without_a_threshold():
+    assert run({}, [1, 1, 2, 2]) == [1, None, 2, None]
+
+
+def test_ewma_smooths_a_spike():
+    written = run({"ewma": 0.25, "deadband": 1}, [20.0, 24.0, 20.0, 20.0])
+    # the spike of 4 moves the average 1, it passes; the average then falls back slowly
+    assert written == [20.0, 21.0, None, None]
+
+
+def test_an_integer_field_stays_an_integer():
+    written = run({"ewma": 0.5, "deadband": 1}, [400, 403, 410])
+    assert written == [400, 402, 406]
+    assert all(isinstance(value, int) for value in written)
+
+
+def test_ewma_must_be_a_weight():
+    with pytest.raises(ValueError):
+        FieldFilter({"ewma": 1.5})
+
+
+def test_devices_and_fields():
+    deadband = DeadbandFilter(
+        {
+            "operame": {"co2": {"deadband": 10}},
+            "esp*": {"*": {"deadband": 1}},
+        }
+    )
+    first = {"measurement": "esp", "time": 1_000_000_000, "fields": {"temperature": 20.0, "state": "on", "on": True}}
+    assert deadband("esp-hall", first) == first
+    # the other fields always pass, a point with only suppressed fields is dropped
+    second = {"measurement": "esp", "time": 2_000_000_000, "fields": {"temperature": 20.5, "state": "on", "on": True}}
+    assert deadband("esp-hall", second)["fields"] == {"state": "on", "on": True}
+    assert deadband("esp-hall", {"measurement": "esp", "time": 3_000_000_000, "fields": {"temperature": 20.5}}) is None
+    # devices and measurements keep their own state
+    assert deadband("esp-attic", {"measurement": "esp", "fields": {"temperature": 20.5}}) is not None
+    # a device without filters passes everything
+    point = {"measurement": "other", "fields": {"value": 1}}
+    assert deadband("other", point) is point
+    assert deadband("other", point) is point
+
+    assert deadband.stats() == {"passed": 6, "suppressed": 2, "dropped": 1, "devices": {"esp-hall": 2}}
+
+
+def test_the_example_filters_load():
+    deadband = DeadbandFilter(load_filters(FILTERS))
+    assert deadband.exact or deadband.prefixes or deadband.default
@@ -0,0 +1 @@
+../mqtt/workers.py
\ No newline at end of file
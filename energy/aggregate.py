@@ -0,0 +1,102 @@
+# Aggregation of per-second telegrams into N-second windows
+#
+# For the instantaneous power, voltage and current fields a window keeps the
+# min, max and mean, written as `<field>_min`, `<field>_max` and `<field>_mean`.
+# Of all other fields, like the cumulative meter readings, the last value is
+# kept under its own name.
+#
+# Windows follow the time of the telegrams, an aggregate gets the start of its
+# window as time.
+from pipeline import Reading
+
+AGGREGATED_FIELDS = {
+    "electricity_delivered",
+    "electricity_received",
+    "instantaneous_voltage_l1",
+    "instantaneous_voltage_l2",
+    "instantaneous_voltage_l3",
+    "instantaneous_current_l1",
+    "instantaneous_current_l2",
+    "instantaneous_current_l3",
+    "instantaneous_active_positive_power1",
+    "instantaneous_active_positive_power2",
+    "instantaneous_active_positive_power3",
+    "instantaneous_active_negative_power1",
+    "instantaneous_active_negative_power2",
+    "instantaneous_active_negative_power3",
+}
+
+
+class Window:
+
+    def __init__(self):
+        self.start = None
+        self.samples = 0
+        self.stats = {}
+        self.last = {}
+
+    def add(self, fields):
+        self.samples += 1
+        for field, value in fields.items():
+            if field in AGGREGATED_FIELDS and isinstance(value, (int, float)):
+                stats = self.stats.get(field)
+                if stats is None:
+                    self.stats[field] = [value, value, value, 1]
+                else:
+                    stats[0] = min(stats[0], value)
+                    stats[1] = max(stats[1], value)
+                    stats[2] += value
+                    stats[3] += 1
+            else:
+                self.last[field] = value
+
+    def close(self, meter):
+        if not self.samples:
+            return None
+
+        point = dict(self.last)
+        for field, (low, high, total, count) in self.stats.items():
+            point[f"{field}_min"] = low
+            point[f"{field}_max"] = high
+            point[f"{field}_mean"] = round(total / count, 3)
+        point["samples"] = self.samples
+
+        self.samples = 0
+        self.stats = {}
+        self.last = {}
+        return Reading(meter, point, self.start)
+
+
+class WindowAggregator:
+    """
+    Pipeline stage that collects the readings of every meter and returns the
+    aggregate of a window once the first reading of the next window arrives.
+    Windows are aligned to multiples of `window` seconds.
+    """
+
+    def __init__(self, window):
+        self.window = window * 1_000_000_000
+        self.windows = {}
+
+    def __call__(self, reading):
+        start = reading.time - reading.time % self.window
+
+        window = self.windows.get(reading.meter)
+        if window is None:
+            window = self.windows[reading.meter] = Window()
+
+        aggregate = None
+        if start != window.start:
+            aggregate = window.close(reading.meter)
+            window.start = start
+
+        window.add(reading.fields)
+        return aggregate
+
+    def flush(self):
+        readings = []
+        for meter, window in self.windows.items():
+            aggregate = window.close(meter)
+            if aggregate is not None:
+                readings.append(aggregate)
+        return readings
@@ -0,0 +1,238 @@
+# Archive of the raw P1 telegrams
+#
+# Every telegram is appended to a daily segment per meter,
+# `<directory>/<meter>/<YYYY-MM-DD>.p1.gz`, with the day in UTC. A record is the
+# time the telegram was received, in nanoseconds since epoch, on a line
+# starting with `@`, followed by the telegram as it was read:
+#
+#   @1544469052000000000
+#   /KFM5KAIFA-METER
+#   ...
+#   !653C
+#
+# Records are compressed in blocks, every block is a gzip member of its own.
+# The index next to the segment, `<YYYY-MM-DD>.p1.idx`, has a line with the
+# time of the first record and the offset of every block, so reading a time
+# range only decompresses the blocks in that range.
+import os
+import re
+import gzip
+import zlib
+import logging
+import threading
+import time
+from bisect import bisect_right
+from datetime import datetime, timezone
+
+log = logging.getLogger("root")
+
+RECORD = re.compile(rb"^@(\d+)\n", re.MULTILINE)
+
+
+DAY_NS = 86400 * 1_000_000_000
+
+
+def day_of(time_ns):
+    return datetime.fromtimestamp(time_ns // 1_000_000_000, timezone.utc).strftime("%Y-%m-%d")
+
+
+class Segment:
+
+    def __init__(self, directory, day, block_size):
+        self.day = day
+        self.block_size = block_size
+        self.block = []
+        self.first = None
+
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{day}.p1.gz")
+        self.data = open(self.path, "ab")
+        self.index = open(os.path.join(directory, f"{day}.p1.idx"), "a", encoding="utf-8")
+
+    def append(self, time_ns, telegram):
+        if self.first is None:
+            self.first = time_ns
+        self.block.append(b"@%d\n%s" % (time_ns, telegram.encode("ascii")))
+        if len(self.block) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if not self.block:
+            return
+
+        offset = self.data.tell()
+        self.data.write(gzip.compress(b"".join(self.block)))
+        self.data.flush()
+        self.index.write(f"{self.first} {offset}\n")
+        self.index.flush()
+        self.block = []
+        self.first = None
+
+    def close(self):
+        self.flush()
+        self.data.close()
+        self.index.close()
+
+
+class TelegramArchive:
+    """
+    Appends the telegrams of all meters to their daily segments. A block is
+    written once it has `block_size` telegrams, so at most that many telegrams
+    per meter are lost when the service is killed.
+
+    The archive never fails the reader: after an error the telegrams are
+    dropped for `retry_delay` seconds before a new segment is tried. With
+    `retention_days` the segments older than that are removed when a meter
+    starts a new day.
+    """
+
+    def __init__(self, directory, block_size=60, retention_days=0, retry_delay=60):
+        self.directory = directory
+        self.block_size = block_size
+        self.retention_days = retention_days
+        self.retry_delay = retry_delay
+        self.segments = {}
+        self.suspended_until = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def append(self, meter, time_ns, telegram):
+        with self.lock:
+            if time.monotonic() < self.suspended_until:
+                self.dropped += 1
+                return
+            if self.dropped:
+                log.warning("archive resumed, dropped %d telegrams", self.dropped)
+                self.dropped = 0
+
+            try:
+                self._append(meter, time_ns, telegram)
+            except Exception as e:  # pylint: disable=broad-except
+                log.error(
+                    "failed to archive telegram of meter '%s', retry in %ds", meter, self.retry_delay, exc_info=e
+                )
+                self._discard(meter)
+                self.suspended_until = time.monotonic() + self.retry_delay
+
+    def _append(self, meter, time_ns, telegram):
+        day = day_of(time_ns)
+        segment = self.segments.get(meter)
+        if segment is None or segment.day != day:
+            if segment is not None:
+                del self.segments[meter]
+                segment.close()
+            meter_dir = os.path.join(self.directory, meter)
+            if self.retention_days > 0:
+                expire(meter_dir, day_of(time_ns - self.retention_days * DAY_NS))
+            segment = Segment(meter_dir, day, self.block_size)
+            self.segments[meter] = segment
+        segment.append(time_ns, telegram)
+
+    def _discard(self, meter):
+        # a segment that failed is reopened after the retry delay
+        segment = self.segments.pop(meter, None)
+        if segment is None:
+            return
+        try:
+            segment.close()
+        except Exception:  # pylint: disable=broad-except
+            pass
+
+    def close(self):
+        with self.lock:
+            for meter, segment in self.segments.items():
+                try:
+                    segment.close()
+                except Exception as e:  # pylint: disable=broad-except
+                    log.error("failed to close the archive of meter '%s'", meter, exc_info=e)
+            self.segments = {}
+
+
+def expire(meter_dir, first_day):
+    # remove the segments and indexes of the days before `first_day`
+    if not os.path.isdir(meter_dir):
+        return
+    for name in os.listdir(meter_dir):
+        day, _, extension = name.partition(".")
+        if extension in ("p1.gz", "p1.idx") and day < first_day:
+            log.info("remove expired archive %s", os.path.join(meter_dir, name))
+            os.remove(os.path.join(meter_dir, name))
+
+
+def segments(directory, meter, first_day, last_day):
+    # the segment files of a meter from first to last day, both inclusive
+    meter_dir = os.path.join(directory, meter)
+    if not os.path.isdir(meter_dir):
+        return []
+    return sorted(
+        os.path.join(meter_dir, name)
+        for name in os.listdir(meter_dir)
+        if name.endswith(".p1.gz") and first_day <= name[: -len(".p1.gz")] <= last_day
+    )
+
+
+def read_segment(path, start=None, end=None):
+    """
+    Yields `(time_ns, telegram)` of every record in the segment that was
+    received from `start` up to, not including, `end`.
+    """
+    blocks = []
+    index = path[: -len(".gz")] + ".idx"
+    if os.path.exists(index):
+        with open(index, encoding="utf-8") as f:
+            blocks = [tuple(map(int, line.split())) for line in f if line.strip()]
+
+    offset = 0
+    if start is not None and blocks:
+        # the last block that starts before `start` can still hold records in range
+        i = bisect_right([first for first, _ in blocks], start) - 1
+        if i > 0:
+            offset = blocks[i][1]
+
+    for content in _blocks(path, offset, [o for _, o in blocks]):
+        records = RECORD.split(content)
+        # split gives [before, time, telegram, time, telegram, ...]
+        for i in range(1, len(records) - 1, 2):
+            time_ns = int(records[i])
+            if start is not None and time_ns < start:
+                continue
+            if end is not None and time_ns >= end:
+                return
+            yield time_ns, records[i + 1].decode("ascii")
+
+
+def _blocks(path, offset, offsets, chunk_size=64 * 1024):
+    # decompressed content of every block from `offset`, read in chunks to keep memory flat
+    with open(path, "rb") as f:
+        f.seek(offset)
+        position = offset
+        pending = f.read(chunk_size)
+        while pending:
+            block = zlib.decompressobj(wbits=31)
+            begin = position
+            content = []
+            try:
+                while pending and not block.eof:
+                    content.append(block.decompress(pending))
+                    position += len(pending)
+                    pending = f.read(chunk_size) if not block.eof else b""
+            except zlib.error:
+                pass
+
+            if block.eof:
+                pending = block.unused_data
+                position -= len(pending)
+                yield b"".join(content)
+                if not pending:
+                    pending = f.read(chunk_size)
+                continue
+
+            # a block that was being written when the service died, continue
+            # with the next block that made it into the index
+            log.warning("skip broken block at offset %d of segment %s", begin, path)
+            following = [o for o in offsets if o > begin]
+            if not following:
+                return
+            position = following[0]
+            f.seek(position)
+            pending = f.read(chunk_size)
@@ -0,0 +1,106 @@
+# Benchmark of the DSMR telegram parser
+#
+# Compares `dsmr.parse` with the original regex based parser on recorded
+# telegrams and prints the cost per telegram.
+#
+# usage: python benchmark.py [telegram files...] [-n iterations]
+import os
+import re
+import argparse
+import timeit
+import dsmr
+
+SAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "samples")
+
+# the parser as it was before `dsmr.parse`, kept as reference
+legacy_obis_table = {
+    r"1-3:0.2.8\((\d+)\)": "version_info",
+    r"0-0:1.0.0\((.*?)\)S": "timestamp",
+    r"1-0:1.8.1\((.*?)\*kWh\)": "meter_t1",
+    r"1-0:1.8.2\((.*?)\*kWh\)": "meter_t2",
+    r"1-0:2.8.1\((.*?)\*kWh\)": "meter_back_t1",
+    r"1-0:2.8.2\((.*?)\*kWh\)": "meter_back_t2",
+    r"0-0:96.14.0\((\d+)\)": "tariff_indicator",
+    r"1-0:1.7.0\((.*?)\*kW\)": "electricity_delivered",
+    r"1-0:2.7.0\((.*?)\*kW\)": "electricity_received",
+    r"0-0:96.7.21\((\d+)\)": "power_failures",
+    r"0-0:96.7.9\((\d+)\)": "long_power_failures",
+    r"1-0:32.32.0\((\d+)\)": "number_voltage_sags1",
+    r"1-0:52.32.0\((\d+)\)": "number_voltage_sags2",
+    r"1-0:72.32.0\((\d+)\)": "number_voltage_sags3",
+    r"1-0:32.36.0\((\d+)\)": "number_voltage_swells1",
+    r"1-0:52.36.0\((\d+)\)": "number_voltage_swells2",
+    r"1-0:72.36.0\((\d+)\)": "number_voltage_swells3",
+    r"1-0:32.7.0\(([\d\.]+)\*V\)": "instantaneous_voltage_l1",
+    r"1-0:52.7.0\(([\d\.]+)\*V\)": "instantaneous_voltage_l2",
+    r"1-0:72.7.0\(([\d\.]+)\*V\)": "instantaneous_voltage_l3",
+    r"1-0:31.7.0\((\d+)\*A\)": "instantaneous_current_l1",
+    r"1-0:51.7.0\((\d+)\*A\)": "instantaneous_current_l2",
+    r"1-0:71.7.0\((\d+)\*A\)": "instantaneous_current_l3",
+    r"1-0:21.7.0\((.*?)\*kW\)": "instantaneous_active_positive_power1",
+    r"1-0:41.7.0\((.*?)\*kW\)": "instantaneous_active_positive_power2",
+    r"1-0:61.7.0\((.*?)\*kW\)": "instantaneous_active_positive_power3",
+    r"1-0:22.7.0\((.*?)\*kW\)": "instantaneous_active_negative_power1",
+    r"1-0:42.7.0\((.*?)\*kW\)": "instantaneous_active_negative_power2",
+    r"1-0:62.7.0\((.*?)\*kW\)": "instantaneous_active_negative_power3",
+    r"0-1:24.1.0\((\d+)\)": "gas_device_type",
+    r"0-1:24.2.1\(.*?\)\((.*?)\*m3\)": "gas_meter",
+}
+
+
+def legacy_parse(data):
+    results = {}
+    for line in data:
+        for regex, key in legacy_obis_table.items():
+            match = re.match(regex, line)
+            if match:
+                value = match.group(1)
+
+                if re.fullmatch(r"\d+", value):
+                    value = int(value)
+                elif re.fullmatch(r"\d+\.\d+", value):
+                    value = float(value)
+
+                results[key] = value
+                break
+    return results
+
+
+def read_telegram(path):
+    with open(path, "rb") as f:
+        telegrams = dsmr.TelegramFramer().feed(f.read())
+    if not telegrams:
+        raise SystemExit(f"{path}: no valid telegram found")
+    return dsmr.lines(telegrams[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the DSMR telegram parser")
+    parser.add_argument("files", nargs="*", help="recorded telegrams (default: samples/*)")
+    parser.add_argument("-n", "--iterations", type=int, default=10000)
+    args = parser.parse_args()
+
+    files = args.files or sorted(
+        os.path.join(SAMPLES, name) for name in os.listdir(SAMPLES)
+    )
+    for path in files:
+        lines = read_telegram(path)
+        # the regex parser never matched the timestamp and ignored the gas capture time
+        results = dsmr.parse(lines)
+        results.pop("timestamp", None)
+        results.pop("gas_timestamp", None)
+        if results != legacy_parse(lines):
+            raise SystemExit(f"{path}: parsers disagree")
+
+        legacy = timeit.timeit(lambda: legacy_parse(lines), number=args.iterations)
+        current = timeit.timeit(lambda: dsmr.parse(lines), number=args.iterations)
+        print(
+            f"{os.path.basename(path)}: {len(lines)} lines, "
+            f"regex {legacy / args.iterations * 1e6:.1f} us/telegram, "
+            f"dsmr {current / args.iterations * 1e6:.1f} us/telegram "
+            f"({legacy / current:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+# DSMR P1 telegram framing and parsing
+#
+# `TelegramFramer` cuts the raw byte stream of the P1 port into telegrams, from
+# the `/` header up to the `!CRC` trailer, and validates the CRC16.
+#
+# Every line of a telegram is split once on its OBIS code, which is looked up in
+# `obis_table` to find the field name, how to cut the value out of the rest of
+# the line and how to convert it.
+#
+# The date-time stamp of the telegram and the capture time of the gas reading
+# are converted to seconds since epoch.
+import os
+import logging
+from datetime import datetime, timedelta, timezone
+
+log = logging.getLogger("root")
+
+# largest telegram we expect, anything bigger is garbage without a trailer
+MAX_TELEGRAM_SIZE = 8192
+
+# UTC offset in hours of the winter time (W) the meter reports, summer time (S) is an hour later
+utc_offset = int(os.getenv("ENERGY_METER_UTC_OFFSET", "1"))
+WINTER = timezone(timedelta(hours=utc_offset))
+SUMMER = timezone(timedelta(hours=utc_offset + 1))
+
+
+def _crc16_table():
+    # CRC-16/ARC as used by DSMR 4+: polynomial 0x8005 reflected, initial value 0
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_crc16 = _crc16_table()
+
+
+def crc16(data):
+    crc = 0
+    for byte in data:
+        crc = (crc >> 8) ^ _crc16[(crc ^ byte) & 0xFF]
+    return crc
+
+
+class TelegramFramer:
+    """
+    Collects bytes read from the P1 port and returns every complete telegram as
+    soon as its trailer arrives. Frames with a bad CRC or that can't be decoded
+    are counted and skipped. Meters older than DSMR 4 send no CRC, their
+    telegrams are passed on without validation.
+    """
+
+    def __init__(self, max_size=MAX_TELEGRAM_SIZE):
+        self.max_size = max_size
+        self.buffer = bytearray()
+        self.telegrams = 0
+        self.crc_errors = 0
+        self.decode_errors = 0
+        self.discarded_bytes = 0
+
+    def feed(self, data):
+        self.buffer += data
+        telegrams = []
+        while True:
+            start = self.buffer.find(b"/")
+            if start < 0:
+                self._discard(len(self.buffer))
+                break
+            if start > 0:
+                self._discard(start)
+
+            end = self.buffer.find(b"!")
+            if end < 0:
+                if len(self.buffer) > self.max_size:
+                    # no trailer, look for the next header
+                    self._discard(1)
+                    continue
+                break
+
+            restart = self.buffer.rfind(b"/", 1, end)
+            if restart > 0:
+                # truncated telegram followed by a new one
+                log.warning("discard telegram without trailer")
+                self._discard(restart)
+                continue
+
+            eol = self.buffer.find(b"\n", end)
+            if eol < 0:
+                break
+
+            telegram = self._validate(end, eol)
+            del self.buffer[: eol + 1]
+            if telegram is not None:
+                self.telegrams += 1
+                telegrams.append(telegram)
+        return telegrams
+
+    def _validate(self, end, eol):
+        checksum = self.buffer[end + 1 : eol].decode("ascii", "replace").strip()
+        if checksum:
+            expected = crc16(self.buffer[: end + 1])
+            try:
+                valid = int(checksum, 16) == expected
+            except ValueError:
+                valid = False
+            if not valid:
+                self.crc_errors += 1
+                log.warning(
+                    "discard telegram with CRC %s, expected %04X (%d bad telegrams)",
+                    checksum,
+                    expected,
+                    self.crc_errors,
+                )
+                return None
+
+        try:
+            return self.buffer[: eol + 1].decode("ascii")
+        except UnicodeDecodeError as e:
+            self.decode_errors += 1
+            log.warning("discard telegram that can't be decoded: %s", e)
+            return None
+
+    def _discard(self, size):
+        self.discarded_bytes += size
+        del self.buffer[:size]
+
+
+def lines(telegram):
+    # the data lines of a telegram, without header and empty lines
+    return [line.strip() for line in telegram.splitlines()[1:] if line.strip()]
+
+
+def _until(marker):
+    # value runs from the opening parenthesis up to the first `marker`
+    def extract(rest):
+        end = rest.find(marker)
+        return rest[:end] if end >= 0 else None
+
+    return extract
+
+
+def _after_capture(marker):
+    # skip the first `(...)` group, e.g. the capture time of the gas reading
+    def extract(rest):
+        start = rest.find(")(")
+        if start < 0:
+            return None
+        end = rest.find(marker, start + 2)
+        return rest[start + 2 : end] if end >= 0 else None
+
+    return extract
+
+
+def _number(value):
+    # int for `\d+`, float for `\d+\.\d+`, anything else is kept as text
+    if value.isdecimal():
+        return int(value)
+    head, dot, tail = value.partition(".")
+    if dot and head.isdecimal() and tail.isdecimal():
+        return float(value)
+    return value
+
+
+def _timestamp(value):
+    # YYMMDDhhmmssX, local time where X is S for summer and W for winter time
+    if len(value) != 13 or not value[:12].isdecimal() or value[12] not in "SW":
+        return None
+    try:
+        dt = datetime(
+            2000 + int(value[0:2]),
+            int(value[2:4]),
+            int(value[4:6]),
+            int(value[6:8]),
+            int(value[8:10]),
+            int(value[10:12]),
+            tzinfo=SUMMER if value[12] == "S" else WINTER,
+        )
+    except ValueError:
+        return None
+    return int(dt.timestamp())
+
+
+def _digits(value):
+    return int(value) if value.isdecimal() else None
+
+
+def _decimal(value):
+    if value and not value.strip("0123456789."):
+        return _number(value)
+    return None
+
+
+# OBIS code -> (field, value extractor, type)
+obis_table = {
+    "1-3:0.2.8": ("version_info", _until(")"), _digits),  # Version information for P1 output
+    "0-0:1.0.0": ("timestamp", _until(")"), _timestamp),  # Date-time stamp of the P1 message
+    # "0-0:96.1.1": ("equipment_identifier", _until(")"), _digits),  # Equipment identifier
+    "1-0:1.8.1": ("meter_t1", _until("*kWh)"), _number),  # Meter Reading electricity delivered to client (Tariff 1) in 0,001 kWh
+    "1-0:1.8.2": ("meter_t2", _until("*kWh)"), _number),  # Meter Reading electricity delivered to client (Tariff 2) in 0,001 kWh
+    "1-0:2.8.1": ("meter_back_t1", _until("*kWh)"), _number),  # Meter Reading electricity delivered by client (Tariff 1) in 0,001 kWh
+    "1-0:2.8.2": ("meter_back_t2", _until("*kWh)"), _number),  # Meter Reading electricity delivered by client (Tariff 2) in 0,001 kWh
+    "0-0:96.14.0": ("tariff_indicator", _until(")"), _digits),  # Tariff indicator electricity. The tariff indicator can also be used to switch tariff dependent loads e.g boilers. This is the responsibility of the P1 user
+    "1-0:1.7.0": ("electricity_delivered", _until("*kW)"), _number),  # Actual electricity power delivered (+P) in 1 Watt resolution
+    "1-0:2.7.0": ("electricity_received", _until("*kW)"), _number),  # Actual electricity power received (-P) in 1 Watt resolution
+    "0-0:96.7.21": ("power_failures", _until(")"), _digits),  # Number of power failures in any phase
+    "0-0:96.7.9": ("long_power_failures", _until(")"), _digits),  # Number of long power failures in any phase
+    # "1-0:99.97.0": ("failure_events", ...),  # Power Failure Event Log (long power failures)
+    "1-0:32.32.0": ("number_voltage_sags1", _until(")"), _digits),  # Number of voltage sags in phase L1
+    "1-0:52.32.0": ("number_voltage_sags2", _until(")"), _digits),  # Number of voltage sags in phase L2
+    "1-0:72.32.0": ("number_voltage_sags3", _until(")"), _digits),  # Number of voltage sags in phase L3
+    "1-0:32.36.0": ("number_voltage_swells1", _until(")"), _digits),  # Number of voltage swells in phase L1
+    "1-0:52.36.0": ("number_voltage_swells2", _until(")"), _digits),  # Number of voltage swells in phase L2
+    "1-0:72.36.0": ("number_voltage_swells3", _until(")"), _digits),  # Number of voltage swells in phase L3
+    # "0-0:96.13.0": ("text_message", _until(")"), str),  # Text message max 1024 characters.
+    "1-0:32.7.0": ("instantaneous_voltage_l1", _until("*V)"), _decimal),  # Instantaneous voltage L1 in V resolution
+    "1-0:52.7.0": ("instantaneous_voltage_l2", _until("*V)"), _decimal),  # Instantaneous voltage L2 in V resolution
+    "1-0:72.7.0": ("instantaneous_voltage_l3", _until("*V)"), _decimal),  # Instantaneous voltage L3 in V resolution
+    "1-0:31.7.0": ("instantaneous_current_l1", _until("*A)"), _digits),  # Instantaneous current L1 in A resolution.
+    "1-0:51.7.0": ("instantaneous_current_l2", _until("*A)"), _digits),  # Instantaneous current L2 in A resolution.
+    "1-0:71.7.0": ("instantaneous_current_l3", _until("*A)"), _digits),  # Instantaneous current L3 in A resolution.
+    "1-0:21.7.0": ("instantaneous_active_positive_power1", _until("*kW)"), _number),  # Instantaneous active power L1 (+P) in W resolution
+    "1-0:41.7.0": ("instantaneous_active_positive_power2", _until("*kW)"), _number),  # Instantaneous active power L2 (+P) in W resolution
+    "1-0:61.7.0": ("instantaneous_active_positive_power3", _until("*kW)"), _number),  # Instantaneous active power L3 (+P) in W resolution
+    "1-0:22.7.0": ("instantaneous_active_negative_power1", _until("*kW)"), _number),  # Instantaneous active power L1 (-P) in W resolution
+    "1-0:42.7.0": ("instantaneous_active_negative_power2", _until("*kW)"), _number),  # Instantaneous active power L2 (-P) in W resolution
+    "1-0:62.7.0": ("instantaneous_active_negative_power3", _until("*kW)"), _number),  # Instantaneous active power L3 (-P) in W resolution
+    "0-1:24.1.0": ("gas_device_type", _until(")"), _digits),  # Device type (gas)
+    # "0-1:96.1.0": ("gas_equipment_identifier", _until(")"), _digits),  # Equipment identifier (gas)
+    "0-1:24.2.1": ("gas_meter", _after_capture("*m3)"), _number),  # Last 5-minute Meter reading in 0,001 m3 and capture time
+}
+
+
+# OBIS code -> field of the capture time in the first `(...)` group
+capture_table = {
+    "0-1:24.2.1": "gas_timestamp",  # capture time of the gas meter reading
+}
+
+
+def parse(lines):
+    results = {}
+    for line in lines:
+        code, _, rest = line.partition("(")
+        entry = obis_table.get(code)
+        if entry is None:
+            continue
+
+        field, extract, convert = entry
+        value = extract(rest)
+        if value is None:
+            continue
+
+        value = convert(value)
+        if value is not None:
+            results[field] = value
+
+            capture = capture_table.get(code)
+            if capture is not None:
+                captured = _timestamp(rest[: rest.find(")")])
+                if captured is not None:
+                    results[capture] = captured
+    return results
@@ -2,16 +2,34 @@
 # 12-2018
 import os
 import time
+import signal
 import logging
-import re
 import json
-import serial
+import sqlite3
+from zoneinfo import ZoneInfo
 from logging.handlers import RotatingFileHandler
 from influxdb import InfluxDBClient
 from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
 import paho.mqtt.client as paho
+from pipeline import Pipeline, Reading
+from reader import MeterReader
+from aggregate import WindowAggregator
+from suppress import ChangeSuppressor
+from local_store import LocalStore
+from outbox import CircuitBreaker, Outbox, OutboxWriter
+from archive import TelegramArchive
+from fanout import TelegramFanout
+from rollup import Rollup
 
 
+#########################################################
+# P1 ports of the meters as `<meter id>=<port>`, comma separated
+meters = dict(
+    meter.strip().split("=", 1)
+    for meter in os.getenv("ENERGY_METERS", "main=/dev/ttyS0").split(",")
+    if meter.strip()
+)
+
 #########################################################
 # MQTT connection variables
 mqtt_broker = os.getenv("MQTT_BROKER", "localhost")
@@ -20,6 +38,12 @@ mqtt_user = os.getenv("MQTT_USERNAME", "")
 mqtt_pass = os.getenv("MQTT_PASSWORD", "")
 mqtt_topic = os.getenv("ENERGY_TOPIC", "sensor/power/p1meter")
 mqtt_timeout = int(os.getenv("MQTT_TIMEOUT", "120"))
+# fields: a retained message per field under ENERGY_TOPIC/<field> for every telegram
+# json: one compact JSON document per telegram on ENERGY_TOPIC
+# json+changed: the JSON document plus the per-field topics of the fields that changed
+# with more than one meter the topics become ENERGY_TOPIC/<meter id>[/<field>]
+mqtt_mode = os.getenv("ENERGY_MQTT_MODE", "fields")
+MQTT_MODES = ("fields", "json", "json+changed")
 
 #########################################################
 # Configure InfluxDB connection variables
@@ -29,10 +53,58 @@ influx_user = os.getenv("INFLUXDB_USER", "user")
 influx_password = os.getenv("INFLUXDB_PASSWORD", "")
 influx_energy_db = os.getenv("INFLUXDB_ENERGY_DATABASE", "energy")
 
+# influxdb, or sqlite to store the points in STORAGE_DIR/<database>.db with
+# local_store.py, the tables of days older than STORAGE_RETENTION_DAYS are dropped
+storage_backend = os.getenv("STORAGE_BACKEND", "influxdb")
+storage_dir = os.getenv("STORAGE_DIR", "data")
+storage_retention_days = int(os.getenv("STORAGE_RETENTION_DAYS", "0"))
+
 # think of measurement as a SQL table, it's not...but...
 measurement = os.getenv("INFLUXDB_ENERGY_MEASUREMENT", "meter")
 location = os.getenv("LOCATION", "house")
 
+# local outbox for points that can't be written while InfluxDB is down, like /var/lib/energy/outbox.db,
+# disabled when empty
+outbox_path = os.getenv("ENERGY_OUTBOX", "")
+outbox_max_points = int(os.getenv("ENERGY_OUTBOX_MAX_POINTS", "1000000"))
+outbox_batch_size = int(os.getenv("ENERGY_OUTBOX_BATCH_SIZE", "5000"))
+
+# archive of the raw telegrams in daily compressed segments, like /var/lib/energy/archive, disabled when empty
+archive_dir = os.getenv("ENERGY_ARCHIVE", "")
+# days of segments to keep, 0 keeps them all
+archive_retention_days = int(os.getenv("ENERGY_ARCHIVE_RETENTION_DAYS", "0"))
+
+# re-broadcast the raw telegrams as `<meter id>=unix:<path>` or `<meter id>=tcp:[<host>:]<port>`, comma separated
+fanouts = dict(
+    fanout.strip().split("=", 1)
+    for fanout in os.getenv("ENERGY_FANOUT", "").split(",")
+    if fanout.strip()
+)
+fanout_backlog = int(os.getenv("ENERGY_FANOUT_BACKLOG", "10"))
+
+# hourly, daily and monthly consumption rollups, checkpointed to ENERGY_ROLLUP_STATE, like
+# /var/lib/energy/rollup.json, disabled when empty
+rollup_state = os.getenv("ENERGY_ROLLUP_STATE", "")
+rollup_measurement = os.getenv("INFLUXDB_ENERGY_ROLLUP_MEASUREMENT", "meter_rollup")
+# seconds between updates of the running periods
+rollup_interval = int(os.getenv("ENERGY_ROLLUP_INTERVAL", "60"))
+# timezone of the days and months, like Europe/Amsterdam, the local time when empty
+rollup_timezone = os.getenv("ENERGY_ROLLUP_TIMEZONE", "")
+
+#########################################################
+# Queues between the serial reader and the MQTT/InfluxDB sinks
+queue_size = int(os.getenv("ENERGY_QUEUE_SIZE", "300"))
+queue_policy = os.getenv("ENERGY_QUEUE_POLICY", "drop-oldest")  # or coalesce
+sink_attempts = int(os.getenv("ENERGY_SINK_ATTEMPTS", "3"))
+sink_backoff = float(os.getenv("ENERGY_SINK_BACKOFF", "5"))
+stats_interval = int(os.getenv("ENERGY_STATS_INTERVAL", "300"))
+# aggregate telegrams into windows of N seconds before writing to InfluxDB, 0 writes every telegram
+aggregate_window = int(os.getenv("ENERGY_AGGREGATE_WINDOW", "0"))
+# only write fields that changed, unchanged values are written again every N seconds, 0 writes all fields
+suppress_heartbeat = int(os.getenv("ENERGY_SUPPRESS_HEARTBEAT", "0"))
+# comma separated fields to suppress, all fields when empty
+suppress_fields = {f.strip() for f in os.getenv("ENERGY_SUPPRESS_FIELDS", "").split(",") if f.strip()} or None
+
 # Configure logging
 log_dir = os.path.join(os.getenv("LOG_DIR", "/var/log"), "electricity-meter.log")
 log_handler = RotatingFileHandler(
@@ -50,52 +122,28 @@ log.addHandler(log_handler)
 log.addHandler(logging.StreamHandler())
 
 
-obis_table = {
-    r"1-3:0.2.8\((\d+)\)": "version_info",  # Version information for P1 output
-    r"0-0:1.0.0\((.*?)\)S": "timestamp",  # Date-time stamp of the P1 message
-    # r"0-0:96.1.1\((\d+)\)": "equipment_identifier",   # Equipment identifier
-    r"1-0:1.8.1\((.*?)\*kWh\)": "meter_t1",  # Meter Reading electricity delivered to client (Tariff 1) in 0,001 kWh
-    r"1-0:1.8.2\((.*?)\*kWh\)": "meter_t2",  # Meter Reading electricity delivered to client (Tariff 2) in 0,001 kWh
-    r"1-0:2.8.1\((.*?)\*kWh\)": "meter_back_t1",  # Meter Reading electricity delivered by client (Tariff 1) in 0,001 kWh
-    r"1-0:2.8.2\((.*?)\*kWh\)": "meter_back_t2",  # Meter Reading electricity delivered by client (Tariff 2) in 0,001 kWh
-    r"0-0:96.14.0\((\d+)\)": "tariff_indicator",  # Tariff indicator electricity. The tariff indicator can also be used to switch tariff dependent loads e.g boilers. This is the responsibility of the P1 user
-    r"1-0:1.7.0\((.*?)\*kW\)": "electricity_delivered",  # Actual electricity power delivered (+P) in 1 Watt resolution
-    r"1-0:2.7.0\((.*?)\*kW\)": "electricity_received",  # Actual electricity power received (-P) in 1 Watt resolution
-    r"0-0:96.7.21\((\d+)\)": "power_failures",  # Number of power failures in any phase
-    r"0-0:96.7.9\((\d+)\)": "long_power_failures",  # Number of long power failures in any phase
-    # r"1-0:99.97.0(.*?)": "failure_events",              # Power Failure Event Log (long power failures)
-    r"1-0:32.32.0\((\d+)\)": "number_voltage_sags1",  # Number of voltage sags in phase L1
-    r"1-0:52.32.0\((\d+)\)": "number_voltage_sags2",  # Number of voltage sags in phase L2
-    r"1-0:72.32.0\((\d+)\)": "number_voltage_sags3",  # Number of voltage sags in phase L3
-    r"1-0:32.36.0\((\d+)\)": "number_voltage_swells1",  # Number of voltage swells in phase L1
-    r"1-0:52.36.0\((\d+)\)": "number_voltage_swells2",  # Number of voltage swells in phase L2
-    r"1-0:72.36.0\((\d+)\)": "number_voltage_swells3",  # Number of voltage swells in phase L3
-    # r"0-0:96.13.0\((.*?)\)": "text_message",            # Text message max 1024 characters.
-    r"1-0:32.7.0\(([\d\.]+)\*V\)": "instantaneous_voltage_l1",  # Instantaneous voltage L1 in V resolution
-    r"1-0:52.7.0\(([\d\.]+)\*V\)": "instantaneous_voltage_l2",  # Instantaneous voltage L2 in V resolution
-    r"1-0:72.7.0\(([\d\.]+)\*V\)": "instantaneous_voltage_l3",  # Instantaneous voltage L3 in V resolution
-    r"1-0:31.7.0\((\d+)\*A\)": "instantaneous_current_l1",  # Instantaneous current L1 in A resolution.
-    r"1-0:51.7.0\((\d+)\*A\)": "instantaneous_current_l2",  # Instantaneous current L2 in A resolution.
-    r"1-0:71.7.0\((\d+)\*A\)": "instantaneous_current_l3",  # Instantaneous current L3 in A resolution.
-    r"1-0:21.7.0\((.*?)\*kW\)": "instantaneous_active_positive_power1",  # Instantaneous active power L1 (+P) in W resolution
-    r"1-0:41.7.0\((.*?)\*kW\)": "instantaneous_active_positive_power2",  # Instantaneous active power L2 (+P) in W resolution
-    r"1-0:61.7.0\((.*?)\*kW\)": "instantaneous_active_positive_power3",  # Instantaneous active power L3 (+P) in W resolution
-    r"1-0:22.7.0\((.*?)\*kW\)": "instantaneous_active_negative_power1",  # Instantaneous active power L1 (-P) in W resolution
-    r"1-0:42.7.0\((.*?)\*kW\)": "instantaneous_active_negative_power2",  # Instantaneous active power L2 (-P) in W resolution
-    r"1-0:62.7.0\((.*?)\*kW\)": "instantaneous_active_negative_power3",  # Instantaneous active power L3 (-P) in W resolution
-    r"0-1:24.1.0\((\d+)\)": "gas_device_type",  # Device type (gas)
-    # r"0-1:96.1.0\((\d+)\)": "gas_equipment_identifier",     # Equipment identifier (gas)
-    r"0-1:24.2.1\(.*?\)\((.*?)\*m3\)": "gas_meter",  # Last 5-minute Meter reading in 0,001 m3 and capture time
-}
-
-
 class EnergyMonitor:
 
     def __init__(self):
         self.init_influxdb()
         self.init_mqtt_client()
+        self.init_rollup()
+        self.init_pipeline()
+        self.archive = TelegramArchive(archive_dir, retention_days=archive_retention_days) if archive_dir else None
+        self.fanouts = {
+            meter: TelegramFanout(meter, address, fanout_backlog) for meter, address in fanouts.items()
+        }
 
     def init_influxdb(self):
+        self.writer = None
+        if storage_backend == "sqlite":
+            # a local file doesn't go down, the outbox isn't needed
+            self.influx_client = LocalStore(
+                os.path.join(storage_dir, f"{influx_energy_db}.db"), retention_days=storage_retention_days
+            )
+            self.retry_on = (sqlite3.OperationalError,)
+            return
+
         # Create the InfluxDB client object
         while True:
             try:
@@ -111,142 +159,247 @@ class EnergyMonitor:
                 log.exception("failed to connect to influx")
                 time.sleep(120)
 
+        # with the outbox the writer keeps the points until InfluxDB is back
+        self.retry_on = () if outbox_path else (InfluxDBClientError, InfluxDBServerError)
+        if outbox_path:
+            self.writer = OutboxWriter(
+                self.influx_client,
+                Outbox(outbox_path, outbox_max_points),
+                CircuitBreaker(),
+                outbox_batch_size,
+            )
+
     def init_mqtt_client(self):
+        if mqtt_mode not in MQTT_MODES:
+            raise ValueError(f"unknown ENERGY_MQTT_MODE '{mqtt_mode}', use one of {MQTT_MODES}")
+
         # Create the MQTT client object
         self.mqtt_client = paho.Client()
+        self.mqtt_client.on_connect = self.on_connect
         self.mqtt_client.on_disconnect = self.on_disconnect
+        self.mqtt_client.reconnect_delay_set(min_delay=1, max_delay=120)
+        self.published = {}
 
         if mqtt_user:
             self.mqtt_client.username_pw_set(mqtt_user, mqtt_pass)
 
-        self.mqtt_client.connect(mqtt_broker, mqtt_port, mqtt_timeout)
+        # connect and reconnect on the paho network thread, so a broker outage
+        # never blocks the reader or the sink workers
+        self.mqtt_client.connect_async(mqtt_broker, mqtt_port, mqtt_timeout)
+        self.mqtt_client.loop_start()
+
+    def init_rollup(self):
+        self.rollup = None
+        self.rollup_points = []
+        if rollup_state:
+            self.rollup = Rollup(
+                rollup_measurement,
+                {"location": location},
+                rollup_state,
+                rollup_interval,
+                ZoneInfo(rollup_timezone) if rollup_timezone else None,
+            )
+
+    def init_pipeline(self):
+        influx_stages = []
+        if aggregate_window > 0:
+            influx_stages.append(WindowAggregator(aggregate_window))
+        if suppress_heartbeat > 0:
+            influx_stages.append(ChangeSuppressor(suppress_heartbeat, suppress_fields))
+
+        self.pipeline = Pipeline(queue_size, queue_policy, stats_interval)
+        self.pipeline.add_sink(
+            "mqtt",
+            self.publish_datagram,
+            attempts=1,
+        )
+        self.pipeline.add_sink(
+            "influxdb",
+            self.store,
+            stages=influx_stages,
+            retry_on=self.retry_on,
+            attempts=1 if self.writer else sink_attempts,
+            backoff=sink_backoff,
+        )
+        if self.rollup is not None:
+            # the rollups only need the counters, a dropped telegram is counted by the next one
+            self.rollup_worker = self.pipeline.add_sink(
+                "rollup",
+                self.roll_up,
+                retry_on=self.retry_on,
+                attempts=1 if self.writer else sink_attempts,
+                backoff=sink_backoff,
+            )
+
+    def create_readers(self):
+        return [MeterReader(meter, port, self.datagram) for meter, port in meters.items()]
 
     def start(self):
-        ser = serial.Serial()
-        ser.baudrate = 115200
-        ser.bytesize = serial.EIGHTBITS
-        ser.parity = serial.PARITY_NONE
-        ser.stopbits = serial.STOPBITS_ONE
-        ser.xonxoff = 0
-        ser.rtscts = 0
-        ser.timeout = 20
-        ser.port = "/dev/ttyS0"
-
-        log.info("serial communication initialized for: %s", ser.portstr)
+        readers = self.create_readers()
 
+        self.pipeline.start()
+        for fanout in self.fanouts.values():
+            fanout.start()
+        for reader in readers:
+            reader.start()
         try:
-            ser.open()
-            lines = []
-            while True:
-                line = ser.readline()
-                if line.startswith(b"/KFM5KAIFA-METER"):  # Header information
-                    self.datagram(lines)
-                    lines = []
-                elif not line.startswith(b"\r\n"):
-                    lines.append(line.decode().strip())
-        except UnicodeDecodeError as e:
-            log.error("failed to decode line %r", line, exc_info=e)
+            for reader in readers:
+                reader.join()
         except KeyboardInterrupt:
             log.error("Serial reading manually stopped.")
-        except (serial.SerialException, OSError) as e:
-            log.error(
-                "Error while opening or reading the serial port %s.",
-                ser.name,
-                exc_info=e,
-            )
         finally:
-            ser.close()
-
-    def datagram(self, lines):
+            for reader in readers:
+                reader.stop()
+            for reader in readers:
+                reader.join()
+            for fanout in self.fanouts.values():
+                fanout.stop()
+            self.pipeline.stop()
+            if self.rollup is not None:
+                if self.rollup_worker.is_alive():
+                    # the worker still writes, the rollup isn't ours to touch
+                    log.error("rollup worker didn't stop, the open periods aren't written")
+                else:
+                    self.store_rollups(self.rollup.points())
+            self.mqtt_client.loop_stop()
+            if self.writer is not None:
+                self.writer.close()
+            if self.archive is not None:
+                self.archive.close()
+
+    def datagram(self, meter, telegram):
+        received = time.time_ns()
         iso = time.ctime()
         log.debug("===========================================================")
-        log.info("handle datagram: %s", iso)
-        log.debug("%s", lines)
+        log.info("handle datagram of meter '%s': %s", meter, iso)
+        log.debug("%s", telegram)
         log.debug("===========================================================")
 
-        results = self.parse_datagram(lines)
-        if not results:
+        if self.archive is not None:
+            self.archive.append(meter, received, telegram)
+        fanout = self.fanouts.get(meter)
+        if fanout is not None:
+            fanout.broadcast(telegram)
+
+        reading = self.parse(meter, telegram, received)
+        if not reading.fields:
             log.warning("no results found in datagram")
             return
 
-        # Publish to MQTT
-        for key, value in results.items():
-            self.publish(key, value)
+        # hand over to the MQTT and InfluxDB workers
+        self.pipeline.put(reading)
+
+    def parse(self, meter, telegram, received):
+        return Reading.parse(meter, telegram, received)
+
+    def publish_datagram(self, reading):
+        if not self.mqtt_client.is_connected():
+            log.debug("mqtt client not connected, skip publishing the datagram")
+            return
+
+        topic = mqtt_topic if len(meters) == 1 else f"{mqtt_topic}/{reading.meter}"
+        if mqtt_mode != "fields":
+            self.publish_message(topic, json.dumps(reading.fields, separators=(",", ":")))
+            if mqtt_mode == "json":
+                return
+
+        for key, value in reading.fields.items():
+            field_topic = f"{topic}/{key}"
+            if self.changed(key, field_topic, value):
+                self.publish(field_topic, value)
+
+    def changed(self, field, topic, value):
+        # the per-field topics are suppressed like the InfluxDB fields, json+changed always suppresses
+        suppress = suppress_heartbeat > 0 and (suppress_fields is None or field in suppress_fields)
+        if mqtt_mode == "fields" and not suppress:
+            return True
+
+        previous = self.published.get(topic)
+        if previous is None or previous[0] != value:
+            return True
+        return suppress and time.monotonic() - previous[1] >= suppress_heartbeat
+
+    def publish(self, topic, value):
+        if self.publish_message(topic, value):
+            self.published[topic] = (value, time.monotonic())
+
+    def store(self, reading):
+        # Create the JSON data structure
+        points = reading.points(measurement, {"location": location})
+        if not points:
+            return
+        log.debug("data = %s", json.dumps(points, indent=2))
+        self.write(points)
 
-        # Write to InfluxDB
-        attempts = 0
-        while attempts < 3:
+    def roll_up(self, reading):
+        self.store_rollups(self.rollup.add(reading))
+
+    def store_rollups(self, points):
+        # kept until written, so a retry of the sink doesn't lose closed periods
+        self.rollup_points.extend(points)
+        if not self.rollup_points:
+            return
+        try:
+            self.write(self.rollup_points)
+        except InfluxDBClientError as e:
+            if e.code != 400:
+                raise
+            self.write_each(self.rollup_points)
+        self.rollup_points = []
+        self.rollup.checkpoint()
+
+    def write_each(self, points):
+        # write the points one by one, so only the points InfluxDB rejects are dropped
+        for i, point in enumerate(points):
+            # the points that aren't written yet are kept for a retry
+            self.rollup_points = points[i:]
             try:
-                # Create the JSON data structure
-                data = [
-                    {
-                        "measurement": measurement,
-                        "tags": {
-                            "location": location,
-                        },
-                        "fields": results,
-                    }
-                ]
-
-                # Send the JSON data to InfluxDB
-                log.debug("data = %s", json.dumps(data, indent=2))
-                self.influx_client.write_points(data)
-                break
-            except (InfluxDBClientError, InfluxDBServerError) as e:
-                log.error(
-                    "InfluxDB client/server error writing to influxdb", exc_info=e
-                )
-                attempts += 1
-                time.sleep(5)
-            except (ValueError, TypeError, OSError) as e:
-                log.error("Unexpected error writing to influxdb", exc_info=e)
-                break
+                self.write([point])
+            except InfluxDBClientError as e:
+                if e.code != 400:
+                    raise
+                log.error("InfluxDB rejected rollup point %s, dropped", point, exc_info=e)
+
+    def write(self, points):
+        if self.writer is not None:
+            self.writer.write(points)
+            return
 
-    def parse_datagram(self, data):
-        results = {}
-        for line in data:
-            for regex, key in obis_table.items():
-                try:
-                    match = re.match(regex, line)
-                    if match:
-                        value = match.group(1)
-
-                        if re.fullmatch(r"\d+", value):
-                            value = int(value)
-                        elif re.fullmatch(r"\d+\.\d+", value):
-                            value = float(value)
-
-                        results[key] = value
-                        break  # move to next line after first match
-                except (re.error, IndexError) as e:
-                    log.error(
-                        "Failed to match regex '%s' on line: %s",
-                        regex,
-                        line,
-                        exc_info=e,
-                    )
-        return results
-
-    def publish(self, field, value):
         try:
-            if self.mqtt_client is None or not self.mqtt_client.is_connected():
-                self.init_mqtt_client()
+            # Send the JSON data to InfluxDB, client/server errors are retried by the worker
+            self.influx_client.write_points(points)
+        except (ValueError, TypeError, OSError) as e:
+            log.error("Unexpected error writing to influxdb", exc_info=e)
 
-            topic = f"{mqtt_topic}/{field}"
-            log.debug("publish `%s`: %s", topic, value)
-            result = self.mqtt_client.publish(topic, value, retain=True)
+    def publish_message(self, topic, payload):
+        try:
+            log.debug("publish `%s`: %s", topic, payload)
+            result = self.mqtt_client.publish(topic, payload, retain=True)
             if result.rc != paho.MQTT_ERR_SUCCESS:
                 log.error("failed to publish to topic %s: %s", topic, paho.error_string(result.rc))
+                return False
+            return True
 
         except (paho.WebsocketConnectionError, OSError, ValueError) as e:
             log.exception(e)
+            return False
+
+    def on_connect(self, _client, _userdata, _flags, rc, _properties=None):
+        log.info("mqtt client connected with result code: '%s'", paho.connack_string(rc))
+        # publish every field again after a reconnect
+        self.published = {}
 
-    def on_disconnect(self, _client, _userdata, _rc, _properties=None):
-        log.info("mqtt client disconnected ok")
+    def on_disconnect(self, _client, _userdata, rc, _properties=None):
+        if rc != 0:
+            log.error("unexpected mqtt disconnection, reconnecting: '%s'", paho.error_string(rc))
+        else:
+            log.info("mqtt client disconnected ok")
 
 
 if __name__ == "__main__":
     log.info("start reading the DSMR P1")
+    # stop on SIGTERM like on ctrl-c, so the queues and the outbox are flushed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
 
     monitor = EnergyMonitor()
     monitor.start()
@@ -0,0 +1,181 @@
+# Fan-out of the raw P1 telegrams of a meter
+#
+# Subscribers connect to a Unix domain socket or a TCP port, like ser2net, and
+# receive every valid telegram as it was read from the meter. Each subscriber
+# has a small queue of telegrams. When a subscriber can't keep up, its oldest
+# queued telegrams are dropped, so a slow subscriber never holds up the serial
+# reader. A telegram is always sent whole, never cut off half way.
+import os
+import socket
+import logging
+import selectors
+import threading
+from collections import deque
+
+log = logging.getLogger("root")
+
+
+def listen(address):
+    # `unix:<path>`, `tcp:<port>` on localhost or `tcp:<host>:<port>`
+    kind, _, target = address.partition(":")
+    if kind == "unix":
+        if os.path.exists(target):
+            os.remove(target)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(target)
+    elif kind == "tcp":
+        host, _, port = target.rpartition(":")
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host or "127.0.0.1", int(port)))
+    else:
+        raise ValueError(f"unknown fan-out address '{address}', use unix:<path> or tcp:[<host>:]<port>")
+    server.listen()
+    server.setblocking(False)
+    return server
+
+
+class Subscriber:
+
+    def __init__(self, sock, name, backlog):
+        self.sock = sock
+        self.name = name
+        self.queue = deque(maxlen=backlog)
+        self.current = None
+        self.sent = 0
+        self.dropped = 0
+
+
+class TelegramFanout(threading.Thread):
+
+    def __init__(self, meter, address, backlog=10):
+        super().__init__(name=f"fanout-{meter}", daemon=True)
+        self.meter = meter
+        self.address = address
+        self.backlog = backlog
+        self.server = listen(address)
+        self.selector = selectors.DefaultSelector()
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.waker.setblocking(False)
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def broadcast(self, telegram):
+        # called by the reader thread, never blocks
+        data = telegram.encode("ascii")
+        with self.lock:
+            if not self.subscribers:
+                return
+            for subscriber in self.subscribers.values():
+                if len(subscriber.queue) == subscriber.queue.maxlen:
+                    subscriber.dropped += 1
+                subscriber.queue.append(data)
+        self.wake()
+
+    def wake(self):
+        try:
+            self.waker.send(b"\0")
+        except (BlockingIOError, OSError):
+            # a wake up is already pending
+            pass
+
+    def run(self):
+        log.info("fan-out telegrams of meter '%s' on %s", self.meter, self.address)
+        self.selector.register(self.server, selectors.EVENT_READ)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        while not self.stopping.is_set():
+            for key, events in self.selector.select():
+                if key.fileobj is self.server:
+                    self.accept()
+                elif key.fileobj is self.wakeup:
+                    self.drain_wakeup()
+                else:
+                    subscriber = key.data
+                    if events & selectors.EVENT_READ:
+                        self.receive(subscriber)
+                    if events & selectors.EVENT_WRITE and subscriber.sock.fileno() >= 0:
+                        self.send(subscriber)
+            self.update_interest()
+
+        for subscriber in list(self.subscribers.values()):
+            self.close(subscriber)
+        self.selector.close()
+        self.server.close()
+
+    def accept(self):
+        try:
+            sock, peer = self.server.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        subscriber = Subscriber(sock, str(peer or sock.fileno()), self.backlog)
+        with self.lock:
+            self.subscribers[sock] = subscriber
+        self.selector.register(sock, selectors.EVENT_READ, subscriber)
+        log.info("subscriber %s connected to meter '%s'", subscriber.name, self.meter)
+
+    def drain_wakeup(self):
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def receive(self, subscriber):
+        # subscribers don't send anything, reading only detects them leaving
+        try:
+            if subscriber.sock.recv(4096):
+                return
+        except BlockingIOError:
+            return
+        except OSError:
+            pass
+        self.close(subscriber)
+
+    def send(self, subscriber):
+        while True:
+            if subscriber.current is None:
+                with self.lock:
+                    if not subscriber.queue:
+                        return
+                    subscriber.current = memoryview(subscriber.queue.popleft())
+            try:
+                sent = subscriber.sock.send(subscriber.current)
+            except BlockingIOError:
+                return
+            except OSError:
+                self.close(subscriber)
+                return
+            subscriber.current = subscriber.current[sent:]
+            if not subscriber.current:
+                subscriber.current = None
+                subscriber.sent += 1
+
+    def update_interest(self):
+        with self.lock:
+            subscribers = list(self.subscribers.values())
+        for subscriber in subscribers:
+            pending = subscriber.current is not None or bool(subscriber.queue)
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if pending else 0)
+            if self.selector.get_key(subscriber.sock).events != events:
+                self.selector.modify(subscriber.sock, events, subscriber)
+
+    def close(self, subscriber):
+        with self.lock:
+            if self.subscribers.pop(subscriber.sock, None) is None:
+                return
+        self.selector.unregister(subscriber.sock)
+        subscriber.sock.close()
+        log.info(
+            "subscriber %s of meter '%s' left after %d telegrams, %d dropped",
+            subscriber.name,
+            self.meter,
+            subscriber.sent,
+            subscriber.dropped,
+        )
+
+    def stop(self):
+        self.stopping.set()
+        self.wake()
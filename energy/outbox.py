@@ -0,0 +1,206 @@
+# Durable outbox for InfluxDB writes
+#
+# Points that can't be written because InfluxDB is down are appended to a local
+# SQLite database (WAL mode). Appends are committed, and synced to disk, in
+# batches. Once InfluxDB is back the backlog is written in large batches, in the
+# order the points were created, before any new point.
+import time
+import json
+import sqlite3
+import logging
+import threading
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+
+log = logging.getLogger("root")
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures. While open no writes are
+    attempted, after `reset_timeout` seconds a single write is let through to
+    probe whether the service is back.
+    """
+
+    def __init__(self, threshold=3, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+
+    @property
+    def is_open(self):
+        return self.opened is not None
+
+    def allow(self):
+        if self.opened is None:
+            return True
+        if time.monotonic() - self.opened >= self.reset_timeout:
+            # half open, let one attempt through
+            self.opened = time.monotonic()
+            return True
+        return False
+
+    def success(self):
+        if self.opened is not None:
+            log.info("circuit closed after %d failures", self.failures)
+        self.failures = 0
+        self.opened = None
+
+    def failure(self):
+        self.failures += 1
+        if self.opened is not None or self.failures >= self.threshold:
+            if self.opened is None:
+                log.warning("circuit opened after %d failures", self.failures)
+            self.opened = time.monotonic()
+
+
+class Outbox:
+
+    def __init__(self, path, max_points=1_000_000, sync_points=100, sync_interval=10):
+        self.max_points = max_points
+        self.sync_points = sync_points
+        self.sync_interval = sync_interval
+        self.pending = []
+        self.last_sync = time.monotonic()
+        self.dropped = 0
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, point TEXT NOT NULL)"
+        )
+        self.db.commit()
+        self.size = self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        if self.size:
+            log.info("outbox %s has %d points to write", path, self.size)
+
+    def __len__(self):
+        return self.size + len(self.pending)
+
+    def append(self, point):
+        self.pending.append(json.dumps(point, separators=(",", ":")))
+        if (
+            len(self.pending) >= self.sync_points
+            or time.monotonic() - self.last_sync >= self.sync_interval
+        ):
+            self.sync()
+
+    def sync(self):
+        self.last_sync = time.monotonic()
+        if not self.pending:
+            return
+
+        with self.db:
+            self.db.executemany("INSERT INTO outbox (point) VALUES (?)", ((p,) for p in self.pending))
+            self.size += len(self.pending)
+            self.pending = []
+
+            if self.size > self.max_points:
+                # retention cap, drop the oldest points
+                dropped = self.db.execute(
+                    "DELETE FROM outbox WHERE id IN (SELECT id FROM outbox ORDER BY id LIMIT ?)",
+                    (self.size - self.max_points,),
+                ).rowcount
+                self.size -= dropped
+                self.dropped += dropped
+                log.warning("outbox full, dropped %d oldest points (%d in total)", dropped, self.dropped)
+
+    def peek(self, limit):
+        self.sync()
+        rows = self.db.execute("SELECT id, point FROM outbox ORDER BY id LIMIT ?", (limit,))
+        return [(row_id, json.loads(point)) for row_id, point in rows]
+
+    def remove(self, last_id):
+        with self.db:
+            self.size -= self.db.execute("DELETE FROM outbox WHERE id <= ?", (last_id,)).rowcount
+
+    def close(self):
+        self.sync()
+        self.db.close()
+
+
+class OutboxWriter:
+    """
+    Writes points to InfluxDB, or to the outbox while the circuit breaker
+    reports InfluxDB as down or a backlog is waiting to be written. Several
+    sinks can share a writer, one write or drain runs at a time.
+    """
+
+    def __init__(self, influx_client, outbox, breaker, batch_size=5000):
+        self.influx_client = influx_client
+        self.outbox = outbox
+        self.breaker = breaker
+        self.batch_size = batch_size
+        # the outbox and the breaker aren't thread safe
+        self.lock = threading.RLock()
+
+    def write(self, points):
+        with self.lock:
+            if not len(self.outbox) and self.breaker.allow():
+                if self._write(points) is False:
+                    for point in points:
+                        self.outbox.append(point)
+                return
+
+            for point in points:
+                self.outbox.append(point)
+            self.drain()
+
+    def drain(self):
+        # one batch per call, so new telegrams keep flowing while a backlog is written
+        with self.lock:
+            self._drain()
+
+    def _drain(self):
+        if not len(self.outbox) or not self.breaker.allow():
+            return
+
+        batch = self.outbox.peek(self.batch_size)
+        if not batch:
+            return
+
+        written = self._write([point for _, point in batch])
+        if written is not False:
+            self.outbox.remove(batch[-1][0])
+            log.info(
+                "%s %d points from the outbox, %d left",
+                "wrote" if written else "dropped",
+                len(batch),
+                len(self.outbox),
+            )
+
+    def _write(self, points):
+        # True when (partly) written, False when InfluxDB is down, None when rejected
+        try:
+            self.influx_client.write_points(points)
+            self.breaker.success()
+            return True
+        except InfluxDBClientError as e:
+            if e.code == 400:
+                if len(points) > 1:
+                    # write the halves, so only the points InfluxDB rejects are dropped
+                    half = len(points) // 2
+                    first = self._write(points[:half])
+                    if first is False:
+                        return False
+                    second = self._write(points[half:])
+                    if second is False:
+                        # the points keep their time, writing the first half again overwrites it
+                        return False
+                    return True if first or second else None
+                # a bad point is never going to be written
+                log.error("InfluxDB rejected point %s, dropped", points[0], exc_info=e)
+                return None
+            log.error("InfluxDB client error writing to influxdb: %s", e)
+        except (ValueError, TypeError) as e:
+            log.error("Unexpected error writing to influxdb", exc_info=e)
+            return None
+        except (InfluxDBServerError, OSError) as e:
+            log.error("InfluxDB unavailable: %s", e)
+        self.breaker.failure()
+        return False
+
+    def close(self):
+        with self.lock:
+            self.outbox.close()
@@ -0,0 +1,250 @@
+# Telegram pipeline between the P1 reader and the sinks
+#
+# The serial reader only parses telegrams and puts them in a bounded queue per
+# sink. Every sink (MQTT, InfluxDB, ...) has its own worker thread that takes
+# telegrams from its queue and retries with backoff, so a slow sink never stops
+# the serial port from being drained.
+#
+# A sink can have stages that run on the reader thread before its queue, e.g. to
+# aggregate telegrams. A stage is called with a telegram and returns what to
+# pass on, or None to pass on nothing. A stage with a `flush()` is flushed when
+# the pipeline stops, it returns the telegrams it still holds.
+import time
+import logging
+import threading
+from collections import deque
+import dsmr
+
+log = logging.getLogger("root")
+
+# what to do with a new telegram when a queue is full
+DROP_OLDEST = "drop-oldest"  # drop the oldest queued telegram
+COALESCE = "coalesce"  # merge the new telegram into the newest queued one of the same meter
+POLICIES = (DROP_OLDEST, COALESCE)
+
+
+class Reading:
+    """
+    The parsed fields of a telegram, or an aggregate of telegrams, of one meter.
+    `time` is the time of the telegram in nanoseconds since epoch.
+    """
+
+    __slots__ = ("meter", "fields", "time")
+
+    def __init__(self, meter, fields, time):
+        self.meter = meter
+        self.fields = fields
+        self.time = time
+
+    def __repr__(self):
+        return f"Reading({self.meter!r}, {self.fields!r}, {self.time!r})"
+
+    @classmethod
+    def parse(cls, meter, telegram, received):
+        # the meter's own clock is the time of the reading, `received` when it has none
+        fields = dsmr.parse(dsmr.lines(telegram))
+        timestamp = fields.pop("timestamp", None)
+        return cls(meter, fields, timestamp * 1_000_000_000 if timestamp is not None else received)
+
+    def points(self, measurement, tags):
+        # InfluxDB points, the gas reading is written at the time the gas meter captured it
+        tags = {**tags, "meter": self.meter}
+        fields = dict(self.fields)
+
+        points = []
+        gas_meter = fields.pop("gas_meter", None)
+        gas_timestamp = fields.pop("gas_timestamp", None)
+        if gas_meter is not None:
+            if gas_timestamp is not None:
+                points.append(
+                    {
+                        "measurement": measurement,
+                        "tags": tags,
+                        "time": gas_timestamp * 1_000_000_000,
+                        "fields": {"gas_meter": gas_meter},
+                    }
+                )
+            else:
+                fields["gas_meter"] = gas_meter
+
+        if fields:
+            points.append(
+                {
+                    "measurement": measurement,
+                    "tags": tags,
+                    "time": self.time,
+                    "fields": fields,
+                }
+            )
+        return points
+
+
+class TelegramQueue:
+
+    def __init__(self, maxsize, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown queue policy '{policy}', use one of {POLICIES}")
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, telegram):
+        with self.condition:
+            if len(self.items) >= self.maxsize:
+                last = self.items[-1]
+                if self.policy == COALESCE and last.meter == telegram.meter:
+                    # a new object, the queued one is shared with the other sinks
+                    self.items[-1] = Reading(last.meter, {**last.fields, **telegram.fields}, telegram.time)
+                    self.coalesced += 1
+                    return
+                self.items.popleft()
+                self.dropped += 1
+            self.items.append(telegram)
+            self.condition.notify()
+
+    def get(self):
+        # blocks until a telegram is available, None once closed and drained
+        with self.condition:
+            while not self.items and not self.closed:
+                self.condition.wait()
+            return self.items.popleft() if self.items else None
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class SinkWorker(threading.Thread):
+    """
+    Hands every telegram of its queue to `handler`. When the handler raises one
+    of `retry_on` it is retried up to `attempts` times with an exponential
+    backoff, after that the telegram is counted as failed. Any other exception
+    fails the telegram right away.
+    """
+
+    def __init__(
+        self, name, handler, queue, stages=(), retry_on=(), attempts=3, backoff=5, max_backoff=60
+    ):
+        super().__init__(name=name, daemon=True)
+        self.handler = handler
+        self.queue = queue
+        self.stages = stages
+        self.retry_on = retry_on
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stopping = threading.Event()
+        self.delivered = 0
+        self.failed = 0
+
+    def run(self):
+        log.info("start sink worker '%s'", self.name)
+        while True:
+            telegram = self.queue.get()
+            if telegram is None:
+                break
+            self.deliver(telegram)
+        log.info("stopped sink worker '%s'", self.name)
+
+    def deliver(self, telegram):
+        delay = self.backoff
+        for attempt in range(1, self.attempts + 1):
+            try:
+                self.handler(telegram)
+                self.delivered += 1
+                return
+            except self.retry_on as e:
+                log.error(
+                    "sink '%s' failed, attempt %d of %d", self.name, attempt, self.attempts, exc_info=e
+                )
+            except Exception as e:  # pylint: disable=broad-except
+                # a bug in a handler must not stop the worker, its queue would fill up for good
+                log.error("sink '%s' failed unexpectedly, telegram dropped", self.name, exc_info=e)
+                break
+            if attempt < self.attempts and not self.stopping.is_set():
+                self.stopping.wait(delay)
+                delay = min(delay * 2, self.max_backoff)
+        self.failed += 1
+
+    def stop(self):
+        self.stopping.set()
+        self.queue.close()
+
+
+class Pipeline:
+
+    def __init__(self, maxsize, policy=DROP_OLDEST, stats_interval=300):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.stats_interval = stats_interval
+        self.last_stats = time.monotonic()
+        self.workers = []
+        # telegrams can come from several reader threads, the stages aren't thread safe
+        self.lock = threading.Lock()
+
+    def add_sink(self, name, handler, stages=(), **retry):
+        worker = SinkWorker(name, handler, TelegramQueue(self.maxsize, self.policy), stages, **retry)
+        self.workers.append(worker)
+        return worker
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def put(self, telegram):
+        with self.lock:
+            for worker in self.workers:
+                self.forward(worker, telegram, worker.stages)
+
+        if time.monotonic() - self.last_stats >= self.stats_interval:
+            self.last_stats = time.monotonic()
+            log.info("pipeline stats: %s", self.stats())
+
+    def forward(self, worker, telegram, stages):
+        for stage in stages:
+            telegram = stage(telegram)
+            if telegram is None:
+                return
+        worker.queue.put(telegram)
+
+    def flush(self):
+        with self.lock:
+            for worker in self.workers:
+                for i, stage in enumerate(worker.stages):
+                    if hasattr(stage, "flush"):
+                        for telegram in stage.flush():
+                            self.forward(worker, telegram, worker.stages[i + 1 :])
+
+    def stop(self, timeout=30):
+        self.flush()
+        # let the workers drain their queues, but don't wait forever on a dead sink
+        for worker in self.workers:
+            worker.stop()
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.join(max(0, deadline - time.monotonic()))
+        log.info("pipeline stats: %s", self.stats())
+
+    def stats(self):
+        stats = {}
+        for worker in self.workers:
+            stats[worker.name] = {
+                "depth": len(worker.queue),
+                "dropped": worker.queue.dropped,
+                "coalesced": worker.queue.coalesced,
+                "delivered": worker.delivered,
+                "failed": worker.failed,
+            }
+            for stage in worker.stages:
+                if hasattr(stage, "stats"):
+                    stats[worker.name].update(stage.stats())
+        return stats
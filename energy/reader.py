@@ -0,0 +1,80 @@
+# Reader thread for the P1 port of one meter
+import logging
+import threading
+import serial
+import dsmr
+
+log = logging.getLogger("root")
+
+
+class MeterReader(threading.Thread):
+    """
+    Reads the serial port of one meter and calls `handler(meter, telegram)` for
+    every valid telegram. When the port fails it is opened again after
+    `retry_delay` seconds, so one broken meter doesn't stop the others.
+    """
+
+    def __init__(self, meter, port, handler, retry_delay=30):
+        super().__init__(name=f"reader-{meter}", daemon=True)
+        self.meter = meter
+        self.port = port
+        self.handler = handler
+        self.retry_delay = retry_delay
+        self.stopping = threading.Event()
+        self.framer = dsmr.TelegramFramer()
+        self.ser = None
+
+    def open(self):
+        ser = serial.Serial()
+        ser.baudrate = 115200
+        ser.bytesize = serial.EIGHTBITS
+        ser.parity = serial.PARITY_NONE
+        ser.stopbits = serial.STOPBITS_ONE
+        ser.xonxoff = 0
+        ser.rtscts = 0
+        ser.timeout = 20
+        ser.port = self.port
+
+        log.info("serial communication initialized for meter '%s': %s", self.meter, ser.portstr)
+        ser.open()
+        return ser
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                self.ser = self.open()
+                self.read()
+            except (serial.SerialException, OSError) as e:
+                log.error(
+                    "Error while opening or reading the serial port %s of meter '%s'.",
+                    self.port,
+                    self.meter,
+                    exc_info=e,
+                )
+                self.stopping.wait(self.retry_delay)
+            finally:
+                if self.ser is not None:
+                    self.ser.close()
+        self.log_stats()
+
+    def read(self):
+        ser = self.ser
+        while not self.stopping.is_set():
+            data = ser.read(ser.in_waiting or 1)
+            for telegram in self.framer.feed(data):
+                self.handler(self.meter, telegram)
+
+    def stop(self):
+        self.stopping.set()
+        if self.ser is not None and self.ser.is_open and hasattr(self.ser, "cancel_read"):
+            self.ser.cancel_read()
+
+    def log_stats(self):
+        log.info(
+            "meter '%s': read %d telegrams, %d with bad CRC, %d undecodable, %d bytes discarded",
+            self.meter,
+            self.framer.telegrams,
+            self.framer.crc_errors,
+            self.framer.decode_errors,
+            self.framer.discarded_bytes,
+        )
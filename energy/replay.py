@@ -0,0 +1,319 @@
+# Replay recorded P1 telegrams through the energy service
+#
+# Feeds telegram files, like samples/kfm5kaifa.txt or archived segments
+# (*.p1.gz), into EnergyMonitor without a meter. The telegrams go through a
+# pseudo terminal and the real serial port code, or through a file backed
+# stand-in for the serial port. MQTT and InfluxDB are replaced by local
+# stand-ins that only count what they get.
+#
+# By default the telegrams are replayed as fast as possible, with --realtime
+# they are paced like they were recorded. --benchmark reports telegrams/s, the
+# parse time per telegram, the latency from feeding a telegram to the sinks and
+# the peak RSS.
+#
+# usage: python replay.py samples/kfm5kaifa.txt [--repeat 10000] [--realtime] [--via file] [--benchmark]
+import os
+import tempfile
+
+# the service reads its configuration on import, by default a replay doesn't
+# archive, fan-out, keep an outbox or roll up
+os.environ.setdefault("LOG_DIR", tempfile.gettempdir())
+os.environ.setdefault("ENERGY_ARCHIVE", "")
+os.environ.setdefault("ENERGY_OUTBOX", "")
+os.environ.setdefault("ENERGY_FANOUT", "")
+os.environ.setdefault("ENERGY_ROLLUP_STATE", "")
+
+import pty
+import time
+import argparse
+import logging
+import resource
+import threading
+from collections import deque
+import paho.mqtt.client as paho
+import archive
+import dsmr
+import electricity_meter
+from reader import MeterReader
+
+log = logging.getLogger("root")
+
+
+def load(paths):
+    # `(time_ns, telegram)` of every telegram in the files, time is None for plain text files
+    telegrams = []
+    for path in paths:
+        if path.endswith(".p1.gz"):
+            telegrams.extend((t, telegram.encode("ascii")) for t, telegram in archive.read_segment(path))
+            continue
+        framer = dsmr.TelegramFramer()
+        with open(path, "rb") as f:
+            telegrams.extend((None, telegram.encode("ascii")) for telegram in framer.feed(f.read()))
+    return telegrams
+
+
+class Feed:
+    """
+    The telegrams to replay, `repeat` times. With `realtime` a telegram is due
+    after the time between the two telegrams when they were recorded, or after
+    `interval` seconds when that isn't known.
+    """
+
+    def __init__(self, telegrams, repeat=1, realtime=False, interval=1.0):
+        self.telegrams = telegrams
+        self.repeat = repeat
+        self.realtime = realtime
+        self.interval = interval
+        self.fed = deque()
+        self.count = 0
+        self.first = None
+        self.done = threading.Event()
+
+    def __iter__(self):
+        due = time.monotonic()
+        previous = None
+        for _ in range(self.repeat):
+            for recorded, data in self.telegrams:
+                if self.realtime:
+                    gap = self.interval
+                    if recorded is not None and previous is not None and recorded > previous:
+                        gap = (recorded - previous) / 1e9
+                    due += gap
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    previous = recorded
+                yield data
+
+    def sent(self):
+        now = time.perf_counter()
+        if self.first is None:
+            self.first = now
+        self.fed.append(now)
+        self.count += 1
+
+
+class FileSerial:
+    # stand-in for serial.Serial that reads the telegrams of the feed
+
+    def __init__(self, feed):
+        self.feed = feed
+        self.telegrams = iter(feed)
+        self.is_open = True
+        self.in_waiting = 0
+
+    def read(self, size=1):
+        data = next(self.telegrams, None)
+        if data is None:
+            self.feed.done.set()
+            return b""
+        self.feed.sent()
+        return data
+
+    def close(self):
+        self.is_open = False
+
+
+def feed_pty(feed, master, reader):
+    # write the telegrams to the pty once the reader has opened the other end
+    reader.ready.wait()
+    for data in feed:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(master, view) :]
+        feed.sent()
+    feed.done.set()
+
+
+class ReplayReader(MeterReader):
+    # stops once every telegram of the feed is read
+
+    def __init__(self, meter, port, handler, feed, serial=None):
+        super().__init__(meter, port, handler)
+        self.feed = feed
+        self.serial = serial
+        self.ready = threading.Event()
+
+    def open(self):
+        ser = self.serial if self.serial is not None else super().open()
+        self.ready.set()
+        return ser
+
+    def read(self):
+        ser = self.ser
+        framer = self.framer
+        while not self.stopping.is_set():
+            data = ser.read(ser.in_waiting or 1)
+            for telegram in framer.feed(data):
+                self.handler(self.meter, telegram)
+            handled = framer.telegrams + framer.crc_errors + framer.decode_errors
+            if self.feed.done.is_set() and handled >= self.feed.count:
+                self.stopping.set()
+
+
+class InfluxStandIn:
+    # counts the points instead of writing them, `latency` seconds per write
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.writes = 0
+        self.points = 0
+
+    def write_points(self, points, *args, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        self.writes += 1
+        self.points += len(points)
+        return True
+
+
+class MqttStandIn:
+    # counts the messages instead of publishing them
+
+    class Result:
+        rc = paho.MQTT_ERR_SUCCESS
+
+    def __init__(self):
+        self.messages = 0
+
+    def is_connected(self):
+        return True
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.messages += 1
+        return self.Result
+
+    def loop_stop(self):
+        pass
+
+
+class ReplayMonitor(electricity_meter.EnergyMonitor):
+
+    def __init__(self, feed, meter, via, influx_latency):
+        self.feed = feed
+        self.meter = meter
+        self.via = via
+        self.influx_latency = influx_latency
+        self.parse_times = []
+        self.latencies = {"mqtt": [], "influxdb": []}
+        # readings on their way to the sinks, by id, with the time they were fed
+        self.pending = {}
+        self.lock = threading.Lock()
+        super().__init__()
+
+    def init_influxdb(self):
+        self.influx_client = InfluxStandIn(self.influx_latency)
+        self.writer = None
+        self.retry_on = ()
+
+    def init_mqtt_client(self):
+        self.mqtt_client = MqttStandIn()
+        self.published = {}
+
+    def create_readers(self):
+        if self.via == "file":
+            return [ReplayReader(self.meter, "replay", self.datagram, self.feed, FileSerial(self.feed))]
+
+        master, slave = pty.openpty()
+        reader = ReplayReader(self.meter, os.ttyname(slave), self.datagram, self.feed)
+        threading.Thread(target=feed_pty, args=(self.feed, master, reader), name="feed", daemon=True).start()
+        return [reader]
+
+    def parse(self, meter, telegram, received):
+        started = time.perf_counter()
+        reading = super().parse(meter, telegram, received)
+        self.parse_times.append(time.perf_counter() - started)
+
+        fed = self.feed.fed.popleft() if self.feed.fed else None
+        if fed is not None:
+            with self.lock:
+                self.pending[id(reading)] = [reading, fed, len(self.latencies)]
+                if len(self.pending) > 10000:
+                    # readings that were dropped or replaced by a stage never arrive
+                    del self.pending[next(iter(self.pending))]
+        return reading
+
+    def arrived(self, sink, reading):
+        now = time.perf_counter()
+        with self.lock:
+            entry = self.pending.get(id(reading))
+            if entry is None or entry[0] is not reading:
+                return
+            self.latencies[sink].append(now - entry[1])
+            entry[2] -= 1
+            if not entry[2]:
+                del self.pending[id(reading)]
+
+    def publish_datagram(self, reading):
+        super().publish_datagram(reading)
+        self.arrived("mqtt", reading)
+
+    def store(self, reading):
+        super().store(reading)
+        self.arrived("influxdb", reading)
+
+
+def percentiles(values, scale):
+    if not values:
+        return "n/a"
+    values = sorted(values)
+    mean = sum(values) / len(values)
+    p50 = values[len(values) // 2]
+    p99 = values[min(len(values) - 1, int(len(values) * 0.99))]
+    return f"mean {mean * scale:.1f}, p50 {p50 * scale:.1f}, p99 {p99 * scale:.1f}"
+
+
+def report(monitor, elapsed):
+    feed = monitor.feed
+    print(f"telegrams: {feed.count} fed, {len(monitor.parse_times)} handled in {elapsed:.2f}s")
+    print(f"throughput: {len(monitor.parse_times) / elapsed if elapsed else 0:.0f} telegrams/s")
+    print(f"parse time (us): {percentiles(monitor.parse_times, 1e6)}")
+    for sink, latencies in monitor.latencies.items():
+        print(f"latency to {sink} (ms): {percentiles(latencies, 1e3)}")
+    print(
+        f"sinks: {monitor.mqtt_client.messages} mqtt messages, "
+        f"{monitor.influx_client.points} points in {monitor.influx_client.writes} influxdb writes"
+    )
+    for sink, stats in monitor.pipeline.stats().items():
+        print(f"pipeline {sink}: {stats}")
+    # ru_maxrss is in kilobytes on Linux
+    print(f"peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay recorded P1 telegrams through the energy service")
+    parser.add_argument("files", nargs="+", help="telegram files, plain text or archived segments (*.p1.gz)")
+    parser.add_argument("--meter", default=next(iter(electricity_meter.meters)), help="meter id of the telegrams")
+    parser.add_argument("--repeat", type=int, default=1, help="replay the files this many times")
+    parser.add_argument("--realtime", action="store_true", help="pace the telegrams like they were recorded")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between telegrams without a recorded time")
+    parser.add_argument("--via", choices=("pty", "file"), default="pty", help="pseudo terminal or file backed serial port")
+    parser.add_argument("--influx-latency", type=float, default=0, help="seconds per write of the InfluxDB stand-in")
+    parser.add_argument("--benchmark", action="store_true", help="quiet logging and report throughput, latency and RSS")
+    args = parser.parse_args()
+
+    telegrams = load(args.files)
+    if not telegrams:
+        raise SystemExit(f"no valid telegrams in {', '.join(args.files)}")
+    if args.benchmark:
+        log.setLevel(logging.WARNING)
+
+    feed = Feed(telegrams, args.repeat, args.realtime, args.interval)
+    monitor = ReplayMonitor(feed, args.meter, args.via, args.influx_latency)
+    log.info("replay %d telegrams %d times via %s", len(telegrams), args.repeat, args.via)
+    monitor.start()
+    elapsed = time.perf_counter() - feed.first if feed.first is not None else 0
+
+    if args.benchmark:
+        report(monitor, elapsed)
+    else:
+        log.info(
+            "replayed %d telegrams: %d mqtt messages, %d influxdb points",
+            feed.count,
+            monitor.mqtt_client.messages,
+            monitor.influx_client.points,
+        )
+
+
+if __name__ == "__main__":
+    main()
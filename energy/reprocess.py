@@ -0,0 +1,170 @@
+# Reprocess archived P1 telegrams
+#
+# Replays the telegrams of the archive from a date range through the current
+# parser and writes the points to InfluxDB in large batches. Every segment (a
+# day of one meter) is handled by its own worker process. The points get the
+# time of the telegram, so reprocessing a range overwrites the points that were
+# written before.
+#
+# usage: python reprocess.py 2024-01-01 2024-01-31 [--meter main] [--workers 4] [--dry-run]
+import os
+import time
+import argparse
+import logging
+from datetime import date
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+import archive
+from pipeline import Reading
+from aggregate import WindowAggregator
+from suppress import ChangeSuppressor
+
+#########################################################
+# Configure InfluxDB connection variables
+influx_host = os.getenv("INFLUXDB_HOST", "localhost")
+influx_port = int(os.getenv("INFLUXDB_PORT", "8086"))
+influx_user = os.getenv("INFLUXDB_USER", "user")
+influx_password = os.getenv("INFLUXDB_PASSWORD", "")
+influx_energy_db = os.getenv("INFLUXDB_ENERGY_DATABASE", "energy")
+
+measurement = os.getenv("INFLUXDB_ENERGY_MEASUREMENT", "meter")
+location = os.getenv("LOCATION", "house")
+
+logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
+log = logging.getLogger("root")
+
+
+def write(client, points, attempts=3):
+    for attempt in range(1, attempts + 1):
+        try:
+            client.write_points(points, batch_size=len(points))
+            return
+        except (InfluxDBClientError, InfluxDBServerError, OSError) as e:
+            if attempt == attempts:
+                raise
+            log.warning("write failed, attempt %d of %d: %s", attempt, attempts, e)
+            time.sleep(5 * attempt)
+
+
+def reprocess_segment(meter, path, args):
+    started = time.monotonic()
+    client = None
+    if not args.dry_run:
+        client = InfluxDBClient(influx_host, influx_port, influx_user, influx_password, influx_energy_db)
+
+    stages = []
+    if args.aggregate > 0:
+        stages.append(WindowAggregator(args.aggregate))
+    if args.suppress > 0:
+        # the same fields as the service, or reprocessing overwrites the history with other points
+        fields = {f.strip() for f in args.suppress_fields.split(",") if f.strip()} or None
+        stages.append(ChangeSuppressor(args.suppress, fields))
+
+    telegrams = 0
+    written = 0
+    batch = []
+
+    def add(reading, stages):
+        for stage in stages:
+            reading = stage(reading)
+            if reading is None:
+                return
+        batch.extend(reading.points(measurement, {"location": location}))
+
+    for received, telegram in archive.read_segment(path):
+        telegrams += 1
+        reading = Reading.parse(meter, telegram, received)
+        if reading.fields:
+            add(reading, stages)
+
+        if len(batch) >= args.batch_size:
+            if client is not None:
+                write(client, batch)
+            written += len(batch)
+            batch = []
+
+    for i, stage in enumerate(stages):
+        if hasattr(stage, "flush"):
+            for reading in stage.flush():
+                add(reading, stages[i + 1 :])
+    if batch and client is not None:
+        write(client, batch)
+    written += len(batch)
+
+    return telegrams, written, time.monotonic() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="reprocess archived P1 telegrams into InfluxDB")
+    parser.add_argument("first", type=date.fromisoformat, help="first day, YYYY-MM-DD (UTC)")
+    parser.add_argument("last", type=date.fromisoformat, help="last day, YYYY-MM-DD (UTC), inclusive")
+    parser.add_argument(
+        "--archive", default=os.getenv("ENERGY_ARCHIVE"), required=not os.getenv("ENERGY_ARCHIVE"), help="ENERGY_ARCHIVE"
+    )
+    parser.add_argument("--meter", action="append", help="meter id, all meters by default")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument(
+        "--aggregate",
+        type=int,
+        default=int(os.getenv("ENERGY_AGGREGATE_WINDOW", "0")),
+        help="aggregation window in seconds, as ENERGY_AGGREGATE_WINDOW",
+    )
+    parser.add_argument(
+        "--suppress",
+        type=int,
+        default=int(os.getenv("ENERGY_SUPPRESS_HEARTBEAT", "0")),
+        help="heartbeat of unchanged fields in seconds, as ENERGY_SUPPRESS_HEARTBEAT",
+    )
+    parser.add_argument(
+        "--suppress-fields",
+        default=os.getenv("ENERGY_SUPPRESS_FIELDS", ""),
+        help="comma separated fields to suppress, all fields when empty, as ENERGY_SUPPRESS_FIELDS",
+    )
+    parser.add_argument("--dry-run", action="store_true", help="parse only, don't write to InfluxDB")
+    args = parser.parse_args()
+
+    meters = args.meter or sorted(
+        name for name in os.listdir(args.archive) if os.path.isdir(os.path.join(args.archive, name))
+    )
+    jobs = [
+        (meter, path)
+        for meter in meters
+        for path in archive.segments(args.archive, meter, args.first.isoformat(), args.last.isoformat())
+    ]
+    if not jobs:
+        raise SystemExit(f"no archived telegrams from {args.first} to {args.last} in {args.archive}")
+
+    log.info("reprocess %d segments with %d workers", len(jobs), args.workers)
+    started = time.monotonic()
+    total_telegrams = 0
+    total_points = 0
+    with ProcessPoolExecutor(args.workers) as executor:
+        futures = {executor.submit(reprocess_segment, meter, path, args): path for meter, path in jobs}
+        for done, future in enumerate(as_completed(futures), 1):
+            telegrams, points, seconds = future.result()
+            total_telegrams += telegrams
+            total_points += points
+            log.info(
+                "[%d/%d] %s: %d telegrams, %d points in %.1fs",
+                done,
+                len(jobs),
+                futures[future],
+                telegrams,
+                points,
+                seconds,
+            )
+
+    elapsed = time.monotonic() - started
+    log.info(
+        "reprocessed %d telegrams into %d points in %.1fs (%.0f telegrams/s)",
+        total_telegrams,
+        total_points,
+        elapsed,
+        total_telegrams / elapsed if elapsed else 0,
+    )
+
+
+if __name__ == "__main__":
+    main()
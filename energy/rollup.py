@@ -0,0 +1,170 @@
+# Hourly, daily and monthly rollups of the meter counters
+#
+# The consumption and return delivery of a period are the deltas of the
+# cumulative counters of the telegrams in that period. The counters of the
+# meter are already split by tariff, `meter_t1` only counts while tariff 1 is
+# active, so every tariff gets its own rollup field:
+#
+#   consumption_t1/t2   delta of meter_t1/t2 in kWh
+#   return_t1/t2        delta of meter_back_t1/t2 in kWh
+#   consumption/return  the sum of both tariffs
+#   gas                 delta of gas_meter in m3, at the time the gas meter captured it
+#
+# A delta ends at the time of its telegram, so it belongs to the period that
+# telegram ends. A delta that arrives after its period closed, like the gas
+# reading captured at the hour, is counted in the open period. Days and months
+# follow the local time, or `timezone`.
+#
+# The counters and the open periods of every meter are checkpointed to a JSON
+# file after their points are written. After a restart the deltas continue
+# from the checkpoint, so a period is never counted twice; telegrams that were
+# handled after the last checkpoint are counted again into the same totals.
+import os
+import json
+import logging
+from datetime import datetime
+
+log = logging.getLogger("root")
+
+PERIODS = ("hour", "day", "month")
+
+# counter -> rollup field
+COUNTERS = {
+    "meter_t1": "consumption_t1",
+    "meter_t2": "consumption_t2",
+    "meter_back_t1": "return_t1",
+    "meter_back_t2": "return_t2",
+    "gas_meter": "gas",
+}
+
+TOTALS = {
+    "consumption": ("consumption_t1", "consumption_t2"),
+    "return": ("return_t1", "return_t2"),
+}
+
+
+def period_start(period, time_ns, timezone=None):
+    dt = datetime.fromtimestamp(time_ns // 1_000_000_000, timezone)
+    if period == "hour":
+        dt = dt.replace(minute=0, second=0, microsecond=0)
+    elif period == "day":
+        dt = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    else:
+        dt = dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return int(dt.timestamp()) * 1_000_000_000
+
+
+class Rollup:
+    """
+    Keeps the open periods of every meter. `add(reading)` returns the points of
+    the periods that closed, and of the open periods every `interval` seconds
+    of telegram time, so the rows of the running hour, day and month are
+    updated in place. Call `checkpoint()` once those points are written.
+    """
+
+    def __init__(self, measurement, tags, state_path, interval=60, timezone=None):
+        self.measurement = measurement
+        self.tags = tags
+        self.state_path = state_path
+        self.interval = interval * 1_000_000_000
+        self.timezone = timezone
+        self.last_emit = None
+        # meter -> {"counters": {counter: value}, "periods": {period: [start, {field: delta}]}}
+        self.meters = {}
+        self.resets = 0
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                self.meters = json.load(f)
+            log.info("rollup state of %d meters loaded from %s", len(self.meters), self.state_path)
+        except (OSError, ValueError) as e:
+            log.error("failed to load the rollup state %s, start over", self.state_path, exc_info=e)
+
+    def checkpoint(self):
+        temp = self.state_path + ".tmp"
+        try:
+            with open(temp, "w", encoding="utf-8") as f:
+                json.dump(self.meters, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, self.state_path)
+        except OSError as e:
+            log.error("failed to checkpoint the rollup state to %s", self.state_path, exc_info=e)
+
+    def add(self, reading):
+        state = self.meters.get(reading.meter)
+        if state is None:
+            state = self.meters[reading.meter] = {"counters": {}, "periods": {}}
+
+        closed = []
+        counters = state["counters"]
+        for counter, field in COUNTERS.items():
+            value = reading.fields.get(counter)
+            if not isinstance(value, (int, float)):
+                continue
+            time = reading.time
+            if counter == "gas_meter" and reading.fields.get("gas_timestamp") is not None:
+                time = reading.fields["gas_timestamp"] * 1_000_000_000
+
+            previous = counters.get(counter)
+            counters[counter] = value
+            if previous is None or value == previous:
+                continue
+            if value < previous:
+                # a replaced meter or a reset counter, skip the delta
+                self.resets += 1
+                log.warning(
+                    "counter %s of meter '%s' went back from %s to %s", counter, reading.meter, previous, value
+                )
+                continue
+
+            # the delta ends at `time`, a telegram at midnight closes the day before
+            for period in PERIODS:
+                totals = self.period(reading.meter, state, period, time - 1, closed)
+                totals[field] = totals.get(field, 0) + value - previous
+
+        # roll over to the periods of this telegram, even when nothing changed
+        for period in PERIODS:
+            self.period(reading.meter, state, period, reading.time - 1, closed)
+
+        if self.last_emit is None:
+            self.last_emit = reading.time
+        if reading.time - self.last_emit >= self.interval:
+            self.last_emit = reading.time
+            return closed + self.points()
+        return closed
+
+    def period(self, meter, state, period, time, closed):
+        # the totals of the period of `time`, the previous period is closed when it ended
+        start = period_start(period, time, self.timezone)
+        current = state["periods"].get(period)
+        if current is None or start > current[0]:
+            if current is not None:
+                closed.append(self.point(meter, period, current))
+            current = state["periods"][period] = [start, {}]
+        # a late delta, like a gas reading of the previous hour, goes into the open period
+        return current[1]
+
+    def point(self, meter, period, current):
+        start, totals = current
+        fields = {field: round(totals.get(field, 0), 3) * 1.0 for field in COUNTERS.values()}
+        for total, parts in TOTALS.items():
+            fields[total] = round(sum(totals.get(part, 0) for part in parts), 3) * 1.0
+        return {
+            "measurement": self.measurement,
+            "tags": {**self.tags, "meter": meter, "period": period},
+            "time": start,
+            "fields": fields,
+        }
+
+    def points(self):
+        # the points of all open periods
+        return [
+            self.point(meter, period, current)
+            for meter, state in self.meters.items()
+            for period, current in state["periods"].items()
+        ]
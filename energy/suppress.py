@@ -0,0 +1,46 @@
+# Change based suppression of slow moving fields
+#
+# Most fields of a telegram, like the gas meter, the version and the power
+# failure counters, hardly ever change. A field is only passed on when its value
+# changed, or when it wasn't passed on for `heartbeat` seconds.
+from pipeline import Reading
+
+
+class ChangeSuppressor:
+    """
+    Pipeline stage that drops unchanged fields from every reading. `fields`
+    limits suppression to those fields, by default all fields are suppressed.
+    """
+
+    def __init__(self, heartbeat, fields=None):
+        self.heartbeat = heartbeat
+        self.fields = fields
+        self.last = {}
+        self.passed = 0
+        self.suppressed = 0
+
+    def __call__(self, reading):
+        # the time of the telegram, so reprocessing the archive suppresses like the service did
+        now = reading.time / 1_000_000_000
+        last = self.last.get(reading.meter)
+        if last is None:
+            last = self.last[reading.meter] = {}
+
+        fields = {}
+        for field, value in reading.fields.items():
+            if self.fields is not None and field not in self.fields:
+                fields[field] = value
+                continue
+
+            previous = last.get(field)
+            if previous is None or previous[0] != value or now - previous[1] >= self.heartbeat:
+                last[field] = (value, now)
+                fields[field] = value
+            else:
+                self.suppressed += 1
+        self.passed += len(fields)
+
+        return Reading(reading.meter, fields, reading.time) if fields else None
+
+    def stats(self):
+        return {"passed": self.passed, "suppressed": self.suppressed}
@@ -0,0 +1,65 @@
+from aggregate import WindowAggregator
+from pipeline import Reading
+
+S = 1_000_000_000
+# a multiple of every window
+START = 1706659200 * S
+
+
+def reading(second, meter="main", **fields):
+    return Reading(meter, fields, START + second * S)
+
+
+def test_a_window_closes_with_the_first_reading_of_the_next():
+    aggregate = WindowAggregator(10)
+    assert aggregate(reading(0, electricity_delivered=1.0)) is None
+    assert aggregate(reading(9, electricity_delivered=3.0)) is None
+    closed = aggregate(reading(10, electricity_delivered=5.0))
+    assert closed.time == START
+    assert closed.fields["electricity_delivered_mean"] == 2.0
+
+
+def test_windows_are_aligned():
+    aggregate = WindowAggregator(10)
+    aggregate(reading(7, electricity_delivered=1.0))
+    # 7 and 9 are in the window of 0, 13 in the window of 10
+    assert aggregate(reading(9, electricity_delivered=1.0)) is None
+    closed = aggregate(reading(13, electricity_delivered=1.0))
+    assert closed.time == START and closed.fields["samples"] == 2
+    assert aggregate.flush()[0].time == START + 10 * S
+
+
+def test_min_max_mean_and_last_values():
+    aggregate = WindowAggregator(60)
+    aggregate(reading(0, electricity_delivered=0.5, instantaneous_current_l1=2, meter_t1=100.0, tariff_indicator=1))
+    aggregate(reading(1, electricity_delivered=1.5, instantaneous_current_l1=4, meter_t1=100.1, tariff_indicator=2))
+    aggregate(reading(2, electricity_delivered=0.25, meter_t1=100.2))
+    (closed,) = aggregate.flush()
+    assert closed.fields == {
+        "electricity_delivered_min": 0.25,
+        "electricity_delivered_max": 1.5,
+        "electricity_delivered_mean": 0.75,
+        "instantaneous_current_l1_min": 2,
+        "instantaneous_current_l1_max": 4,
+        "instantaneous_current_l1_mean": 3.0,
+        "meter_t1": 100.2,
+        "tariff_indicator": 2,
+        "samples": 3,
+    }
+
+
+def test_meters_have_their_own_windows():
+    aggregate = WindowAggregator(10)
+    aggregate(reading(0, "main", meter_t1=1.0))
+    assert aggregate(reading(11, "solar", meter_t1=2.0)) is None
+    closed = aggregate(reading(12, "main", meter_t1=3.0))
+    assert closed.meter == "main" and closed.fields == {"meter_t1": 1.0, "samples": 1}
+    assert sorted((r.meter, r.fields["meter_t1"]) for r in aggregate.flush()) == [("main", 3.0), ("solar", 2.0)]
+
+
+def test_flush_empties_the_windows():
+    aggregate = WindowAggregator(10)
+    assert aggregate.flush() == []
+    aggregate(reading(0, meter_t1=1.0))
+    assert len(aggregate.flush()) == 1
+    assert aggregate.flush() == []
@@ -0,0 +1,115 @@
+import os
+import gzip
+from archive import TelegramArchive, read_segment, segments
+
+DAY = 86400 * 1_000_000_000
+# 2024-01-31 00:00 UTC
+START = 1706659200 * 1_000_000_000
+
+
+def telegram(i):
+    return f"/KFM5KAIFA-METER\r\n\r\n1-0:1.8.1({i:010.3f}*kWh)\r\n!0000\r\n"
+
+
+def archive(directory, times, block_size=3):
+    archive = TelegramArchive(str(directory), block_size)
+    for time_ns in times:
+        archive.append("meter", time_ns, telegram(time_ns // 1_000_000_000 % 100000))
+    archive.close()
+
+
+def test_round_trip(tmp_path):
+    times = [START + i * 1_000_000_000 for i in range(10)]
+    archive(tmp_path, times)
+    (path,) = segments(str(tmp_path), "meter", "2024-01-31", "2024-01-31")
+    records = list(read_segment(path))
+    assert [time_ns for time_ns, _ in records] == times
+    assert records[4][1] == telegram(times[4] // 1_000_000_000 % 100000)
+
+
+def test_segment_per_day(tmp_path):
+    archive(tmp_path, [START - 1, START, START + DAY])
+    days = segments(str(tmp_path), "meter", "2024-01-30", "2024-02-01")
+    assert [os.path.basename(path) for path in days] == ["2024-01-30.p1.gz", "2024-01-31.p1.gz", "2024-02-01.p1.gz"]
+    assert segments(str(tmp_path), "meter", "2024-01-31", "2024-01-31") == days[1:2]
+    assert segments(str(tmp_path), "other", "2024-01-30", "2024-02-01") == []
+
+
+def test_time_range_uses_the_index(tmp_path):
+    times = [START + i * 1_000_000_000 for i in range(10)]
+    archive(tmp_path, times)
+    path = str(tmp_path / "meter" / "2024-01-31.p1.gz")
+    with open(path[: -len(".gz")] + ".idx", encoding="utf-8") as f:
+        assert [int(line.split()[0]) for line in f] == times[::3]
+
+    records = list(read_segment(path, times[4], times[8]))
+    assert [time_ns for time_ns, _ in records] == times[4:8]
+
+
+def test_truncated_last_block(tmp_path):
+    times = [START + i * 1_000_000_000 for i in range(6)]
+    archive(tmp_path, times)
+    path = str(tmp_path / "meter" / "2024-01-31.p1.gz")
+    # the service died while it wrote a block, the index never got it
+    block = gzip.compress(b"@%d\n%s" % (START + 10**10, telegram(0).encode("ascii")))
+    with open(path, "ab") as f:
+        f.write(block[: len(block) // 2])
+
+    assert [time_ns for time_ns, _ in read_segment(path)] == times
+
+
+def test_broken_block_in_the_middle(tmp_path):
+    times = [START + i * 1_000_000_000 for i in range(9)]
+    archive(tmp_path, times)
+    path = str(tmp_path / "meter" / "2024-01-31.p1.gz")
+    index = path[: -len(".gz")] + ".idx"
+    with open(index, encoding="utf-8") as f:
+        offsets = [int(line.split()[1]) for line in f]
+    with open(path, "rb") as f:
+        data = f.read()
+
+    # cut the second block short, the third one stays where the index has it
+    broken = data[: offsets[1]] + data[offsets[1] : offsets[2]][:20]
+    with open(path, "wb") as f:
+        f.write(broken + data[offsets[2] :])
+    with open(index, "w", encoding="utf-8") as f:
+        f.write(f"{times[0]} 0\n{times[3]} {offsets[1]}\n{times[6]} {len(broken)}\n")
+
+    assert [time_ns for time_ns, _ in read_segment(path)] == times[:3] + times[6:]
+
+
+def test_errors_suspend_the_archive(tmp_path, monkeypatch):
+    now = [0]
+    monkeypatch.setattr("archive.time.monotonic", lambda: now[0])
+    blocked = tmp_path / "blocked"
+    blocked.write_text("not a directory")
+    archive = TelegramArchive(str(blocked), block_size=1, retry_delay=60)
+
+    archive.append("meter", START, telegram(1))
+    assert archive.segments == {} and archive.suspended_until == 60
+
+    blocked.unlink()
+    now[0] = 30
+    archive.append("meter", START + 1, telegram(2))
+    assert archive.dropped == 1 and not blocked.exists()
+
+    now[0] = 60
+    archive.append("meter", START + 2, telegram(3))
+    archive.close()
+    (path,) = segments(str(blocked), "meter", "2024-01-31", "2024-01-31")
+    assert [time_ns for time_ns, _ in read_segment(path)] == [START + 2]
+
+
+def test_retention(tmp_path):
+    archive(tmp_path, [START - 3 * DAY, START - 2 * DAY, START - DAY])
+    kept = TelegramArchive(str(tmp_path), block_size=1, retention_days=2)
+    kept.append("meter", START, telegram(1))
+    kept.close()
+    assert sorted(os.listdir(tmp_path / "meter")) == [
+        "2024-01-29.p1.gz",
+        "2024-01-29.p1.idx",
+        "2024-01-30.p1.gz",
+        "2024-01-30.p1.idx",
+        "2024-01-31.p1.gz",
+        "2024-01-31.p1.idx",
+    ]
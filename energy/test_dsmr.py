@@ -0,0 +1,99 @@
+import os
+import pytest
+import dsmr
+from benchmark import legacy_parse, read_telegram
+
+SAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "samples")
+
+
+@pytest.fixture(name="lines")
+def sample_lines():
+    return read_telegram(os.path.join(SAMPLES, "kfm5kaifa.txt"))
+
+
+def test_parse_matches_the_regex_parser(lines):
+    results = dsmr.parse(lines)
+    # the regex parser never matched the timestamp and ignored the gas capture time
+    results.pop("timestamp")
+    results.pop("gas_timestamp")
+    assert results == legacy_parse(lines)
+
+
+def test_parse_converts_the_values(lines):
+    results = dsmr.parse(lines)
+    assert results["version_info"] == 42
+    assert results["meter_t1"] == 1581.123
+    assert results["tariff_indicator"] == 2
+    assert results["instantaneous_voltage_l1"] == 229.0
+    assert results["instantaneous_current_l2"] == 5
+    assert results["gas_meter"] == 938.351
+
+
+def test_parse_timestamps(lines):
+    results = dsmr.parse(lines)
+    # 2018-12-10 20:10:52 winter time, UTC+1
+    assert results["timestamp"] == 1544469052
+    assert results["gas_timestamp"] == 1544468400
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        "1-0:1.8.1(001581.123*kWh",  # no unit and closing parenthesis
+        "1-0:32.7.0(22x.0*V)",  # not a number
+        "0-0:96.14.0(abc)",
+        "0-0:1.0.0(181210201052X)",  # no summer or winter time
+        "9-9:9.9.9(1)",  # unknown OBIS code
+    ],
+)
+def test_parse_skips_what_the_regex_parser_skips(line):
+    assert dsmr.parse([line]) == legacy_parse([line]) == {}
+
+
+@pytest.fixture(name="telegram")
+def sample_telegram():
+    with open(os.path.join(SAMPLES, "kfm5kaifa.txt"), "rb") as f:
+        return f.read()
+
+
+def test_crc16_of_the_sample(telegram):
+    end = telegram.index(b"!")
+    assert dsmr.crc16(telegram[: end + 1]) == int(telegram[end + 1 : end + 5], 16)
+
+
+def test_framer_returns_a_telegram_fed_byte_by_byte(telegram):
+    framer = dsmr.TelegramFramer()
+    telegrams = []
+    for i in range(len(telegram)):
+        telegrams += framer.feed(telegram[i : i + 1])
+    assert telegrams == [telegram.decode("ascii")]
+    assert framer.telegrams == 1
+    assert not framer.buffer
+
+
+def test_framer_skips_a_bad_crc(telegram):
+    framer = dsmr.TelegramFramer()
+    corrupt = telegram.replace(b"001581.123", b"001581.124")
+    assert framer.feed(corrupt + telegram) == [telegram.decode("ascii")]
+    assert framer.crc_errors == 1
+
+
+def test_framer_resyncs_after_garbage_and_a_truncated_telegram(telegram):
+    framer = dsmr.TelegramFramer()
+    truncated = telegram[: len(telegram) // 2]
+    telegrams = framer.feed(b"\x00\xffnoise" + truncated + telegram)
+    assert telegrams == [telegram.decode("ascii")]
+    assert framer.discarded_bytes == len(b"\x00\xffnoise") + len(truncated)
+
+
+def test_framer_drops_a_frame_without_trailer(telegram):
+    framer = dsmr.TelegramFramer(max_size=64)
+    assert framer.feed(b"/" + b"x" * 100) == []
+    assert len(framer.buffer) <= 64
+    assert framer.feed(telegram) == [telegram.decode("ascii")]
+
+
+def test_framer_passes_a_telegram_without_crc():
+    # DSMR 2 and 3 meters end with a bare `!`
+    telegram = b"/ISk5MT382-1000\r\n\r\n1-0:1.8.1(12345.678*kWh)\r\n!\r\n"
+    assert dsmr.TelegramFramer().feed(telegram) == [telegram.decode("ascii")]
@@ -0,0 +1,99 @@
+import time
+import socket
+import pytest
+from fanout import TelegramFanout
+
+
+def telegram(i):
+    return f"/KFM5KAIFA-METER\r\n\r\n1-0:1.8.1({i:010.3f}*kWh)\r\n!0000\r\n"
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def receive(sock, size, timeout=5):
+    sock.settimeout(timeout)
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        assert chunk, "connection closed"
+        data += chunk
+    return data.decode("ascii")
+
+
+@pytest.fixture(name="fanout")
+def fixture_fanout(tmp_path):
+    fanout = TelegramFanout("main", f"unix:{tmp_path / 'p1.sock'}", backlog=3)
+    yield fanout
+    fanout.stop()
+    if fanout.is_alive():
+        fanout.join(5)
+
+
+def connect(fanout):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(fanout.address.partition(":")[2])
+    return sock
+
+
+def test_unknown_address():
+    with pytest.raises(ValueError):
+        TelegramFanout("main", "udp:2001")
+
+
+def test_subscribers_receive_whole_telegrams(fanout):
+    fanout.start()
+    first, second = connect(fanout), connect(fanout)
+    wait_for(lambda: len(fanout.subscribers) == 2)
+    telegrams = [telegram(i) for i in range(3)]
+    for t in telegrams:
+        fanout.broadcast(t)
+    expected = "".join(telegrams)
+    assert receive(first, len(expected)) == expected
+    assert receive(second, len(expected)) == expected
+    first.close()
+    second.close()
+
+
+def test_a_slow_subscriber_loses_its_oldest_telegrams(fanout):
+    # without the fan-out thread running nothing is sent, like a subscriber that doesn't read
+    sock = connect(fanout)
+    fanout.accept()
+    for i in range(5):
+        fanout.broadcast(telegram(i))
+    (subscriber,) = fanout.subscribers.values()
+    assert subscriber.dropped == 2
+
+    fanout.start()
+    expected = "".join(telegram(i) for i in range(2, 5))
+    assert receive(sock, len(expected)) == expected
+    wait_for(lambda: subscriber.sent == 3)
+    sock.close()
+
+
+def test_a_subscriber_that_leaves_is_closed(fanout):
+    fanout.start()
+    sock = connect(fanout)
+    wait_for(lambda: len(fanout.subscribers) == 1)
+    sock.close()
+    wait_for(lambda: not fanout.subscribers)
+    # nobody to send to
+    fanout.broadcast(telegram(1))
+
+
+def test_stop_closes_the_subscribers(fanout):
+    fanout.start()
+    sock = connect(fanout)
+    wait_for(lambda: len(fanout.subscribers) == 1)
+    fanout.stop()
+    fanout.join(5)
+    assert not fanout.is_alive() and not fanout.subscribers
+    sock.settimeout(5)
+    assert sock.recv(4096) == b""
+    sock.close()
+    with pytest.raises(OSError):
+        connect(fanout)
@@ -0,0 +1,116 @@
+import pytest
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from outbox import CircuitBreaker, Outbox, OutboxWriter
+
+
+class FakeInflux:
+    def __init__(self):
+        self.points = []
+        self.down = False
+        self.writes = 0
+
+    def write_points(self, points):
+        self.writes += 1
+        if self.down:
+            raise InfluxDBServerError("down")
+        if any(point["fields"].get("value") == "bad" for point in points):
+            raise InfluxDBClientError("partial write: field type conflict", 400)
+        self.points.extend(points)
+
+
+def point(value):
+    return {"measurement": "energy", "time": value, "fields": {"value": value}}
+
+
+@pytest.fixture(name="outbox")
+def temporary_outbox(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.db"), sync_points=1)
+    yield outbox
+    outbox.db.close()
+
+
+def test_breaker_opens_after_the_threshold():
+    breaker = CircuitBreaker(threshold=3, reset_timeout=3600)
+    breaker.failure()
+    breaker.failure()
+    assert not breaker.is_open and breaker.allow()
+    breaker.failure()
+    assert breaker.is_open and not breaker.allow()
+
+
+def test_breaker_half_open_probe():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0)
+    breaker.failure()
+    assert breaker.is_open
+    # after the reset timeout one attempt is let through
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.is_open
+    assert breaker.allow()
+    breaker.success()
+    assert not breaker.is_open and breaker.failures == 0
+
+
+def test_outbox_keeps_points_across_a_restart(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    outbox = Outbox(path, sync_points=100)
+    for i in range(3):
+        outbox.append(point(i))
+    outbox.close()
+
+    outbox = Outbox(path)
+    assert len(outbox) == 3
+    assert [p for _, p in outbox.peek(10)] == [point(0), point(1), point(2)]
+    outbox.close()
+
+
+def test_outbox_drops_the_oldest_points_when_full(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.db"), max_points=2, sync_points=1)
+    for i in range(4):
+        outbox.append(point(i))
+    assert len(outbox) == 2 and outbox.dropped == 2
+    assert [p for _, p in outbox.peek(10)] == [point(2), point(3)]
+    outbox.close()
+
+
+def test_writer_replays_the_backlog_in_order(outbox):
+    influx = FakeInflux()
+    writer = OutboxWriter(influx, outbox, CircuitBreaker(threshold=1, reset_timeout=0), batch_size=2)
+    influx.down = True
+    writer.write([point(0), point(1)])
+    writer.write([point(2)])
+    assert len(outbox) == 3 and not influx.points
+
+    influx.down = False
+    # new points wait behind the backlog
+    writer.write([point(3)])
+    while len(outbox):
+        writer.drain()
+    assert influx.points == [point(i) for i in range(4)]
+
+
+def test_writer_keeps_a_batch_that_fails_halfway(outbox):
+    influx = FakeInflux()
+    writer = OutboxWriter(influx, outbox, CircuitBreaker(threshold=1, reset_timeout=0), batch_size=10)
+    for i in range(4):
+        outbox.append(point(i))
+
+    influx.down = True
+    writer.drain()
+    assert len(outbox) == 4
+    influx.down = False
+    writer.drain()
+    # every point is written once, the replay doesn't add copies to the outbox
+    assert not len(outbox)
+    assert influx.points == [point(i) for i in range(4)]
+
+
+def test_writer_drops_only_the_rejected_points(outbox):
+    influx = FakeInflux()
+    writer = OutboxWriter(influx, outbox, CircuitBreaker())
+    points = [point(i) for i in range(10)]
+    points[3] = point("bad")
+    points[7] = point("bad")
+    writer.write(points)
+    assert influx.points == [p for p in points if p["fields"]["value"] != "bad"]
+    assert not len(outbox)
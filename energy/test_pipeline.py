@@ -0,0 +1,120 @@
+import threading
+import pytest
+from pipeline import COALESCE, DROP_OLDEST, Pipeline, Reading, SinkWorker, TelegramQueue
+
+
+def reading(time, meter="main", **fields):
+    return Reading(meter, fields or {"value": time}, time)
+
+
+def drain(queue):
+    queue.close()
+    items = []
+    while (item := queue.get()) is not None:
+        items.append(item)
+    return items
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        TelegramQueue(10, "latest-only")
+
+
+def test_drop_oldest_keeps_the_newest_telegrams():
+    queue = TelegramQueue(3, DROP_OLDEST)
+    for time in range(5):
+        queue.put(reading(time))
+    assert [item.time for item in drain(queue)] == [2, 3, 4]
+    assert queue.dropped == 2 and queue.coalesced == 0
+
+
+def test_coalesce_merges_into_the_newest_telegram_of_the_meter():
+    queue = TelegramQueue(2, COALESCE)
+    first = reading(0, a=1)
+    queue.put(first)
+    queue.put(reading(1, a=2, b=1))
+    queue.put(reading(2, b=2, c=3))
+    queue.put(reading(3, c=4))
+    (oldest, merged) = drain(queue)
+    assert oldest is first
+    assert merged.time == 3 and merged.fields == {"a": 2, "b": 2, "c": 4}
+    assert queue.coalesced == 2 and queue.dropped == 0
+
+
+def test_coalesce_drops_the_oldest_for_another_meter():
+    queue = TelegramQueue(2, COALESCE)
+    queue.put(reading(0, "main"))
+    queue.put(reading(1, "main"))
+    queue.put(reading(2, "solar"))
+    assert [(item.meter, item.time) for item in drain(queue)] == [("main", 1), ("solar", 2)]
+    assert queue.dropped == 1
+
+
+def test_coalesce_doesnt_change_a_shared_telegram():
+    queue = TelegramQueue(1, COALESCE)
+    shared = reading(0, a=1)
+    queue.put(shared)
+    queue.put(reading(1, a=2))
+    assert shared.fields == {"a": 1}
+
+
+def test_worker_retries_then_fails():
+    calls = []
+
+    def handler(telegram):
+        calls.append(telegram)
+        raise OSError("down")
+
+    worker = SinkWorker("sink", handler, TelegramQueue(10), retry_on=(OSError,), attempts=3, backoff=0)
+    worker.deliver(reading(0))
+    assert len(calls) == 3
+    assert worker.failed == 1 and worker.delivered == 0
+
+
+def test_worker_survives_an_unexpected_error():
+    def handler(telegram):
+        if telegram.time == 0:
+            raise KeyError("bug")
+
+    worker = SinkWorker("sink", handler, TelegramQueue(10), retry_on=(OSError,), backoff=0)
+    worker.deliver(reading(0))
+    worker.deliver(reading(1))
+    assert worker.failed == 1 and worker.delivered == 1
+
+
+def test_pipeline_stages_flush_and_stats():
+    delivered = []
+    done = threading.Event()
+
+    class Hold:
+        # holds every telegram until it is flushed
+        def __init__(self):
+            self.held = []
+
+        def __call__(self, telegram):
+            self.held.append(telegram)
+            return None
+
+        def flush(self):
+            held, self.held = self.held, []
+            return held
+
+        def stats(self):
+            return {"held": len(self.held)}
+
+    pipeline = Pipeline(10, DROP_OLDEST)
+    pipeline.add_sink("direct", delivered.append)
+    hold = Hold()
+    pipeline.add_sink("held", lambda telegram: done.set(), stages=(hold,))
+    pipeline.put(reading(0))
+    pipeline.put(reading(1))
+    assert pipeline.stats()["held"]["held"] == 2
+
+    pipeline.start()
+    pipeline.stop(timeout=5)
+    assert [item.time for item in delivered] == [0, 1]
+    assert done.is_set()
+    assert pipeline.stats() == {
+        "direct": {"depth": 0, "dropped": 0, "coalesced": 0, "delivered": 2, "failed": 0},
+        "held": {"depth": 0, "dropped": 0, "coalesced": 0, "delivered": 2, "failed": 0, "held": 0},
+    }
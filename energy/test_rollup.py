@@ -0,0 +1,104 @@
+from datetime import datetime, timezone
+import pytest
+from pipeline import Reading
+from rollup import Rollup, period_start
+
+S = 1_000_000_000
+
+
+def at(text):
+    return int(datetime.fromisoformat(text).replace(tzinfo=timezone.utc).timestamp()) * S
+
+
+@pytest.fixture(name="state_path")
+def temporary_state(tmp_path):
+    return str(tmp_path / "rollup.json")
+
+
+def rollup(state_path):
+    return Rollup("rollup", {"location": "house"}, state_path, interval=3600, timezone=timezone.utc)
+
+
+def closed(points, period):
+    return {point["time"]: point["fields"] for point in points if point["tags"]["period"] == period}
+
+
+def test_period_start():
+    time = at("2024-03-15T13:45:10")
+    assert period_start("hour", time, timezone.utc) == at("2024-03-15T13:00:00")
+    assert period_start("day", time, timezone.utc) == at("2024-03-15T00:00:00")
+    assert period_start("month", time, timezone.utc) == at("2024-03-01T00:00:00")
+
+
+def test_a_delta_at_midnight_belongs_to_the_day_before(state_path):
+    store = rollup(state_path)
+    assert store.add(Reading("meter", {"meter_t1": 100.0}, at("2024-03-15T23:30:00"))) == []
+    assert store.add(Reading("meter", {"meter_t1": 100.5}, at("2024-03-16T00:00:00"))) == []
+
+    # the next telegram closes the hour and the day
+    points = store.add(Reading("meter", {"meter_t1": 100.75}, at("2024-03-16T00:00:10")))
+    assert closed(points, "hour")[at("2024-03-15T23:00:00")]["consumption_t1"] == 0.5
+    assert closed(points, "day")[at("2024-03-15T00:00:00")]["consumption"] == 0.5
+    assert not closed(points, "month")
+    assert store.meters["meter"]["periods"]["day"] == [at("2024-03-16T00:00:00"), {"consumption_t1": 0.25}]
+
+
+def test_tariffs_and_totals(state_path):
+    store = rollup(state_path)
+    first = {"meter_t1": 10.0, "meter_t2": 20.0, "meter_back_t1": 1.0}
+    store.add(Reading("meter", first, at("2024-03-15T10:00:01")))
+    second = {"meter_t1": 10.25, "meter_t2": 20.5, "meter_back_t1": 1.125}
+    store.add(Reading("meter", second, at("2024-03-15T10:30:00")))
+    (fields,) = closed(store.points(), "hour").values()
+    assert fields["consumption_t1"] == 0.25 and fields["consumption_t2"] == 0.5
+    assert fields["consumption"] == 0.75 and fields["return"] == 0.125
+
+
+def test_a_late_gas_reading_goes_into_the_open_hour(state_path):
+    store = rollup(state_path)
+    gas = {"gas_meter": 5.0, "gas_timestamp": at("2024-03-15T10:00:00") // S}
+    store.add(Reading("meter", gas, at("2024-03-15T10:00:05")))
+    store.add(Reading("meter", {}, at("2024-03-15T11:00:05")))
+    # captured at 11:00 for the hour before, it arrives when 10:00 is closed
+    gas = {"gas_meter": 5.25, "gas_timestamp": at("2024-03-15T11:00:00") // S}
+    points = store.add(Reading("meter", gas, at("2024-03-15T11:00:10")))
+    assert points == []
+    assert store.meters["meter"]["periods"]["hour"] == [at("2024-03-15T11:00:00"), {"gas": 0.25}]
+
+
+def test_a_counter_reset_is_skipped(state_path):
+    store = rollup(state_path)
+    store.add(Reading("meter", {"meter_t1": 500.0}, at("2024-03-15T10:00:01")))
+    store.add(Reading("meter", {"meter_t1": 0.5}, at("2024-03-15T10:10:00")))
+    store.add(Reading("meter", {"meter_t1": 1.0}, at("2024-03-15T10:20:00")))
+    assert store.resets == 1
+    assert closed(store.points(), "hour")[at("2024-03-15T10:00:00")]["consumption_t1"] == 0.5
+
+
+def test_open_periods_every_interval(state_path):
+    store = rollup(state_path)
+    store.add(Reading("meter", {"meter_t1": 1.0}, at("2024-03-15T10:00:01")))
+    assert store.add(Reading("meter", {"meter_t1": 1.5}, at("2024-03-15T10:59:00"))) == []
+    points = store.add(Reading("meter", {"meter_t1": 2.0}, at("2024-03-15T11:00:01")))
+    # the closed hour, then all open periods
+    assert [point["tags"]["period"] for point in points] == ["hour", "hour", "day", "month"]
+
+
+def test_checkpoint_continues_after_a_restart(state_path):
+    store = rollup(state_path)
+    store.add(Reading("meter", {"meter_t1": 1.0}, at("2024-03-15T10:00:01")))
+    store.add(Reading("meter", {"meter_t1": 1.5}, at("2024-03-15T10:10:00")))
+    store.checkpoint()
+    # handled after the checkpoint, counted again after the restart
+    store.add(Reading("meter", {"meter_t1": 1.75}, at("2024-03-15T10:20:00")))
+
+    store = rollup(state_path)
+    store.add(Reading("meter", {"meter_t1": 1.75}, at("2024-03-15T10:20:00")))
+    store.add(Reading("meter", {"meter_t1": 2.0}, at("2024-03-15T10:30:00")))
+    assert closed(store.points(), "hour")[at("2024-03-15T10:00:00")]["consumption_t1"] == 1.0
+
+
+def test_a_broken_checkpoint_starts_over(state_path):
+    with open(state_path, "w", encoding="utf-8") as f:
+        f.write('{"meter": {"counters"')
+    assert rollup(state_path).meters == {}
@@ -0,0 +1,49 @@
+from pipeline import Reading
+from suppress import ChangeSuppressor
+
+S = 1_000_000_000
+
+
+def reading(second, meter="main", **fields):
+    return Reading(meter, fields, second * S)
+
+
+def test_unchanged_fields_are_suppressed():
+    suppress = ChangeSuppressor(heartbeat=300)
+    assert suppress(reading(0, meter_t1=1.0, version_info=42)).fields == {"meter_t1": 1.0, "version_info": 42}
+    assert suppress(reading(1, meter_t1=1.1, version_info=42)).fields == {"meter_t1": 1.1}
+    assert suppress.stats() == {"passed": 3, "suppressed": 1}
+
+
+def test_a_change_always_passes():
+    suppress = ChangeSuppressor(heartbeat=300)
+    values = [1, 2, 1, 1, 3, 2]
+    passed = [suppress(reading(second, value=value)) for second, value in enumerate(values)]
+    assert [r.fields["value"] if r else None for r in passed] == [1, 2, 1, None, 3, 2]
+
+
+def test_a_reading_without_changed_fields_is_dropped():
+    suppress = ChangeSuppressor(heartbeat=300)
+    suppress(reading(0, gas_meter=5.0))
+    assert suppress(reading(1, gas_meter=5.0)) is None
+
+
+def test_heartbeat_on_telegram_time():
+    suppress = ChangeSuppressor(heartbeat=10)
+    suppress(reading(0, gas_meter=5.0))
+    assert suppress(reading(9, gas_meter=5.0)) is None
+    assert suppress(reading(10, gas_meter=5.0)).fields == {"gas_meter": 5.0}
+    # the heartbeat starts again from the last value passed on
+    assert suppress(reading(19, gas_meter=5.0)) is None
+
+
+def test_only_the_listed_fields_are_suppressed():
+    suppress = ChangeSuppressor(heartbeat=300, fields={"version_info"})
+    suppress(reading(0, version_info=42, meter_t1=1.0))
+    assert suppress(reading(1, version_info=42, meter_t1=1.0)).fields == {"meter_t1": 1.0}
+
+
+def test_meters_are_suppressed_separately():
+    suppress = ChangeSuppressor(heartbeat=300)
+    suppress(reading(0, "main", meter_t1=1.0))
+    assert suppress(reading(1, "solar", meter_t1=1.0)).fields == {"meter_t1": 1.0}
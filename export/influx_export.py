@@ -0,0 +1,373 @@
+# Export of the InfluxDB history to columnar files
+#
+# Exports every measurement of every retention policy of the energy, climate
+# and flora databases to compressed files, one directory per day (UTC):
+#
+#   <out>/<database>/<retention policy>/<measurement>/day=2024-01-31/part-<start>.parquet
+#
+# with a `time` column and a column per tag and field. The history is queried
+# in windows of --window minutes and every window is appended to the file of
+# its day, so memory only holds one window no matter how much is exported.
+# Parquet and Arrow IPC (zstd) need pyarrow, without it --format csv writes
+# gzipped CSV files.
+#
+# The export runs up to the start of the current day, or --end. The end of
+# every exported day is the watermark of its measurement in --state, the next
+# export starts there, and the state has the number of exported values per
+# field of every day.
+#
+# With --delete-after N the points older than N days are deleted from
+# InfluxDB, but never points after a watermark. A DELETE removes the points
+# of every retention policy, so first the values per day of every retention
+# policy are counted again: a day with late points, from a replay of the
+# outbox, a reprocess or an import, is exported again and only the days that
+# still match their export are deleted.
+#
+# usage: python influx_export.py --out /mnt/history [--database climate] [--format parquet] [--delete-after 90]
+import os
+import csv
+import gzip
+import json
+import time
+import argparse
+import logging
+from datetime import datetime, timedelta, timezone
+from influxdb import InfluxDBClient
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Configure InfluxDB connection variables
+influx_host = os.getenv("INFLUXDB_HOST", "localhost")
+influx_port = int(os.getenv("INFLUXDB_PORT", "8086"))
+influx_user = os.getenv("INFLUXDB_USER", "user")
+influx_password = os.getenv("INFLUXDB_PASSWORD", "")
+databases = [
+    os.getenv("INFLUXDB_ENERGY_DATABASE", "energy"),
+    os.getenv("INFLUXDB_CLIMATE_DATABASE", "climate"),
+    os.getenv("INFLUXDB_FLORA_DATABASE", "flora"),
+]
+
+FORMATS = {"parquet": ".parquet", "arrow": ".arrow", "csv": ".csv.gz"}
+
+logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
+log = logging.getLogger("root")
+
+
+def arrow_type(influx_type):
+    return {
+        "float": pyarrow.float64(),
+        "integer": pyarrow.int64(),
+        "string": pyarrow.string(),
+        "boolean": pyarrow.bool_(),
+    }[influx_type]
+
+
+def columns(client, database, rp, measurement):
+    # the tags and the fields with their type of a measurement
+    source = f'"{rp}"."{measurement}"'
+    tags = [row["tagKey"] for row in client.query(f"SHOW TAG KEYS FROM {source}", database=database).get_points()]
+    fields = {}
+    for row in client.query(f"SHOW FIELD KEYS FROM {source}", database=database).get_points():
+        # a field can have another type in an older shard, the first one wins
+        if row["fieldKey"] not in tags:
+            fields.setdefault(row["fieldKey"], row["fieldType"])
+    return tags, fields
+
+
+class ArrowWriter:
+    """
+    Writes the windows of a day as record batches of one Parquet or Arrow
+    IPC file. A value that doesn't fit the type of its column is left out.
+    """
+
+    def __init__(self, path, file_format, tags, fields):
+        if pyarrow is None:
+            raise SystemExit(f"--format {file_format} needs pyarrow, install it or use --format csv")
+        self.schema = pyarrow.schema(
+            [pyarrow.field("time", pyarrow.timestamp("ns", tz="UTC"))]
+            + [pyarrow.field(tag, pyarrow.string()) for tag in tags]
+            + [pyarrow.field(field, arrow_type(field_type)) for field, field_type in fields.items()]
+        )
+        if file_format == "parquet":
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression="zstd")
+        else:
+            options = pyarrow.ipc.IpcWriteOptions(compression="zstd")
+            self.writer = pyarrow.ipc.new_file(path, self.schema, options=options)
+
+    def write(self, rows):
+        arrays = []
+        for column in self.schema:
+            values = [row.get(column.name) for row in rows]
+            try:
+                arrays.append(pyarrow.array(values, type=column.type))
+            except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+                arrays.append(pyarrow.array([self.value(v, column.type) for v in values], type=column.type))
+        self.writer.write_batch(pyarrow.record_batch(arrays, schema=self.schema))
+
+    @staticmethod
+    def value(value, column_type):
+        try:
+            pyarrow.scalar(value, type=column_type)
+            return value
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            return None
+
+    def close(self):
+        self.writer.close()
+
+
+class CsvWriter:
+    """
+    Writes the windows of a day to a gzipped CSV file, the time in
+    nanoseconds since epoch.
+    """
+
+    def __init__(self, path, _file_format, tags, fields):
+        self.file = gzip.open(path, "wt", encoding="utf-8", newline="")
+        self.writer = csv.DictWriter(self.file, ["time", *tags, *fields], extrasaction="ignore")
+        self.writer.writeheader()
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+def days(start, end):
+    # (start, end) of every day, or part of a day, from start to end
+    while start < end:
+        stop = min(datetime.combine(start.date() + timedelta(days=1), datetime.min.time(), timezone.utc), end)
+        yield start, stop
+        start = stop
+
+
+def midnight(moment):
+    return datetime.combine(moment.date(), datetime.min.time(), timezone.utc)
+
+
+def first_time(client, database, rp, measurement):
+    # the time of the oldest point of a measurement, None when it is empty
+    result = client.query(f'SELECT * FROM "{rp}"."{measurement}" LIMIT 1', database=database, epoch="s")
+    for point in result.get_points():
+        return datetime.fromtimestamp(point["time"], timezone.utc)
+    return None
+
+
+def influx_counts(client, database, rp, measurement, start, end):
+    # the number of values per field of every day from start to end in InfluxDB
+    query = (
+        f'SELECT COUNT(*) FROM "{rp}"."{measurement}" '
+        f"WHERE time >= '{start.isoformat()}' AND time < '{end.isoformat()}' GROUP BY time(1d) fill(none)"
+    )
+    counts = {}
+    for row in client.query(query, database=database, epoch="s").get_points():
+        day = datetime.fromtimestamp(row.pop("time"), timezone.utc).date().isoformat()
+        counts[day] = {column[len("count_") :]: count for column, count in row.items() if count}
+    return counts
+
+
+def export_day(client, database, rp, measurement, start, end, tags, fields, args):
+    # the number of points from start to end, written to the file of their day,
+    # and the number of values per field
+    directory = os.path.join(args.out, database, rp, measurement, f"day={start.date().isoformat()}")
+    os.makedirs(directory, exist_ok=True)
+    name = f"part-{start.strftime('%H%M%S')}{FORMATS[args.format]}"
+    path = os.path.join(directory, name)
+    temp = path + ".tmp"
+    whole_day = start == midnight(start) and end == start + timedelta(days=1)
+
+    writer = None
+    points = 0
+    counts = {}
+    window = timedelta(minutes=args.window)
+    try:
+        while start < end:
+            stop = min(start + window, end)
+            query = (
+                f'SELECT * FROM "{rp}"."{measurement}" '
+                f"WHERE time >= '{start.isoformat()}' AND time < '{stop.isoformat()}'"
+            )
+            rows = list(client.query(query, database=database, epoch="ns").get_points())
+            if rows:
+                if writer is None:
+                    writer_class = CsvWriter if args.format == "csv" else ArrowWriter
+                    writer = writer_class(temp, args.format, tags, fields)
+                writer.write(rows)
+                points += len(rows)
+                for row in rows:
+                    for column, value in row.items():
+                        if value is not None and column != "time" and column not in tags:
+                            counts[column] = counts.get(column, 0) + 1
+            start = stop
+    except BaseException:
+        if writer is not None:
+            writer.close()
+            os.remove(temp)
+        raise
+
+    if writer is not None:
+        writer.close()
+        # an export of the same day again replaces the file
+        os.replace(temp, path)
+    if whole_day:
+        # the whole day replaces the parts of earlier exports
+        for other in os.listdir(directory):
+            if other.startswith("part-") and other != name:
+                os.remove(os.path.join(directory, other))
+    return points, counts
+
+
+def export(client, database, rp, measurement, end, state, args):
+    key = f"{database}/{rp}/{measurement}"
+    if key in state:
+        start = datetime.fromtimestamp(state[key]["watermark"], timezone.utc)
+    elif args.start:
+        start = args.start
+    else:
+        start = first_time(client, database, rp, measurement)
+        if start is None:
+            return 0
+    if start >= end:
+        return 0
+
+    tags, fields = columns(client, database, rp, measurement)
+    total = 0
+    for day_start, day_end in days(start, end):
+        started = time.monotonic()
+        points, counts = export_day(client, database, rp, measurement, day_start, day_end, tags, fields, args)
+        total += points
+        exported = state.setdefault(key, {"watermark": None, "days": {}})
+        exported["watermark"] = day_end.timestamp()
+        day = day_start.date().isoformat()
+        if day_start.time() != datetime.min.time():
+            # the rest of a day that was exported in part before
+            for field, count in exported["days"].get(day, {}).items():
+                counts[field] = counts.get(field, 0) + count
+        if counts:
+            exported["days"][day] = counts
+        else:
+            exported["days"].pop(day, None)
+        checkpoint(args.state, state)
+
+        elapsed = time.monotonic() - started
+        log.info(
+            "%s: %s, %d points (%.0f points/s)",
+            key,
+            day_start.date(),
+            points,
+            points / elapsed if elapsed else 0,
+        )
+    return total
+
+
+def verified(client, database, rp, measurement, before, state, args):
+    # the start of the first day before `before` with points that aren't
+    # exported, `before` when all of them are
+    key = f"{database}/{rp}/{measurement}"
+    first = first_time(client, database, rp, measurement)
+    if first is None or first >= before:
+        return before
+    if key not in state:
+        log.warning("%s isn't exported, the points from %s aren't deleted", key, first.date())
+        return midnight(first)
+    exported = state[key]
+    tags = None
+    for day, counts in sorted(influx_counts(client, database, rp, measurement, midnight(first), before).items()):
+        if counts == exported["days"].get(day):
+            continue
+        start = datetime.fromisoformat(day).replace(tzinfo=timezone.utc)
+        log.info("%s: %s has points that aren't exported, export the day again", key, day)
+        if tags is None:
+            tags, fields = columns(client, database, rp, measurement)
+        _, exported["days"][day] = export_day(
+            client, database, rp, measurement, start, start + timedelta(days=1), tags, fields, args
+        )
+        checkpoint(args.state, state)
+        if exported["days"][day] != counts:
+            log.warning("%s: %s changed during its export, the points from that day aren't deleted", key, day)
+            return start
+    return before
+
+
+def delete(client, database, rps, measurement, state, args):
+    # a DELETE has no retention policy, every one of them must be exported up to `before`
+    keys = [f"{database}/{rp}/{measurement}" for rp in rps]
+    watermarks = [state[key]["watermark"] for key in keys if key in state]
+    if not watermarks:
+        return
+    before = midnight(
+        min(
+            datetime.now(timezone.utc) - timedelta(days=args.delete_after),
+            datetime.fromtimestamp(min(watermarks), timezone.utc),
+        )
+    )
+    for rp in rps:
+        before = verified(client, database, rp, measurement, before, state, args)
+
+    log.info("%s/%s: delete the points before %s", database, measurement, before.isoformat())
+    if not args.dry_run:
+        client.query(f"DELETE FROM \"{measurement}\" WHERE time < '{before.isoformat()}'", database=database)
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def checkpoint(path, state):
+    temp = path + ".tmp"
+    with open(temp, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(temp, path)
+
+
+def utc(value):
+    moment = datetime.fromisoformat(value)
+    return moment.replace(tzinfo=timezone.utc) if moment.tzinfo is None else moment
+
+
+def main():
+    parser = argparse.ArgumentParser(description="export the InfluxDB history to columnar files per day")
+    parser.add_argument("--out", required=True, help="directory of the exported files")
+    parser.add_argument("--database", action="append", help="database, energy, climate and flora by default")
+    parser.add_argument("--measurement", action="append", help="measurement, all measurements by default")
+    parser.add_argument("--format", choices=FORMATS, default="parquet" if pyarrow else "csv")
+    parser.add_argument("--start", type=utc, help="start of a first export (UTC), the oldest point by default")
+    parser.add_argument("--end", type=utc, help="end of the export (UTC), the start of today by default")
+    parser.add_argument("--window", type=int, default=60, help="minutes per query")
+    parser.add_argument("--state", default="export.json", help="watermarks and counts of the exported measurements")
+    parser.add_argument("--delete-after", type=int, help="delete the exported points older than this many days")
+    parser.add_argument("--dry-run", action="store_true", help="export, but don't delete")
+    args = parser.parse_args()
+
+    end = args.end or datetime.combine(datetime.now(timezone.utc).date(), datetime.min.time(), timezone.utc)
+    state = load_state(args.state)
+    client = InfluxDBClient(influx_host, influx_port, influx_user, influx_password)
+
+    total = 0
+    started = time.monotonic()
+    for database in args.database or databases:
+        rps = [rp["name"] for rp in client.get_list_retention_policies(database)]
+        measurements = args.measurement or [
+            row["name"] for row in client.query("SHOW MEASUREMENTS", database=database).get_points()
+        ]
+        for measurement in measurements:
+            for rp in rps:
+                total += export(client, database, rp, measurement, end, state, args)
+            if args.delete_after is not None:
+                delete(client, database, rps, measurement, state, args)
+
+    elapsed = time.monotonic() - started
+    log.info("exported %d points in %.0fs (%.0f points/s)", total, elapsed, total / elapsed if elapsed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+import os
+import re
+import csv
+import gzip
+import argparse
+from datetime import datetime, timedelta, timezone
+import pytest
+from influx_export import delete, export, load_state, midnight
+
+SELECT = re.compile(r'SELECT (\*|COUNT\(\*\)) FROM "(\w+)"\."(\w+)"(?: WHERE time >= \'(.+?)\' AND time < \'(.+?)\')?')
+DELETE = re.compile(r"DELETE FROM \"(\w+)\" WHERE time < '(.+?)'")
+
+
+class Result:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def get_points(self):
+        return iter(self.rows)
+
+
+class FakeInflux:
+    """
+    The queries of the export on points in memory, per retention policy and
+    measurement, with a `value` field and a `sensor` tag.
+    """
+
+    def __init__(self):
+        self.points = {}
+        self.deletes = []
+        self.on_select = None
+
+    def add(self, rp, moment, value, measurement="climate"):
+        self.points.setdefault((rp, measurement), []).append({"time": moment, "sensor": "esp", "value": value})
+
+    def query(self, query, database=None, epoch=None):
+        assert database == "climate"
+        if query.startswith("SHOW TAG KEYS"):
+            return Result([{"tagKey": "sensor"}])
+        if query.startswith("SHOW FIELD KEYS"):
+            return Result([{"fieldKey": "value", "fieldType": "float"}])
+        match = DELETE.match(query)
+        if match:
+            measurement, before = match[1], datetime.fromisoformat(match[2])
+            self.deletes.append(before)
+            for (_, m), points in self.points.items():
+                if m == measurement:
+                    points[:] = [p for p in points if p["time"] >= before]
+            return Result([])
+
+        select, rp, measurement, start, end = SELECT.match(query).groups()
+        points = sorted(self.points.get((rp, measurement), []), key=lambda p: p["time"])
+        if start is not None:
+            start, end = datetime.fromisoformat(start), datetime.fromisoformat(end)
+            points = [p for p in points if start <= p["time"] < end]
+        if select == "*":
+            if self.on_select is not None and start is not None:
+                self.on_select(start)
+            scale = 1_000_000_000 if epoch == "ns" else 1
+            rows = [{**p, "time": int(p["time"].timestamp()) * scale} for p in points]
+            return Result(rows[:1] if query.endswith("LIMIT 1") else rows)
+
+        counts = {}
+        for p in points:
+            counts[midnight(p["time"])] = counts.get(midnight(p["time"]), 0) + 1
+        return Result([{"time": int(day.timestamp()), "count_value": n} for day, n in sorted(counts.items())])
+
+
+# the exported days are relative to today, the deletes are relative to now
+TODAY = midnight(datetime.now(timezone.utc))
+
+
+def day(n, hour=12):
+    return TODAY - timedelta(days=n) + timedelta(hours=hour)
+
+
+@pytest.fixture(name="args")
+def fixture_args(tmp_path):
+    return argparse.Namespace(
+        out=str(tmp_path / "out"),
+        format="csv",
+        window=60,
+        start=None,
+        state=str(tmp_path / "export.json"),
+        delete_after=0,
+        dry_run=False,
+    )
+
+
+@pytest.fixture(name="influx")
+def fixture_influx():
+    influx = FakeInflux()
+    for n in (10, 9, 8):
+        influx.add("autogen", day(n), 1.0)
+    return influx
+
+
+def test_the_watermark_moves_forward(influx, args):
+    state = {}
+    assert export(influx, "climate", "autogen", "climate", TODAY - timedelta(days=8), state, args) == 2
+    exported = state["climate/autogen/climate"]
+    assert exported["watermark"] == (TODAY - timedelta(days=8)).timestamp()
+    assert sorted(exported["days"]) == [day(10).date().isoformat(), day(9).date().isoformat()]
+
+    # the next export starts at the watermark
+    assert export(influx, "climate", "autogen", "climate", TODAY, state, args) == 1
+    assert exported["watermark"] == TODAY.timestamp()
+    assert load_state(args.state) == state
+    assert export(influx, "climate", "autogen", "climate", TODAY, state, args) == 0
+
+
+def test_the_delete_stops_at_delete_after(influx, args):
+    state = {}
+    export(influx, "climate", "autogen", "climate", TODAY, state, args)
+    args.delete_after = 9
+    delete(influx, "climate", ["autogen"], "climate", state, args)
+    assert influx.deletes == [midnight(datetime.now(timezone.utc) - timedelta(days=9))]
+    assert [p["time"] for p in influx.points[("autogen", "climate")]] == [day(9), day(8)]
+
+
+def test_the_delete_stops_at_the_lowest_watermark(influx, args):
+    influx.add("year", day(10), 2.0)
+    state = {}
+    export(influx, "climate", "autogen", "climate", TODAY, state, args)
+    export(influx, "climate", "year", "climate", TODAY - timedelta(days=9), state, args)
+    delete(influx, "climate", ["autogen", "year"], "climate", state, args)
+    assert influx.deletes == [TODAY - timedelta(days=9)]
+
+
+def test_late_points_are_exported_again_before_the_delete(influx, args):
+    state = {}
+    export(influx, "climate", "autogen", "climate", TODAY, state, args)
+    # before the oldest point of the first export, its first day was exported from 12:00
+    influx.add("autogen", day(10, hour=6), 5.0)
+    delete(influx, "climate", ["autogen"], "climate", state, args)
+
+    assert state["climate/autogen/climate"]["days"][day(10).date().isoformat()] == {"value": 2}
+    assert load_state(args.state) == state
+    directory = os.path.join(args.out, "climate", "autogen", "climate", f"day={day(10).date().isoformat()}")
+    # the whole day replaces the part of the first export
+    assert os.listdir(directory) == ["part-000000.csv.gz"]
+    with gzip.open(os.path.join(directory, "part-000000.csv.gz"), "rt", encoding="utf-8") as f:
+        assert [row["value"] for row in csv.DictReader(f)] == ["5.0", "1.0"]
+    assert influx.deletes == [TODAY]
+    assert not influx.points[("autogen", "climate")]
+
+
+def test_no_delete_when_a_day_changes_during_its_export(influx, args):
+    state = {}
+    export(influx, "climate", "autogen", "climate", TODAY, state, args)
+    influx.add("autogen", day(9, hour=18), 5.0)
+
+    def late_point(start):
+        # another late point while the day is exported again
+        if start == day(9, hour=0):
+            influx.add("autogen", day(9, hour=22), 6.0)
+
+    influx.on_select = late_point
+    delete(influx, "climate", ["autogen"], "climate", state, args)
+    # only the day before is deleted
+    assert influx.deletes == [TODAY - timedelta(days=9)]
+    assert [p["time"] for p in influx.points[("autogen", "climate")]] == [
+        day(9),
+        day(8),
+        day(9, hour=18),
+        day(9, hour=22),
+    ]
+
+
+def test_no_delete_of_a_retention_policy_that_isnt_exported(influx, args):
+    influx.add("year", day(10), 2.0)
+    state = {}
+    export(influx, "climate", "autogen", "climate", TODAY, state, args)
+    delete(influx, "climate", ["autogen", "year"], "climate", state, args)
+    assert influx.deletes == [TODAY - timedelta(days=10)]
+    assert len(influx.points[("autogen", "climate")]) == 3
+
+
+def test_dry_run(influx, args):
+    state = {}
+    export(influx, "climate", "autogen", "climate", TODAY, state, args)
+    args.dry_run = True
+    delete(influx, "climate", ["autogen"], "climate", state, args)
+    assert not influx.deletes
@@ -0,0 +1 @@
+../storage/field_types.py
\ No newline at end of file
@@ -1,14 +1,20 @@
 import os
 import sys
 import time
+import sqlite3
+import signal
 import json
 import logging
 from logging.handlers import RotatingFileHandler
-from datetime import datetime
 from dotenv import load_dotenv
 import paho.mqtt.client as mqtt
 from influxdb import InfluxDBClient
-from influxdb.exceptions import InfluxDBClientError 
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from local_store import LocalStore
+from workers import MessageWorkers
+from routing import Router, load_routes
+from field_types import FieldTypes
+from watering import WateringDetector
 
 
 env_file = os.getenv("ENV_FILE", "./config/config.env")
@@ -29,8 +35,49 @@ influx_user = os.getenv("INFLUXDB_USER", "user")
 influx_password = os.getenv("INFLUXDB_PASSWORD", "")
 influx_db = os.getenv("INFLUXDB_FLORA_DATABASE", "flora")
 
+# influxdb, or sqlite to store the points in STORAGE_DIR/<database>.db with
+# local_store.py, the tables of days older than STORAGE_RETENTION_DAYS are dropped
+storage_backend = os.getenv("STORAGE_BACKEND", "influxdb")
+storage_dir = os.getenv("STORAGE_DIR", "data")
+storage_retention_days = int(os.getenv("STORAGE_RETENTION_DAYS", "0"))
+
 location = os.getenv("LOCATION", "house")
 
+# values that don't fit the type of their field are written to this measurement
+quarantine_measurement = os.getenv("FLORA_QUARANTINE_MEASUREMENT", "quarantine")
+
+# a watering is a moisture FLORA_WATERING_THRESHOLD above the lowest moisture of
+# the last FLORA_WATERING_WINDOW seconds, checkpointed to FLORA_WATERING_STATE, like
+# /var/lib/flora/watering.json, every FLORA_WATERING_CHECKPOINT_INTERVAL seconds,
+# disabled when empty
+watering_state = os.getenv("FLORA_WATERING_STATE", "")
+watering_window = int(os.getenv("FLORA_WATERING_WINDOW", "7200"))
+watering_threshold = float(os.getenv("FLORA_WATERING_THRESHOLD", "1.5"))
+watering_checkpoint_interval = int(os.getenv("FLORA_WATERING_CHECKPOINT_INTERVAL", "60"))
+
+# join the shared subscription `$share/<group>/FLORA_TOPIC/#` so several
+# processes split the messages, empty to get all messages in this process;
+# the watering state is kept per process, so it can't be used with FLORA_WATERING_STATE
+share_group = os.getenv("FLORA_SHARE_GROUP", "")
+
+# messages are stored by FLORA_WORKERS threads, every worker queues at most
+# FLORA_QUEUE_SIZE messages and drops the oldest when full
+workers = int(os.getenv("FLORA_WORKERS", "2"))
+queue_size = int(os.getenv("FLORA_QUEUE_SIZE", "1000"))
+stats_interval = int(os.getenv("FLORA_STATS_INTERVAL", "300"))
+
+# per-plant: a measurement per plant with all fields of the message
+# single: one `flora` measurement with the plant and sensor as tags and only numeric fields
+schema = os.getenv("FLORA_SCHEMA", "per-plant")
+SCHEMAS = {"per-plant": "routes.json", "single": "routes-flora.json"}
+if schema not in SCHEMAS:
+    raise ValueError(f"unknown FLORA_SCHEMA '{schema}', use one of {tuple(SCHEMAS)}")
+
+# routing table of the devices to their measurements, see routing.py
+routes_file = os.getenv(
+    "FLORA_ROUTES", os.path.join(os.path.dirname(os.path.abspath(__file__)), SCHEMAS[schema])
+)
+
 # Configure logging
 log_dir = os.path.join(os.getenv("LOG_DIR", "/var/log"), "flora-persists.log")
 log_handler = RotatingFileHandler(log_dir, maxBytes=5*1024*1024,backupCount=2)
@@ -43,95 +90,129 @@ log.setLevel(logging.INFO)
 log.addHandler(log_handler)
 log.addHandler(logging.StreamHandler())
 
+router = Router(load_routes(routes_file), {"location": location}, stats_interval)
+field_types = FieldTypes(quarantine_measurement)
+watering = None
+if watering_state:
+    if share_group:
+        # a process of the group doesn't see every sample of a plant to detect a watering
+        raise ValueError("FLORA_SHARE_GROUP can't be used with FLORA_WATERING_STATE, set it empty")
+    watering = WateringDetector(
+        watering_state,
+        watering_window,
+        watering_threshold,
+        tags={"location": location},
+        checkpoint_interval=watering_checkpoint_interval,
+    )
+
 # The callback for when the client receives a CONNACK response from the server.
-def on_connect(client, _userdata, _flags, rc):
+def on_connect(client, _userdata, _flags, rc, _properties=None):
     log.info("connected with result code: '%s'", mqtt.connack_string(rc))
 
     # Subscribing in on_connect() means that if we lose the connection and
     # reconnect then subscriptions will be renewed.
     topic = f"{mqtt_topic}/#"
+    if share_group:
+        # the broker hands every message to one member of the group, the
+        # workers in this process still keep the messages of a device in order
+        topic = f"$share/{share_group}/{topic}"
+    log.info("subscribe to %s", topic)
     client.subscribe(topic)
 
-# The callback for when a PUBLISH message is received from the server.
-def on_message(_client, _userdata, msg):
-    try:
-        device = msg.topic[len(mqtt_topic)+1:]
-        message = json.loads(msg.payload.decode("utf-8"))
+def detect_watering(data):
+    # the watering point when the moisture of the plant jumped
+    moisture = data['fields'].get('moisture')
+    plant = data['tags'].get('plant') or data['tags'].get('node')
+    if watering is None or plant is None or not isinstance(moisture, (int, float)):
+        return None
+    return watering.add(plant, data.get('time') or time.time_ns(), moisture)
 
-        if device == 'esp-flora':
-            data = {
-                'measurement': 'lemon-dracaena',
-                'tags': {
-                    'location': location,
-                     'node': 'lemon-dracaena',
-                     'sensor': 'esp'
-                },
-                'fields': {
-                    'plant': 'lemon-dracaena',
-                    'temperature': round(float(message['temperature']), 1),
-                    'time': datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')
-                }
-            }
-            if message['moisture'] <= 100:
-                data['fields']['moisture'] = round(float(message['moisture']), 1)
-            else:
-                data['fields']['moisture_raw'] = int(message['moisture'])
-                log.warning("ignoring moisture value %s for device=%s", message['moisture'], device)
-
-        elif 'plant' in message:
-            data = {
-                'measurement': message['plant'],
-                'tags': {
-                    'location': location,
-                     'node': message['plant'],
-                     'sensor': message['sensor']
-                },
-                'fields': message
-            }
-        else:
-            log.error("failed to handle update for device=%s, message='%s'", device, message)
+def handle(device, message, retained):
+    # runs on a worker thread
+    try:
+        data = router.route(device, message, retained)
+        if data is None:
             return
 
         log.info("received update for device=%s, data='%s'", device, data)
 
-        # Send the JSON data to InfluxDB
-        successful = dbclient.write_points([data])
+        # Send the JSON data to InfluxDB, with the values that don't fit their field quarantined
+        points = field_types.check(data)
+        event = detect_watering(data)
+        if event is not None:
+            points.append(event)
+        successful = dbclient.write_points(points)
         if not successful:
             log.error("failed to write to db for '%s': '%s'", device, data)
+        elif event is not None:
+            watering.written(event)
+        if watering is not None:
+            watering.checkpoint()
 
-    except (ValueError, KeyError, json.JSONDecodeError, InfluxDBClientError) as e:
+    except (ValueError, KeyError, TypeError, InfluxDBClientError, InfluxDBServerError, OSError, sqlite3.Error) as e:
         log.error("failed to write to db", exc_info=e)
 
+# The callback for when a PUBLISH message is received from the server.
+def on_message(_client, _userdata, msg):
+    try:
+        device = msg.topic[len(mqtt_topic)+1:]
+        message = json.loads(msg.payload.decode("utf-8"))
+        # hand over to the workers, the network loop must not wait for InfluxDB
+        message_workers.put(device, message, msg.retain)
+
+    except (ValueError, json.JSONDecodeError) as e:
+        log.error("failed to decode message on '%s'", msg.topic, exc_info=e)
+
 
 ########################
 # Main
 ########################
 if "__main__" == __name__:
     log.info("starting flora persist service")
-    # Set up a client for InfluxDB
-    while True:
-        try:
-            # Create the InfluxDB client object
-            dbclient = InfluxDBClient(
-                influx_host, influx_port, influx_user, influx_password, influx_db
-            )
-            break
-        except ConnectionError:
-            log.exception("failed to connect to influx")
-            time.sleep(120)
-
-    mqtt_client = mqtt.Client()
+    if storage_backend == "sqlite":
+        dbclient = LocalStore(os.path.join(storage_dir, f"{influx_db}.db"), retention_days=storage_retention_days)
+    else:
+        # Set up a client for InfluxDB
+        while True:
+            try:
+                # Create the InfluxDB client object
+                dbclient = InfluxDBClient(
+                    influx_host, influx_port, influx_user, influx_password, influx_db
+                )
+                break
+            except ConnectionError:
+                log.exception("failed to connect to influx")
+                time.sleep(120)
+
+        field_types.load(dbclient, influx_db)
+    message_workers = MessageWorkers(handle, workers, queue_size, stats_interval)
+    message_workers.start()
+
+    # shared subscriptions are part of MQTT 5
+    mqtt_client = mqtt.Client(protocol=mqtt.MQTTv5 if share_group else mqtt.MQTTv311)
     mqtt_client.on_connect = on_connect
     mqtt_client.on_message = on_message
     if mqtt_user:
         mqtt_client.username_pw_set(mqtt_user, mqtt_pass)
 
     mqtt_client.connect(mqtt_broker, mqtt_port, mqtt_timeout)
-    
+
+    # stop on SIGTERM like on ctrl-c, so the queues are drained
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
     # Blocking call that processes network traffic, dispatches callbacks and
     # handles reconnecting.
     # Other loop*() functions are available that give a threaded interface and a
     # manual interface.
-    mqtt_client.loop_forever()
+    try:
+        mqtt_client.loop_forever()
+    except KeyboardInterrupt:
+        log.info("flora persist service stopped")
+    finally:
+        mqtt_client.disconnect()
+        message_workers.stop()
+        if watering is not None:
+            watering.checkpoint(force=True)
+        log.info("routing stats: %s, field types: %s", router.stats(), field_types.stats())
 
     sys.exit()
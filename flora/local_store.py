@@ -0,0 +1 @@
+../storage/local_store.py
\ No newline at end of file
@@ -0,0 +1,133 @@
+# Migrate the per-plant measurements to the single flora measurement
+#
+# Copies the history of every plant measurement, in chunks of --chunk days, to
+# the `flora` measurement of FLORA_SCHEMA=single: the plant and the sensor are
+# tags and only the numeric fields are kept, as floats. The points keep their
+# time, so copying a range again overwrites it, and an interrupted migration
+# continues with --start.
+#
+# usage: python migrate_schema.py [--plant cactus] [--start 2023-01-01] [--chunk 7] [--dry-run]
+import os
+import time
+import argparse
+import logging
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+from influxdb import InfluxDBClient
+
+env_file = os.getenv("ENV_FILE", "./config/config.env")
+load_dotenv(env_file)
+
+# Configure InfluxDB connection variables
+influx_host = os.getenv("INFLUXDB_HOST", "localhost")
+influx_port = int(os.getenv("INFLUXDB_PORT", "8086"))
+influx_user = os.getenv("INFLUXDB_USER", "user")
+influx_password = os.getenv("INFLUXDB_PASSWORD", "")
+influx_db = os.getenv("INFLUXDB_FLORA_DATABASE", "flora")
+
+location = os.getenv("LOCATION", "house")
+
+# measurements that aren't plants
+NOT_PLANTS = {"flora", "watering", "quarantine"}
+
+logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
+log = logging.getLogger("root")
+
+
+def first_time(client, measurement):
+    # the time of the oldest point of a measurement, None when it is empty
+    result = client.query(f'SELECT * FROM "{measurement}" LIMIT 1', epoch="s")
+    for point in result.get_points():
+        return datetime.fromtimestamp(point["time"], timezone.utc)
+    return None
+
+
+def convert(measurement, tags, rows, target):
+    tags = tags or {}
+    tags = {
+        "location": tags.get("location") or location,
+        "plant": tags.get("node") or measurement,
+        "sensor": tags.get("sensor") or "unknown",
+    }
+    points = []
+    for row in rows:
+        fields = {
+            field: float(value)
+            for field, value in row.items()
+            if field != "time" and isinstance(value, (int, float)) and not isinstance(value, bool)
+        }
+        if fields:
+            points.append(
+                {
+                    "measurement": target,
+                    "tags": tags,
+                    "time": row["time"],
+                    "fields": fields,
+                }
+            )
+    return points
+
+
+def migrate(client, measurement, start, end, args):
+    copied = 0
+    chunk = timedelta(days=args.chunk)
+    while start < end:
+        stop = min(start + chunk, end)
+        started = time.monotonic()
+        query = (
+            f'SELECT * FROM "{measurement}" '
+            f"WHERE time >= '{start.isoformat()}' AND time < '{stop.isoformat()}' GROUP BY *"
+        )
+        result = client.query(query, epoch="ns")
+        points = []
+        for (_, tags), rows in result.items():
+            points.extend(convert(measurement, tags, rows, args.measurement))
+        if points and not args.dry_run:
+            client.write_points(points, batch_size=args.batch_size)
+        copied += len(points)
+
+        elapsed = time.monotonic() - started
+        log.info(
+            "%s: %s to %s, %d points (%.0f points/s)",
+            measurement,
+            start.date(),
+            stop.date(),
+            len(points),
+            len(points) / elapsed if elapsed else 0,
+        )
+        start = stop
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="copy the per-plant flora measurements to one measurement")
+    parser.add_argument("--plant", action="append", help="plant measurement, all plants by default")
+    parser.add_argument(
+        "--start", type=datetime.fromisoformat, help="start of the copy (UTC), the oldest point by default"
+    )
+    parser.add_argument("--chunk", type=int, default=7, help="days per query")
+    parser.add_argument("--measurement", default="flora", help="the single measurement")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--dry-run", action="store_true", help="read and convert only, don't write")
+    args = parser.parse_args()
+
+    client = InfluxDBClient(influx_host, influx_port, influx_user, influx_password, influx_db)
+    plants = args.plant or [
+        m["name"] for m in client.get_list_measurements() if m["name"] not in NOT_PLANTS | {args.measurement}
+    ]
+    end = datetime.now(timezone.utc)
+
+    total = 0
+    started = time.monotonic()
+    for plant in plants:
+        start = args.start.replace(tzinfo=timezone.utc) if args.start else first_time(client, plant)
+        if start is None:
+            log.info("%s: no points", plant)
+            continue
+        total += migrate(client, plant, start, end, args)
+
+    log.info("copied %d points of %d plants in %.0fs", total, len(plants), time.monotonic() - started)
+
+
+if __name__ == "__main__":
+    main()
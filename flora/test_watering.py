@@ -0,0 +1,101 @@
+import json
+import threading
+import pytest
+from watering import WateringDetector
+
+S = 1_000_000_000
+
+
+@pytest.fixture(name="state_path")
+def temporary_state(tmp_path):
+    return str(tmp_path / "watering.json")
+
+
+def detector(state_path, **options):
+    return WateringDetector(state_path, window=3600, threshold=2, tags={"location": "house"}, **options)
+
+
+def test_a_jump_above_the_lowest_moisture_is_a_watering(state_path):
+    watering = detector(state_path)
+    assert watering.add("ficus", 1 * S, 20) is None
+    assert watering.add("ficus", 2 * S, 18) is None
+    assert watering.add("ficus", 3 * S, 19.5) is None
+    event = watering.add("ficus", 4 * S, 21)
+    assert event == {
+        "measurement": "watering",
+        "tags": {"location": "house", "plant": "ficus"},
+        "time": 4 * S,
+        "fields": {"moisture_before": 18.0, "moisture_after": 21.0, "jump": 3.0},
+    }
+
+
+def test_one_watering_is_one_event(state_path):
+    watering = detector(state_path)
+    watering.add("ficus", 1 * S, 18)
+    watering.written(watering.add("ficus", 2 * S, 25))
+    # the window starts over, the rise after the watering isn't another one
+    assert watering.add("ficus", 3 * S, 26) is None
+    assert watering.events == 1
+
+
+def test_a_watering_that_isnt_written_is_detected_again(state_path):
+    watering = detector(state_path)
+    watering.add("ficus", 1 * S, 18)
+    assert watering.add("ficus", 2 * S, 25) is not None
+    event = watering.add("ficus", 3 * S, 25.5)
+    assert event["time"] == 3 * S and event["fields"]["moisture_before"] == 18.0
+    assert watering.events == 0
+
+
+def test_samples_leave_the_window(state_path):
+    watering = detector(state_path)
+    watering.add("ficus", 0, 10)
+    assert watering.add("ficus", 3601 * S, 15) is None
+    assert watering.samples["ficus"] == [[3601 * S, 15]]
+
+
+def test_late_samples_and_plants(state_path):
+    watering = detector(state_path)
+    watering.add("ficus", 10 * S, 20)
+    assert watering.add("ficus", 5 * S, 10) is None
+    assert watering.add("ficus", 10 * S, 30) is None
+    # every plant has its own window
+    assert watering.add("cactus", 11 * S, 30) is None
+    assert watering.samples == {"ficus": [[10 * S, 20]], "cactus": [[11 * S, 30]]}
+
+
+def test_checkpoint_is_throttled_and_restores(state_path):
+    watering = detector(state_path, checkpoint_interval=3600)
+    watering.add("ficus", 1 * S, 18)
+    watering.checkpoint()
+    with pytest.raises(FileNotFoundError):
+        open(state_path, encoding="utf-8").close()
+
+    watering.checkpoint(force=True)
+    restarted = detector(state_path)
+    assert restarted.samples == {"ficus": [[1 * S, 18]]}
+    assert restarted.add("ficus", 2 * S, 21) is not None
+
+
+def test_concurrent_checkpoints_leave_valid_json(state_path):
+    watering = detector(state_path, checkpoint_interval=0)
+
+    def work(plant):
+        for i in range(200):
+            watering.add(plant, i * S, i % 3)
+            watering.checkpoint()
+
+    threads = [threading.Thread(target=work, args=(f"plant-{i}",)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    watering.checkpoint(force=True)
+    with open(state_path, encoding="utf-8") as f:
+        assert len(json.load(f)) == 4
+
+
+def test_a_broken_checkpoint_starts_over(state_path):
+    with open(state_path, "w", encoding="utf-8") as f:
+        f.write('{"ficus": [[1, ')
+    assert detector(state_path).samples == {}
@@ -0,0 +1,103 @@
+# Detection of waterings from the moisture of the plants
+#
+# Every plant has a rolling window of its moisture samples. A watering is a
+# sample that is at least `threshold` above the lowest moisture in the window,
+# it is written as a point to the watering measurement. Once that point is
+# written the window starts over from that sample, so one watering is one
+# event; when the write fails the next sample detects the watering again.
+#
+# The windows are checkpointed to a JSON file at most every
+# `checkpoint_interval` seconds, so a restart doesn't miss a watering that
+# started before it or report one again.
+import os
+import json
+import time
+import logging
+import threading
+
+log = logging.getLogger("root")
+
+
+class WateringDetector:
+
+    def __init__(
+        self, state_path, window=7200, threshold=1.5, measurement="watering", tags=None, checkpoint_interval=60
+    ):
+        self.state_path = state_path
+        self.checkpoint_interval = checkpoint_interval
+        self.window = window * 1_000_000_000
+        self.threshold = threshold
+        self.measurement = measurement
+        self.tags = tags or {}
+        # plant -> [[time, moisture], ...] in time order
+        self.samples = {}
+        self.lock = threading.Lock()
+        # the workers checkpoint one at a time, to the same temporary file
+        self.checkpoint_lock = threading.Lock()
+        self.last_checkpoint = time.monotonic()
+        self.events = 0
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                self.samples = json.load(f)
+            log.info("watering state of %d plants loaded from %s", len(self.samples), self.state_path)
+        except (OSError, ValueError) as e:
+            log.error("failed to load the watering state %s, start over", self.state_path, exc_info=e)
+
+    def checkpoint(self, force=False):
+        # at most every checkpoint_interval seconds, unless forced
+        with self.checkpoint_lock:
+            if not force and time.monotonic() - self.last_checkpoint < self.checkpoint_interval:
+                return
+            self.last_checkpoint = time.monotonic()
+            with self.lock:
+                state = json.dumps(self.samples)
+            temp = self.state_path + ".tmp"
+            try:
+                with open(temp, "w", encoding="utf-8") as f:
+                    f.write(state)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp, self.state_path)
+            except OSError as e:
+                log.error("failed to checkpoint the watering state to %s", self.state_path, exc_info=e)
+
+    def add(self, plant, time, moisture):
+        # the point of the watering when this sample is one, else None; call
+        # written() once the point is written
+        with self.lock:
+            samples = self.samples.setdefault(plant, [])
+            if samples and time <= samples[-1][0]:
+                # a replay or a late sample, the window only moves forward
+                return None
+            samples.append([time, moisture])
+            while samples[0][0] < time - self.window:
+                samples.pop(0)
+
+            lowest = min(value for _, value in samples)
+            if moisture - lowest < self.threshold:
+                return None
+
+        log.info("watering of %s detected, moisture from %s to %s", plant, lowest, moisture)
+        return {
+            "measurement": self.measurement,
+            "tags": {**self.tags, "plant": plant},
+            "time": time,
+            "fields": {
+                "moisture_before": float(lowest),
+                "moisture_after": float(moisture),
+                "jump": float(moisture - lowest),
+            },
+        }
+
+    def written(self, event):
+        # start the window of the plant over from the watering
+        plant = event["tags"]["plant"]
+        with self.lock:
+            samples = self.samples.get(plant, [])
+            self.samples[plant] = [sample for sample in samples if sample[0] >= event["time"]]
+            self.events += 1
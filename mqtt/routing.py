@@ -0,0 +1,247 @@
+# Routing of MQTT messages to InfluxDB points
+#
+# The routing table maps the device of a topic, the part after the base topic,
+# to the point to write. A device is routed by its exact name, else by the
+# longest prefix pattern like `esp*` that matches, else by the `*` route. The
+# routes are compiled once when the table is loaded and the route of a device
+# is cached, so a message never walks the whole table.
+#
+#   "esp*": {
+#     "format": "json",                    json: the payload has the fields
+#                                          point: the payload is the point itself
+#                                          regex: the groups of `pattern` are the fields
+#     "measurement": "{device}",
+#     "tags": {"location": "{location}", "sensor": "{device}"},
+#     "fields": {"humidity": "float"},     coercion per field: int, float, str or round:<digits>
+#     "only": false,                       true drops the fields without a coercion
+#     "numeric": false,                    true keeps only the numbers, as floats
+#     "set": {"time": "{now}"},            fields with a fixed value
+#     "limits": {"moisture": {"max": 100, "else": "moisture_raw"}},
+#     "required": ["plant"],
+#     "time": "time"                       field with the time of the message, the default
+#   }
+#
+# Measurement, tags and fixed fields can use {device}, {location}, {now} and
+# the fields of a json message. A value outside its limits is written to the
+# `else` field, or dropped without one.
+#
+# A point is written at the time in the message, an ISO 8601 string or seconds,
+# milliseconds or nanoseconds since epoch, so writing the same message again
+# overwrites the point. Retained messages are sent again by the broker on every
+# (re)connect; a retained message without its own time is skipped, it would be
+# written as a new point.
+import re
+import json
+import time
+import logging
+from datetime import datetime
+
+log = logging.getLogger("root")
+
+FORMATS = ("json", "point", "regex")
+
+
+def coercion(name):
+    if name == "int":
+        return int
+    if name == "float":
+        return float
+    if name == "str":
+        return str
+    if name.startswith("round:"):
+        digits = int(name[len("round:") :])
+        return lambda value: round(float(value), digits)
+    raise ValueError(f"unknown coercion '{name}', use int, float, str or round:<digits>")
+
+
+def source_time(value):
+    # nanoseconds since epoch of the time in a message, None when it isn't a time
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        if value < 1e11:
+            return int(value * 1_000_000_000)
+        if value < 1e14:
+            return int(value * 1_000_000)
+        return int(value)
+    if isinstance(value, str):
+        try:
+            # naive times are local, like the ones of flora.py
+            return int(datetime.fromisoformat(value).timestamp() * 1e9)
+        except ValueError:
+            return None
+    return None
+
+
+def template(value):
+    # a constant, or a format string when it has placeholders
+    if isinstance(value, str) and "{" in value:
+        return lambda context: value.format_map(context)
+    return lambda context: value
+
+
+class Route:
+
+    def __init__(self, pattern, spec):
+        self.pattern = pattern
+        self.format = spec.get("format", "json")
+        if self.format not in FORMATS:
+            raise ValueError(f"unknown format '{self.format}' of route '{pattern}', use one of {FORMATS}")
+
+        self.regex = None
+        self.groups = []
+        if self.format == "regex":
+            self.regex = re.compile(spec["pattern"], re.IGNORECASE)
+            self.groups = list(spec.get("groups", spec.get("fields", {})))
+
+        self.measurement = template(spec.get("measurement", "{device}"))
+        self.tags = {tag: template(value) for tag, value in spec.get("tags", {}).items()}
+        self.coercions = {field: coercion(name) for field, name in spec.get("fields", {}).items()}
+        self.only = spec.get("only", False)
+        self.numeric = spec.get("numeric", False)
+        self.set = {field: template(value) for field, value in spec.get("set", {}).items()}
+        self.limits = {
+            field: (limit.get("min"), limit.get("max"), limit.get("else"))
+            for field, limit in spec.get("limits", {}).items()
+        }
+        self.required = spec.get("required", [])
+        self.time = spec.get("time", "time")
+        self.needs_now = "{now}" in json.dumps(spec)
+
+    def __call__(self, device, payload, context):
+        if self.format == "regex":
+            match = self.regex.search(payload)
+            if not match:
+                raise ValueError(f"payload of '{device}' doesn't match {self.regex.pattern}: {payload}")
+            message = dict(zip(self.groups, match.groups()))
+        else:
+            message = json.loads(payload) if isinstance(payload, (str, bytes)) else payload
+            if self.format == "point":
+                return message
+            if not isinstance(message, dict):
+                raise TypeError(f"message of '{device}' isn't an object: {message}")
+
+        for field in self.required:
+            if field not in message:
+                raise KeyError(f"message of '{device}' has no {field}: {message}")
+
+        context = {**message, **context, "device": device}
+        if self.needs_now:
+            context["now"] = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        if self.only:
+            fields = {field: message[field] for field in self.coercions if field in message}
+        else:
+            fields = dict(message)
+        for field, coerce in self.coercions.items():
+            if field in fields:
+                fields[field] = coerce(fields[field])
+        for field, (low, high, other) in self.limits.items():
+            value = fields.get(field)
+            if value is None or (low is None or value >= low) and (high is None or value <= high):
+                continue
+            log.warning("ignoring %s value %s for device=%s", field, value, device)
+            del fields[field]
+            if other:
+                fields[other] = self.coercions.get(other, lambda v: v)(message[field])
+        point = {
+            "measurement": self.measurement(context),
+            "tags": {tag: value(context) for tag, value in self.tags.items()},
+            "fields": fields,
+        }
+        timestamp = source_time(message.get(self.time)) if self.time else None
+        if timestamp is not None:
+            # the time of the point, not a field
+            fields.pop(self.time, None)
+            point["time"] = timestamp
+        for field, value in self.set.items():
+            fields[field] = value(context)
+        if self.numeric:
+            # floats only, so sensors that send integers don't conflict with the others
+            point["fields"] = {
+                field: float(value)
+                for field, value in fields.items()
+                if isinstance(value, (int, float)) and not isinstance(value, bool)
+            }
+        return point
+
+
+class Router:
+    """
+    Routes the messages of every device with the routing table. Devices
+    without a route are counted and logged with the stats every
+    `stats_interval` seconds, not one by one.
+    """
+
+    def __init__(self, routes, context, stats_interval=300):
+        self.exact = {}
+        self.prefixes = {}
+        self.default = None
+        for pattern, spec in routes.items():
+            route = Route(pattern, spec)
+            if pattern == "*":
+                self.default = route
+            elif pattern.endswith("*"):
+                self.prefixes[pattern[:-1]] = route
+            else:
+                self.exact[pattern] = route
+        # the prefix lengths to try, longest first
+        self.lengths = sorted({len(prefix) for prefix in self.prefixes}, reverse=True)
+        self.cache = {}
+        self.context = context
+
+        self.stats_interval = stats_interval
+        self.last_stats = time.monotonic()
+        self.routed = 0
+        self.invalid = 0
+        self.replays = 0
+        self.unmatched = {}
+
+    def lookup(self, device):
+        if device in self.cache:
+            return self.cache[device]
+        route = self.exact.get(device)
+        if route is None:
+            for length in self.lengths:
+                route = self.prefixes.get(device[:length])
+                if route is not None:
+                    break
+            else:
+                route = self.default
+        if len(self.cache) < 10000:
+            self.cache[device] = route
+        return route
+
+    def route(self, device, payload, retained=False):
+        # the point of the message, None when the device has no route or it is a replay
+        if time.monotonic() - self.last_stats >= self.stats_interval:
+            self.last_stats = time.monotonic()
+            log.info("routing stats: %s", self.stats())
+
+        route = self.lookup(device)
+        if route is None:
+            self.unmatched[device] = self.unmatched.get(device, 0) + 1
+            return None
+        try:
+            point = route(device, payload, self.context)
+        except (ValueError, KeyError, TypeError):
+            self.invalid += 1
+            raise
+        if retained and "time" not in point:
+            self.replays += 1
+            return None
+        self.routed += 1
+        return point
+
+    def stats(self):
+        return {
+            "routed": self.routed,
+            "invalid": self.invalid,
+            "replays": self.replays,
+            "unmatched": dict(self.unmatched),
+        }
+
+
+def load_routes(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
@@ -0,0 +1,112 @@
+import os
+import pytest
+from routing import Router, coercion, load_routes, source_time
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+ROUTES = os.path.join(DIRECTORY, "..", "climate", "routes.json")
+
+TABLE = {
+    "esp32": {"measurement": "exact"},
+    "esp*": {"measurement": "short"},
+    "esp32-*": {"measurement": "long"},
+    "*": {"measurement": "default"},
+}
+
+
+def test_exact_route_before_any_prefix():
+    assert Router(TABLE, {}).route("esp32", "{}")["measurement"] == "exact"
+
+
+def test_longest_prefix_wins():
+    router = Router(TABLE, {})
+    assert router.route("esp32-kitchen", "{}")["measurement"] == "long"
+    assert router.route("esp8266", "{}")["measurement"] == "short"
+
+
+def test_default_route_and_unmatched_devices():
+    assert Router(TABLE, {}).route("operame", "{}")["measurement"] == "default"
+
+    router = Router({"esp*": {}}, {})
+    assert router.route("operame", "{}") is None
+    assert router.route("operame", "{}") is None
+    assert router.stats()["unmatched"] == {"operame": 2}
+
+
+def test_the_shipped_routes():
+    router = Router(load_routes(ROUTES), {"location": "house"})
+    assert router.route("operame", "812 ppm") == {
+        "measurement": "operame",
+        "tags": {"location": "house", "devices": "operame", "sensor": "metriful"},
+        "fields": {"co2": 812},
+    }
+
+    point = router.route("esp-hall", '{"humidity": 40, "temperature": 20.5}')
+    assert point["measurement"] == "esp-hall"
+    assert point["tags"] == {"location": "house", "devices": "esp-hall", "sensor": "esp-hall"}
+    assert point["fields"] == {"humidity": 40.0, "temperature": 20.5}
+
+    # the default route passes a point on as it is
+    point = {"measurement": "other", "fields": {"value": 1}}
+    assert router.route("other", point) == point
+
+
+def test_route_options():
+    routes = {
+        "plant*": {
+            "measurement": "{plant}",
+            "tags": {"location": "{location}"},
+            "fields": {"moisture": "int", "light": "round:1"},
+            "only": True,
+            "limits": {"moisture": {"max": 100, "else": "moisture_raw"}},
+            "required": ["plant"],
+        }
+    }
+    router = Router(routes, {"location": "house"})
+    point = router.route("plant-1", {"plant": "ficus", "moisture": 120, "light": 1.26, "battery": 80})
+    assert point == {
+        "measurement": "ficus",
+        "tags": {"location": "house"},
+        "fields": {"light": 1.3, "moisture_raw": 120},
+    }
+
+    with pytest.raises(KeyError):
+        router.route("plant-1", {"moisture": 20})
+    assert router.stats()["invalid"] == 1
+
+
+def test_time_of_the_message_and_retained_replays():
+    router = Router({"*": {}}, {})
+    point = router.route("esp", {"value": 1, "time": 1700000000}, retained=True)
+    assert point["time"] == 1700000000 * 1_000_000_000
+    assert "time" not in point["fields"]
+
+    # a retained message without a time would be written as a new point
+    assert router.route("esp", {"value": 1}, retained=True) is None
+    assert router.stats()["replays"] == 1
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (1700000000, 1700000000 * 10**9),
+        (1700000000123, 1700000000123 * 10**6),
+        (1700000000123456789, 1700000000123456789),
+        ("2023-11-14T22:13:20+00:00", 1700000000 * 10**9),
+        ("yesterday", None),
+        (True, None),
+    ],
+)
+def test_source_time(value, expected):
+    assert source_time(value) == expected
+
+
+def test_unknown_coercion():
+    with pytest.raises(ValueError):
+        coercion("bool")
+
+
+@pytest.mark.parametrize("service", ["climate", "flora"])
+@pytest.mark.parametrize("module", ["routing.py", "workers.py"])
+def test_services_link_to_the_shared_modules(service, module):
+    link = os.path.join(DIRECTORY, "..", service, module)
+    assert os.path.realpath(link) == os.path.realpath(os.path.join(DIRECTORY, module))
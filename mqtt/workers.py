@@ -0,0 +1,127 @@
+# Worker pool for MQTT messages
+#
+# The MQTT callback only puts the decoded message in a queue, the workers
+# transform and store it, so a slow InfluxDB never blocks the network loop of
+# paho and its keepalives.
+import time
+import zlib
+import logging
+import threading
+from collections import deque
+
+log = logging.getLogger("root")
+
+
+class MessageQueue:
+    # bounded queue that drops the oldest message when it is full
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.high_water = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item):
+        with self.condition:
+            if len(self.items) >= self.maxsize:
+                self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.high_water = max(self.high_water, len(self.items))
+            self.condition.notify()
+
+    def get(self):
+        # blocks until a message is available, None once closed and drained
+        with self.condition:
+            while not self.items and not self.closed:
+                self.condition.wait()
+            return self.items.popleft() if self.items else None
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class MessageWorkers:
+    """
+    Calls `handler(key, *message)` for every message on one of `workers`
+    threads. The messages with the same key, like the device, always go to the
+    same worker so they are handled in order. `stop()` lets the workers drain
+    their queues.
+    """
+
+    def __init__(self, handler, workers=2, queue_size=1000, stats_interval=300):
+        self.handler = handler
+        self.queues = [MessageQueue(queue_size) for _ in range(workers)]
+        self.threads = [
+            threading.Thread(target=self.work, args=(queue,), name=f"worker-{i}", daemon=True)
+            for i, queue in enumerate(self.queues)
+        ]
+        self.stats_interval = stats_interval
+        self.started = time.monotonic()
+        self.last_stats = self.started
+        self.lock = threading.Lock()
+        self.received = 0
+        self.handled = 0
+        self.failed = 0
+        self.busy = 0.0
+
+    def start(self):
+        self.started = time.monotonic()
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, key, *message):
+        # called on the MQTT network thread, never blocks on a full queue
+        queue = self.queues[zlib.crc32(key.encode("utf-8")) % len(self.queues)]
+        queue.put((key, *message))
+        self.received += 1
+
+        if time.monotonic() - self.last_stats >= self.stats_interval:
+            self.last_stats = time.monotonic()
+            log.info("worker stats: %s", self.stats())
+
+    def work(self, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            started = time.monotonic()
+            try:
+                self.handler(*item)
+                failed = 0
+            except Exception as e:  # pylint: disable=broad-except
+                # a bad message must not stop the worker
+                log.error("failed to handle message of '%s'", item[0], exc_info=e)
+                failed = 1
+            with self.lock:
+                self.handled += 1
+                self.failed += failed
+                self.busy += time.monotonic() - started
+
+    def stop(self, timeout=30):
+        for queue in self.queues:
+            queue.close()
+        deadline = time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        log.info("worker stats: %s", self.stats())
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            "received": self.received,
+            "rate": round(self.received / elapsed, 2) if elapsed else 0,
+            "handled": self.handled,
+            "failed": self.failed,
+            "depth": [len(queue) for queue in self.queues],
+            "high_water": [queue.high_water for queue in self.queues],
+            "dropped": sum(queue.dropped for queue in self.queues),
+            "busy_ms": round(self.busy / self.handled * 1000, 1) if self.handled else 0,
+        }
@@ -1,9 +1,14 @@
 import os
+import time
+import sqlite3
+from contextlib import closing
 from datetime import datetime
 from flask import render_template, Markup
 from influxdb import InfluxDBClient
+from influxdb.resultset import ResultSet
 from dateutil import parser, tz
 from logger import log
+from local_store import LocalStore, rfc3339
 
 
 # Configure InfluxDB connection from environment variables
@@ -13,15 +18,64 @@ dbuser = os.getenv("INFLUXDB_USER", "user")
 dbpassword = os.getenv("INFLUXDB_PASSWORD", "")
 dbname = os.getenv("INFLUXDB_FLORA_DATABASE", "flora")
 
+# influxdb, or sqlite to read STORAGE_DIR/<database>.db of local_store.py
+storage_backend = os.getenv("STORAGE_BACKEND", "influxdb")
+storage_dir = os.getenv("STORAGE_DIR", "data")
+
+# per-plant: a measurement per plant, single: one measurement with the plant as tag
+schema = os.getenv("FLORA_SCHEMA", "per-plant")
+measurement = os.getenv("FLORA_MEASUREMENT", "flora")
+# derivative: find the waterings in 60 days of moisture, like before the watering measurement
+# events: the last point per plant of the watering measurement of flora_persists, only has
+# the waterings since flora_persists detects them
+waterings_from = os.getenv("FLORA_WATERINGS", "derivative")
+
+# measurements of the per-plant schema that aren't plants
+NOT_PLANTS = ("watering", "quarantine")
+
+DAY = 86400 * 1_000_000_000
+
+
+def connect():
+    if storage_backend == "sqlite":
+        return LocalStore(os.path.join(storage_dir, f"{dbname}.db"), read_only=True)
+    return InfluxDBClient(dbhost, dbport, dbuser, dbpassword, dbname)
+
 
 def load_data(client):
-    log.debug("load data from influxdb")
+    log.debug("load data from %s", storage_backend)
+    if storage_backend == "sqlite":
+        since = time.time_ns() - DAY
+        if schema == "single":
+            return client.last(measurement, since, group_by=("plant",))
+        return client.last(since=since)
+    if schema == "single":
+        # the other fields come from the same point as the last moisture
+        return client.query(
+            "SELECT LAST(moisture) AS moisture, temperature, conductivity, light, battery "
+            f'FROM "{measurement}" WHERE time >= now() - 24h GROUP BY plant'
+        )
     results = client.query(
         "SELECT * FROM /.*/ WHERE time >= now() - 24h ORDER BY time DESC LIMIT 1"
     )
     return results
 
 
+def plants(data):
+    # (plant, point) of the last point of every plant
+    for (name, tags), points in data.items():
+        if name in NOT_PLANTS:
+            continue
+        for p in points:
+            yield (tags["plant"] if tags else p["node"]), p
+
+
+def plant_waterings(waterings, plant):
+    if schema == "single" or waterings_from == "events":
+        return waterings.get_points(tags={"plant": plant})
+    return waterings.get_points(measurement=plant)
+
+
 def summary(data, waterings):
     table = '<table id="data" class="flora-table tablesorter">'
     table += "<thead><tr>\
@@ -35,12 +89,12 @@ def summary(data, waterings):
                 <th>time</th>\
             </tr></thead>"
 
-    for p in data.get_points():
+    for plant, p in plants(data):
         dt = parser.parse(p["time"]).astimezone(tz.gettz("europe/amsterdam"))
         time = dt.strftime("%H:%M")  #  %d %b")
-        watering = last_watering(waterings[p["node"]])
+        watering = last_watering(plant_waterings(waterings, plant))
         table += f"""<tr>
-            <td>{p['node']}</td>
+            <td>{plant}</td>
             <td>{p['temperature']}</td>
             <td>{p['moisture']}</td>
             <td>{p['conductivity']}</td>
@@ -55,8 +109,51 @@ def summary(data, waterings):
     return table
 
 
+def derivatives(means, field, interval, threshold):
+    # the derivative of the means per `interval` above threshold, like derivative(mean(field), interval) of InfluxDB
+    series = []
+    for (name, tags), points in means.items():
+        values = []
+        previous = None
+        for p in points:
+            if p[field] is None:
+                continue
+            if previous is not None:
+                derivative = (p[field] - previous[field]) / ((p["time"] - previous["time"]) / interval)
+                if derivative > threshold:
+                    values.append([rfc3339(p["time"] * 1_000_000_000), derivative])
+            previous = p
+        if values:
+            serie = {"name": name, "columns": ["time", "derivative"], "values": values}
+            if tags:
+                serie["tags"] = tags
+            series.append(serie)
+    return ResultSet({"series": series})
+
+
+def load_local_waterings(client):
+    now = time.time_ns()
+    if waterings_from == "events":
+        return client.last("watering", now - 365 * DAY, group_by=("plant",))
+    if schema == "single":
+        means = client.mean(measurement, 7200, now - 60 * DAY, fields=["moisture"], group_by=("plant",), epoch="s")
+    else:
+        means = client.mean(None, 7200, now - 60 * DAY, fields=["moisture"], epoch="s")
+    return derivatives(means, "moisture", 7200, 1.5)
+
+
 def load_waterings(client):
-    log.debug("load waterings from influxdb")
+    log.debug("load waterings from %s", storage_backend)
+    if storage_backend == "sqlite":
+        return load_local_waterings(client)
+    if waterings_from == "events":
+        return client.query("SELECT LAST(jump) FROM watering WHERE time >= now() - 365d GROUP BY plant")
+    if schema == "single":
+        return client.query(
+            "SELECT derivative FROM (SELECT derivative(mean(moisture), 2h) "
+            f'FROM "{measurement}" WHERE time >= now()-60d and time <= now() GROUP BY time(2h), plant) '
+            "WHERE derivative > 1.5 GROUP BY plant"
+        )
     results = client.query(
         "SELECT derivative FROM (SELECT derivative(mean(moisture), 2h) FROM /.*/ WHERE time >= now()-60d and time <= now() GROUP BY time(2h)) WHERE derivative > 1.5"
     )
@@ -96,12 +193,12 @@ def last_watering(data):
 
 def flora_page():
     try:
-        client = InfluxDBClient(dbhost, dbport, dbuser, dbpassword, dbname)
-        data = load_data(client)
-        watering_data = load_waterings(client)
+        with closing(connect()) as client:
+            data = load_data(client)
+            watering_data = load_waterings(client)
 
         table = summary(data, watering_data)
-    except (ConnectionError, OSError, ValueError) as e:
+    except (ConnectionError, OSError, ValueError, sqlite3.Error) as e:
         log.error(f"failed to load data: {e}")
         table = "<table></table>"
 
@@ -112,12 +209,12 @@ def flora_frame(theme):
     background = "1B1B1B" if theme == "dark" else "white"
     text = "white" if theme == "dark" else "black"
     try:
-        client = InfluxDBClient(dbhost, dbport, dbuser, dbpassword, dbname)
-        data = load_data(client)
-        watering_data = load_waterings(client)
+        with closing(connect()) as client:
+            data = load_data(client)
+            watering_data = load_waterings(client)
 
         table = summary(data, watering_data)
-    except (ConnectionError, OSError, ValueError) as e:
+    except (ConnectionError, OSError, ValueError, sqlite3.Error) as e:
         log.error(f"failed to load data: {e}")
         table = "<table></table>"
 
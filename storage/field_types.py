@@ -0,0 +1,129 @@
+# Registry of the field types of every measurement
+#
+# InfluxDB rejects a whole write when a field gets a value of another type than
+# it has, like `humidity` as a string from one ESP and as a float from another.
+# The registry knows the type of every field, from SHOW FIELD KEYS on startup
+# and from the first value of a new field, and checks every point before it is
+# written. A value of another type is coerced when that is lossless, like 21 or
+# "21.5" for a float field. Otherwise the value is quarantined: it is written as
+# a string to the quarantine measurement, tagged with its measurement and field.
+import logging
+import threading
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+
+log = logging.getLogger("root")
+
+
+def type_of(value):
+    # the InfluxDB type of a value, bool first as it is an int too
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, int):
+        return "integer"
+    if isinstance(value, float):
+        return "float"
+    if isinstance(value, str):
+        return "string"
+    return None
+
+
+def coerce(value, field_type):
+    # the value as `field_type`, raises ValueError or TypeError when that loses information
+    if field_type == "float":
+        if isinstance(value, bool):
+            raise TypeError("a boolean isn't a float")
+        return float(value)
+    if field_type == "integer":
+        if isinstance(value, bool):
+            raise TypeError("a boolean isn't an integer")
+        number = float(value)
+        if not number.is_integer():
+            raise ValueError(f"{value} isn't an integer")
+        return int(number)
+    if field_type == "string":
+        return str(value)
+    if field_type == "boolean":
+        if isinstance(value, str) and value.lower() in ("true", "false"):
+            return value.lower() == "true"
+        if value in (0, 1):
+            return bool(value)
+        raise ValueError(f"{value} isn't a boolean")
+    raise TypeError(f"unknown field type {field_type}")
+
+
+class FieldTypes:
+
+    def __init__(self, quarantine="quarantine"):
+        self.quarantine = quarantine
+        # measurement -> {field: type}
+        self.types = {}
+        self.lock = threading.Lock()
+        self.coerced = 0
+        self.quarantined = 0
+
+    def load(self, client, database=None):
+        try:
+            result = client.query("SHOW FIELD KEYS", database=database)
+        except (InfluxDBClientError, InfluxDBServerError, OSError) as e:
+            log.error("failed to load the field types, learn them from the messages", exc_info=e)
+            return
+        with self.lock:
+            for (measurement, _), rows in result.items():
+                fields = self.types.setdefault(measurement, {})
+                for row in rows:
+                    # a field can have another type in an older shard, the first one wins
+                    fields.setdefault(row["fieldKey"], row["fieldType"])
+        log.info("loaded the field types of %d measurements", len(self.types))
+
+    def check(self, point):
+        # the points to write: the point with coerced fields, and the quarantined values
+        measurement = point.get("measurement")
+        fields = point.get("fields")
+        if not measurement or not fields:
+            return [point]
+
+        quarantined = []
+        checked = {}
+        with self.lock:
+            types = self.types.setdefault(measurement, {})
+            for field, value in fields.items():
+                if value is None:
+                    continue
+                actual = type_of(value)
+                expected = types.get(field)
+                if actual is None:
+                    # like a list or an object, InfluxDB has no type for it
+                    quarantined.append((field, value, expected))
+                    continue
+                if expected is None:
+                    types[field] = actual
+                    expected = actual
+                if actual == expected:
+                    checked[field] = value
+                    continue
+                try:
+                    checked[field] = coerce(value, expected)
+                    self.coerced += 1
+                except (ValueError, TypeError):
+                    quarantined.append((field, value, expected))
+
+        points = []
+        if checked:
+            points.append({**point, "fields": checked})
+        for field, value, expected in quarantined:
+            self.quarantined += 1
+            log.warning(
+                "quarantine %s value %r of measurement %s, the field is %s", field, value, measurement, expected
+            )
+            quarantine = {
+                "measurement": self.quarantine,
+                "tags": {"measurement": measurement, "field": field},
+                "fields": {"value": repr(value)},
+            }
+            if "time" in point:
+                quarantine["time"] = point["time"]
+            points.append(quarantine)
+        return points
+
+    def stats(self):
+        return {"coerced": self.coerced, "quarantined": self.quarantined}
@@ -0,0 +1,455 @@
+# Embedded time series store
+#
+# An alternative to InfluxDB on a single Pi: the points of a database are kept
+# in one SQLite file. LocalStore.write_points() takes the points of
+# InfluxDBClient.write_points(), so a service only swaps its client, and the
+# queries return an influxdb ResultSet, so the site reads them like the result
+# of client.query().
+#
+#   series          a row per measurement and tag set, with a unique index
+#   head            the points that aren't compacted yet, per series and time
+#   blocks_<day>    the compacted points of a UTC day, a table per day
+#
+# A block has up to `block_size` points of one series: the times are delta and
+# varint encoded, and so are the integer fields and the float fields with at
+# most 6 decimals; other fields are JSON. The points of the days before today
+# are moved from the head to blocks once an hour, and with `retention_days` the
+# tables of older days are dropped.
+#
+# As in InfluxDB a point with the time of an existing point adds its fields to
+# it, and a point without a time is written at the time it is written.
+#
+# This file is the only copy, the services import it through the
+# local_store.py symlink in their directory.
+import os
+import json
+import time
+import struct
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timezone
+from urllib.request import pathname2url
+from influxdb.resultset import ResultSet
+
+log = logging.getLogger("root")
+
+DAY = 86400 * 1_000_000_000
+EPOCHS = {"ns": 1, "u": 1_000, "ms": 1_000_000, "s": 1_000_000_000}
+
+
+def zigzag(number):
+    return number << 1 if number >= 0 else (-number << 1) - 1
+
+
+def varints(numbers):
+    data = bytearray()
+    for number in numbers:
+        number = zigzag(number)
+        while number > 0x7F:
+            data.append(number & 0x7F | 0x80)
+            number >>= 7
+        data.append(number)
+    return bytes(data)
+
+
+def unvarints(data):
+    numbers = []
+    number = 0
+    shift = 0
+    for byte in data:
+        number |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        numbers.append(number >> 1 if not number & 1 else -((number + 1) >> 1))
+        number = 0
+        shift = 0
+    return numbers
+
+
+def deltas(numbers):
+    return [number - previous for previous, number in zip([0] + numbers, numbers)]
+
+
+def undeltas(numbers):
+    total = 0
+    values = []
+    for number in numbers:
+        total += number
+        values.append(total)
+    return values
+
+
+def scale_of(values):
+    # the decimals that make every float an integer, None when that takes more than 6
+    for scale in range(7):
+        factor = 10**scale
+        if all(round(value * factor) / factor == value for value in values):
+            return scale
+    return None
+
+
+def encode_column(values):
+    # (kind, payload) of the present values of a field
+    if all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+        return "i", varints(deltas(values))
+    if all(isinstance(v, float) for v in values):
+        scale = scale_of(values)
+        if scale is not None:
+            return f"f{scale}", varints(deltas([round(v * 10**scale) for v in values]))
+        return "d", struct.pack(f"<{len(values)}d", *values)
+    return "j", json.dumps(values).encode("utf-8")
+
+
+def decode_column(kind, payload):
+    if kind == "i":
+        return undeltas(unvarints(payload))
+    if kind.startswith("f"):
+        factor = 10 ** int(kind[1:])
+        return [number / factor for number in undeltas(unvarints(payload))]
+    if kind == "d":
+        return list(struct.unpack(f"<{len(payload) // 8}d", payload))
+    return json.loads(payload)
+
+
+def encode_block(points):
+    # the blob of [(time, fields), ...] in time order
+    times = [t for t, _ in points]
+    header = [len(points)]
+    payloads = [varints(deltas(times))]
+    header.append(len(payloads[0]))
+    names = sorted({field for _, fields in points for field in fields})
+    for name in names:
+        present = [name in fields for _, fields in points]
+        values = [fields[name] for _, fields in points if name in fields]
+        kind, payload = encode_column(values)
+        mask = b""
+        if not all(present):
+            mask = bytes(
+                sum(1 << bit for bit in range(8) if i + bit < len(present) and present[i + bit])
+                for i in range(0, len(present), 8)
+            )
+        header.append([name, kind, len(mask), len(payload)])
+        payloads.extend((mask, payload))
+    head = json.dumps(header).encode("utf-8")
+    return struct.pack("<I", len(head)) + head + b"".join(payloads)
+
+
+def decode_block(data):
+    (length,) = struct.unpack_from("<I", data)
+    header = json.loads(data[4 : 4 + length])
+    offset = 4 + length
+    count, times_length = header[0], header[1]
+    times = undeltas(unvarints(data[offset : offset + times_length]))
+    offset += times_length
+    points = [(t, {}) for t in times]
+    for name, kind, mask_length, payload_length in header[2:]:
+        mask = data[offset : offset + mask_length]
+        offset += mask_length
+        values = iter(decode_column(kind, data[offset : offset + payload_length]))
+        offset += payload_length
+        for i in range(count):
+            if not mask or mask[i // 8] >> (i % 8) & 1:
+                points[i][1][name] = next(values)
+    return points
+
+
+def point_time(value, precision=None):
+    # nanoseconds since epoch of the time of a point, naive times are UTC like in InfluxDB
+    if value is None:
+        return time.time_ns()
+    if isinstance(value, datetime):
+        moment = value
+    elif isinstance(value, str):
+        moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    else:
+        return int(value * EPOCHS[precision or "ns"])
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp()) * 1_000_000_000 + moment.microsecond * 1_000
+
+
+def rfc3339(nanoseconds):
+    seconds, fraction = divmod(nanoseconds, 1_000_000_000)
+    text = datetime.fromtimestamp(seconds, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+    if fraction:
+        text += f".{fraction:09d}".rstrip("0")
+    return text + "Z"
+
+
+class LocalStore:
+    """
+    A SQLite file with the points of one database. It can be shared by the
+    threads of a service; the site opens it read-only per request, reads don't
+    wait for the writes of the service.
+    """
+
+    def __init__(self, path, block_size=1000, retention_days=0, compact_interval=3600, read_only=False):
+        self.path = path
+        self.block_size = block_size
+        self.retention_days = retention_days
+        self.compact_interval = compact_interval
+        self.last_compaction = 0
+        self.lock = threading.RLock()
+        self.series_ids = {}
+
+        if read_only:
+            # a reader doesn't create the file or its tables
+            uri = f"file:{pathname2url(os.path.abspath(path))}?mode=ro"
+            self.db = sqlite3.connect(uri, uri=True, timeout=30, check_same_thread=False)
+            return
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS series ("
+                "id INTEGER PRIMARY KEY, measurement TEXT NOT NULL, tags TEXT NOT NULL, "
+                "UNIQUE (measurement, tags))"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS head ("
+                "series INTEGER NOT NULL, time INTEGER NOT NULL, fields TEXT NOT NULL, "
+                "PRIMARY KEY (series, time)) WITHOUT ROWID"
+            )
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    # writing
+
+    def series_id(self, measurement, tags):
+        key = (measurement, json.dumps(tags, sort_keys=True))
+        series = self.series_ids.get(key)
+        if series is None:
+            self.db.execute("INSERT OR IGNORE INTO series (measurement, tags) VALUES (?, ?)", key)
+            (series,) = self.db.execute(
+                "SELECT id FROM series WHERE measurement = ? AND tags = ?", key
+            ).fetchone()
+            self.series_ids[key] = series
+        return series
+
+    def write_points(self, points, time_precision=None, database=None, retention_policy=None, tags=None, **_):
+        # the arguments of InfluxDBClient.write_points, a store is one database without retention policies
+        rows = []
+        with self.lock, self.db:
+            for point in points:
+                fields = {field: value for field, value in point.get("fields", {}).items() if value is not None}
+                if not point.get("measurement") or not fields:
+                    raise ValueError(f"a point needs a measurement and fields: {point}")
+                point_tags = {**(tags or {}), **point.get("tags", {})}
+                point_tags = {tag: str(value) for tag, value in point_tags.items() if value not in (None, "")}
+                series = self.series_id(point["measurement"], point_tags)
+                rows.append((series, point_time(point.get("time"), time_precision), json.dumps(fields)))
+            self.db.executemany(
+                "INSERT INTO head (series, time, fields) VALUES (?, ?, ?) "
+                "ON CONFLICT (series, time) DO UPDATE SET fields = json_patch(head.fields, excluded.fields)",
+                rows,
+            )
+        if time.monotonic() - self.last_compaction >= self.compact_interval:
+            self.compact()
+        return True
+
+    def compact(self, before=None):
+        # move the points before `before`, the start of today by default, from the head to blocks
+        self.last_compaction = time.monotonic()
+        if before is None:
+            before = time.time_ns() // DAY * DAY
+        started = time.monotonic()
+        moved = 0
+        with self.lock, self.db:
+            rows = self.db.execute(
+                "SELECT series, time, fields FROM head WHERE time < ? ORDER BY series, time", (before,)
+            )
+            block = []
+            for series, timestamp, fields in rows:
+                if block and (
+                    block[0][0] != series or block[0][1] // DAY != timestamp // DAY or len(block) >= self.block_size
+                ):
+                    self.add_block(block)
+                    block = []
+                block.append((series, timestamp, json.loads(fields)))
+                moved += 1
+            if block:
+                self.add_block(block)
+            self.db.execute("DELETE FROM head WHERE time < ?", (before,))
+
+            if self.retention_days > 0:
+                oldest = self.partition(time.time_ns() - self.retention_days * DAY)
+                for table in self.partitions():
+                    if table < oldest:
+                        self.db.execute(f"DROP TABLE {table}")
+                        log.info("dropped %s of %s, older than %d days", table, self.path, self.retention_days)
+        if moved:
+            log.info("compacted %d points of %s in %.1fs", moved, self.path, time.monotonic() - started)
+
+    def add_block(self, block):
+        series = block[0][0]
+        table = self.partition(block[0][1])
+        self.db.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "series INTEGER NOT NULL, start INTEGER NOT NULL, end INTEGER NOT NULL, data BLOB NOT NULL)"
+        )
+        self.db.execute(f"CREATE INDEX IF NOT EXISTS {table}_series ON {table} (series, end)")
+        self.db.execute(
+            f"INSERT INTO {table} (series, start, end, data) VALUES (?, ?, ?, ?)",
+            (series, block[0][1], block[-1][1], encode_block([(t, fields) for _, t, fields in block])),
+        )
+
+    # reading
+
+    @staticmethod
+    def partition(nanoseconds):
+        return "blocks_" + datetime.fromtimestamp(nanoseconds // 1_000_000_000, timezone.utc).strftime("%Y%m%d")
+
+    def partitions(self, start=None, end=None):
+        # the block tables from start to end, oldest first
+        tables = sorted(
+            name
+            for (name,) in self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'blocks_%'")
+        )
+        first = self.partition(start) if start is not None else ""
+        last = self.partition(end) if end is not None else "~"
+        return [table for table in tables if first <= table <= last]
+
+    def series(self, measurement=None, tags=None):
+        # [(id, measurement, tags)] of a measurement, all measurements when None
+        query = "SELECT id, measurement, tags FROM series"
+        rows = self.db.execute(query + " WHERE measurement = ?", (measurement,)) if measurement else self.db.execute(query)
+        found = []
+        for series, name, series_tags in rows:
+            series_tags = json.loads(series_tags)
+            if all(series_tags.get(tag) == value for tag, value in (tags or {}).items()):
+                found.append((series, name, series_tags))
+        return found
+
+    def read(self, series, start=None, end=None):
+        # {time: fields} of a series from start up to end, the head overrides the blocks
+        start = 0 if start is None else start
+        end = 2**63 - 1 if end is None else end
+        points = {}
+        for table in self.partitions(start, end - 1):
+            for (data,) in self.db.execute(
+                f"SELECT data FROM {table} WHERE series = ? AND end >= ? AND start < ? ORDER BY rowid",
+                (series, start, end),
+            ):
+                for timestamp, fields in decode_block(data):
+                    if start <= timestamp < end:
+                        points.setdefault(timestamp, {}).update(fields)
+        for timestamp, fields in self.db.execute(
+            "SELECT time, fields FROM head WHERE series = ? AND time >= ? AND time < ?", (series, start, end)
+        ):
+            points.setdefault(timestamp, {}).update(json.loads(fields))
+        return points
+
+    def read_last(self, series, start=None):
+        # (time, fields) of the last point of a series from start on, None without one
+        start = 0 if start is None else start
+        head = self.db.execute(
+            "SELECT time, fields FROM head WHERE series = ? AND time >= ? ORDER BY time DESC LIMIT 1",
+            (series, start),
+        ).fetchone()
+        last = (head[0], json.loads(head[1])) if head else None
+        for table in reversed(self.partitions(start)):
+            row = self.db.execute(
+                f"SELECT end, data FROM {table} WHERE series = ? AND end >= ? ORDER BY end DESC LIMIT 1",
+                (series, start),
+            ).fetchone()
+            if row is None:
+                continue
+            if last is None or row[0] >= last[0]:
+                # the same time in the head has the newer fields
+                last = self.read(series, row[0], row[0] + 1).popitem()
+            break
+        return last
+
+    def groups(self, measurement, tags, group_by):
+        # {(measurement, group tags): [(id, tags)]}, every measurement is a group of its own
+        groups = {}
+        for series, name, series_tags in self.series(measurement, tags):
+            key = (name, tuple((tag, series_tags.get(tag, "")) for tag in group_by))
+            groups.setdefault(key, []).append((series, series_tags))
+        return groups
+
+    @staticmethod
+    def result(series_list, epoch=None):
+        series_list = [s for s in series_list if s["values"]]
+        for s in series_list:
+            for row in s["values"]:
+                row[0] = rfc3339(row[0]) if epoch is None else row[0] // EPOCHS[epoch]
+        return ResultSet({"series": series_list})
+
+    @staticmethod
+    def series_result(name, group, rows):
+        columns = ["time"] + sorted({column for row in rows for column in row if column != "time"})
+        result = {"name": name, "columns": columns, "values": [[row.get(c) for c in columns] for row in rows]}
+        if group:
+            result["tags"] = dict(group)
+        return result
+
+    def last(self, measurement=None, since=None, tags=None, group_by=(), epoch=None):
+        # the last point of every group, like SELECT LAST(*) ... GROUP BY <group_by>
+        results = []
+        with self.lock:
+            for (name, group), members in self.groups(measurement, tags, group_by).items():
+                last = None
+                for series, series_tags in members:
+                    point = self.read_last(series, since)
+                    if point is not None and (last is None or point[0] > last[0]):
+                        # the tags that aren't grouped are columns, like in InfluxDB
+                        extra = {tag: value for tag, value in series_tags.items() if tag not in group_by}
+                        last = (point[0], {**extra, **point[1]})
+                if last is not None:
+                    results.append(self.series_result(name, group, [{"time": last[0], **last[1]}]))
+        return self.result(results, epoch)
+
+    def scan(self, measurement, start=None, end=None, tags=None, group_by=(), epoch=None):
+        # the points from start up to end in time order, like SELECT * ... GROUP BY <group_by>
+        results = []
+        with self.lock:
+            for (name, group), members in self.groups(measurement, tags, group_by).items():
+                rows = []
+                for series, series_tags in members:
+                    extra = {tag: value for tag, value in series_tags.items() if tag not in group_by}
+                    rows.extend({"time": t, **extra, **fields} for t, fields in self.read(series, start, end).items())
+                rows.sort(key=lambda row: row["time"])
+                results.append(self.series_result(name, group, rows))
+        return self.result(results, epoch)
+
+    def mean(self, measurement, interval, start, end=None, fields=None, tags=None, group_by=(), epoch=None):
+        # the mean of the numeric fields per `interval` seconds, like GROUP BY time(interval) with fill(null)
+        interval = interval * 1_000_000_000
+        end = time.time_ns() if end is None else end
+        results = []
+        with self.lock:
+            for (name, group), members in self.groups(measurement, tags, group_by).items():
+                sums = {}
+                for series, _ in members:
+                    for timestamp, point in self.read(series, start, end).items():
+                        bucket = sums.setdefault(timestamp // interval * interval, {})
+                        for field, value in point.items():
+                            if fields and field not in fields:
+                                continue
+                            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                                total = bucket.setdefault(field, [0.0, 0])
+                                total[0] += value
+                                total[1] += 1
+                names = sorted(fields or {field for bucket in sums.values() for field in bucket})
+                rows = []
+                for bucket in range(start // interval * interval, end, interval):
+                    totals = sums.get(bucket, {})
+                    rows.append(
+                        {
+                            "time": bucket,
+                            **{f: totals[f][0] / totals[f][1] if f in totals else None for f in names},
+                        }
+                    )
+                if sums:
+                    results.append(self.series_result(name, group, rows))
+        return self.result(results, epoch)
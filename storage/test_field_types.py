@@ -0,0 +1,105 @@
+import os
+import pytest
+from influxdb.resultset import ResultSet
+from field_types import FieldTypes, coerce
+
+
+class FakeInflux:
+    def query(self, query, database=None):
+        assert query == "SHOW FIELD KEYS"
+        return ResultSet(
+            {
+                "series": [
+                    {
+                        "name": "esp",
+                        "columns": ["fieldKey", "fieldType"],
+                        "values": [["humidity", "float"], ["co2", "integer"]],
+                    }
+                ]
+            }
+        )
+
+
+@pytest.mark.parametrize(
+    "value, field_type, expected",
+    [
+        (21, "float", 21.0),
+        ("21.5", "float", 21.5),
+        (21.0, "integer", 21),
+        ("400", "integer", 400),
+        (21.5, "string", "21.5"),
+        ("True", "boolean", True),
+        (0, "boolean", False),
+    ],
+)
+def test_lossless_coercions(value, field_type, expected):
+    result = coerce(value, field_type)
+    assert result == expected and type(result) is type(expected)
+
+
+@pytest.mark.parametrize(
+    "value, field_type",
+    [(21.5, "integer"), ("wet", "float"), (True, "float"), (True, "integer"), (2, "boolean"), ("yes", "boolean")],
+)
+def test_lossy_coercions_raise(value, field_type):
+    with pytest.raises((ValueError, TypeError)):
+        coerce(value, field_type)
+
+
+def test_types_from_influxdb():
+    field_types = FieldTypes()
+    field_types.load(FakeInflux())
+    (point,) = field_types.check({"measurement": "esp", "fields": {"humidity": 40, "co2": 812.0}})
+    assert point["fields"] == {"humidity": 40.0, "co2": 812}
+    assert field_types.stats() == {"coerced": 2, "quarantined": 0}
+
+
+def test_the_first_value_of_a_new_field_sets_its_type():
+    field_types = FieldTypes()
+    field_types.check({"measurement": "esp", "fields": {"humidity": 40.5}})
+    (point,) = field_types.check({"measurement": "esp", "fields": {"humidity": 41}})
+    assert point["fields"] == {"humidity": 41.0}
+    # other measurements have their own fields
+    (point,) = field_types.check({"measurement": "operame", "fields": {"humidity": "dry"}})
+    assert point["fields"] == {"humidity": "dry"}
+
+
+def test_quarantine():
+    field_types = FieldTypes("quarantine")
+    field_types.check({"measurement": "esp", "fields": {"humidity": 40.5}})
+    point, quarantine, other = field_types.check(
+        {
+            "measurement": "esp",
+            "tags": {"sensor": "esp"},
+            "time": 1700000000000000000,
+            "fields": {"humidity": "wet", "temperature": 20.5, "list": [1, 2]},
+        }
+    )
+    assert point == {
+        "measurement": "esp",
+        "tags": {"sensor": "esp"},
+        "time": 1700000000000000000,
+        "fields": {"temperature": 20.5},
+    }
+    assert quarantine == {
+        "measurement": "quarantine",
+        "tags": {"measurement": "esp", "field": "humidity"},
+        "fields": {"value": "'wet'"},
+        "time": 1700000000000000000,
+    }
+    assert other["tags"] == {"measurement": "esp", "field": "list"}
+    assert field_types.stats()["quarantined"] == 2
+
+
+def test_a_point_with_only_bad_values_is_not_written():
+    field_types = FieldTypes()
+    field_types.check({"measurement": "esp", "fields": {"humidity": 40.5}})
+    points = field_types.check({"measurement": "esp", "fields": {"humidity": "wet"}})
+    assert [point["measurement"] for point in points] == ["quarantine"]
+
+
+@pytest.mark.parametrize("service", ["climate", "flora"])
+def test_services_link_to_this_module(service):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    link = os.path.join(directory, "..", service, "field_types.py")
+    assert os.path.realpath(link) == os.path.realpath(os.path.join(directory, "field_types.py"))
@@ -0,0 +1,139 @@
+import os
+import sqlite3
+import pytest
+from local_store import DAY, LocalStore, decode_block, deltas, encode_block, rfc3339, undeltas, unvarints, varints
+
+# 2024-01-31 00:00 UTC
+START = 1706659200 * 1_000_000_000
+HOUR = 3600 * 1_000_000_000
+
+
+@pytest.fixture(name="store")
+def temporary_store(tmp_path):
+    store = LocalStore(str(tmp_path / "data" / "climate.db"), block_size=3)
+    yield store
+    store.close()
+
+
+def point(time, tags=None, **fields):
+    return {"measurement": "esp", "tags": tags or {"sensor": "hall"}, "time": time, "fields": fields}
+
+
+def test_varints_and_deltas():
+    numbers = [0, 1, -1, 63, -64, 64, 2**40, -(2**40), 5]
+    assert unvarints(varints(numbers)) == numbers
+    assert undeltas(deltas(numbers)) == numbers
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        [1, 2, 300, -5],
+        [20.5, 20.25, -3.125],
+        [0.1, 0.2, 1 / 3],
+        ["on", "off", "on"],
+        [True, False, True],
+    ],
+)
+def test_block_round_trip(values):
+    points = [(START + i * 10**9, {"value": value}) for i, value in enumerate(values)]
+    decoded = decode_block(encode_block(points))
+    assert decoded == points
+    assert [type(fields["value"]) for _, fields in decoded] == [type(value) for value in values]
+
+
+def test_block_with_missing_fields():
+    points = [(START + i, {"a": i} if i % 3 else {"b": float(i)}) for i in range(20)]
+    assert decode_block(encode_block(points)) == points
+
+
+def test_head_and_blocks_read_the_same(store):
+    store.write_points([point(START + i * HOUR, temperature=20.0 + i / 4, humidity=40 + i) for i in range(30)])
+    before = list(store.scan("esp", epoch="ns").get_points())
+    store.compact(START + 2 * DAY)
+    assert store.db.execute("SELECT COUNT(*) FROM head").fetchone()[0] == 0
+    assert store.partitions() == ["blocks_20240131", "blocks_20240201"]
+    assert list(store.scan("esp", epoch="ns").get_points()) == before
+    assert before[3] == {"time": START + 3 * HOUR, "sensor": "hall", "humidity": 43, "temperature": 20.75}
+
+
+def test_a_point_at_the_same_time_adds_its_fields(store):
+    store.write_points([point(START, temperature=20.0)])
+    store.compact(START + DAY)
+    store.write_points([point(START, humidity=40)])
+    store.write_points([point(START, temperature=21.0)])
+    (row,) = store.scan("esp", epoch="ns").get_points()
+    assert row == {"time": START, "sensor": "hall", "humidity": 40, "temperature": 21.0}
+
+
+def test_last_per_group(store):
+    store.write_points([point(START + i * HOUR, {"sensor": "hall"}, temperature=float(i)) for i in range(5)])
+    store.write_points([point(START + i * HOUR, {"sensor": "attic"}, temperature=float(10 + i)) for i in range(3)])
+    store.compact(START + 4 * HOUR)
+
+    rows = {
+        tags["sensor"]: list(points)
+        for (_, tags), points in store.last("esp", group_by=("sensor",), epoch="ns").items()
+    }
+    assert rows == {
+        "hall": [{"time": START + 4 * HOUR, "temperature": 4.0}],
+        "attic": [{"time": START + 2 * HOUR, "temperature": 12.0}],
+    }
+    (row,) = store.last("esp", since=START + 3 * HOUR).get_points()
+    assert row["sensor"] == "hall" and row["time"] == rfc3339(START + 4 * HOUR)
+
+
+def test_scan_time_range(store):
+    store.write_points([point(START + i * HOUR, value=i) for i in range(48)])
+    store.compact(START + DAY)
+    rows = list(store.scan("esp", START + 20 * HOUR, START + 26 * HOUR, epoch="ns").get_points())
+    assert [row["value"] for row in rows] == list(range(20, 26))
+
+
+def test_mean_per_interval(store):
+    store.write_points([point(START + i * 600 * 10**9, value=i, name="x") for i in range(6)])
+    store.write_points([point(START + 3 * HOUR, value=10)])
+    rows = list(store.mean("esp", 3600, START, START + 4 * HOUR, epoch="s").get_points())
+    assert rows == [
+        {"time": START // 10**9, "value": 2.5},
+        {"time": START // 10**9 + 3600, "value": None},
+        {"time": START // 10**9 + 7200, "value": None},
+        {"time": START // 10**9 + 10800, "value": 10.0},
+    ]
+
+
+def test_retention_drops_old_days(tmp_path):
+    store = LocalStore(str(tmp_path / "climate.db"), retention_days=1)
+    store.write_points([point(START, value=1)])
+    store.compact(START + DAY)
+    assert store.partitions() == []
+    assert list(store.scan("esp").get_points()) == []
+    store.close()
+
+
+def test_bad_points_are_rejected(store):
+    with pytest.raises(ValueError):
+        store.write_points([{"measurement": "esp", "fields": {}}])
+
+
+def test_read_only(tmp_path):
+    path = str(tmp_path / "flora.db")
+    with pytest.raises(sqlite3.Error):
+        LocalStore(path, read_only=True).last()
+    assert not os.path.exists(path)
+
+    writer = LocalStore(path)
+    writer.write_points([point(START, value=1)])
+    reader = LocalStore(path, read_only=True)
+    assert len(list(reader.last().get_points())) == 1
+    with pytest.raises(sqlite3.Error):
+        reader.write_points([point(START, value=2)])
+    reader.close()
+    writer.close()
+
+
+@pytest.mark.parametrize("service", ["climate", "energy", "flora", "site"])
+def test_services_link_to_this_module(service):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    link = os.path.join(directory, "..", service, "local_store.py")
+    assert os.path.realpath(link) == os.path.realpath(os.path.join(directory, "local_store.py"))